@@ -0,0 +1,116 @@
+"""Helpers shared by the benchmark scripts: a throwaway server and seed users."""
+import contextlib
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+# the benchmarks flood the chat socket on purpose, so `serve` turns its rate limits off unless `env` sets them
+NO_RATE_LIMITS = {"IOT_WS_RATE_LIMIT": "0", "IOT_WS_USER_RATE_LIMIT": "0"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    def __init__(self, proc: subprocess.Popen, host: str, workdir: Path):
+        self.proc = proc
+        self.host = host
+        self.workdir = workdir
+
+    @property
+    def db_path(self) -> Path:
+        return self.workdir / "db.sqlite3"
+
+    def stop(self):
+        """Stops with SIGINT so shutdown hooks get to flush."""
+        if self.proc.poll() is not None:
+            return
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+@contextlib.contextmanager
+def checkout(rev: str | None):
+    """Yields a source tree of git revision `rev`, or this tree when None."""
+    if rev is None:
+        yield ROOT
+        return
+    with tempfile.TemporaryDirectory(prefix="iot-bench-src-") as tmp:
+        subprocess.run(["git", "-C", str(ROOT), "worktree", "add", "--detach", tmp, rev], check=True, capture_output=True)
+        try:
+            yield Path(tmp)
+        finally:
+            subprocess.run(["git", "-C", str(ROOT), "worktree", "remove", "--force", tmp], check=False, capture_output=True)
+
+
+@contextlib.contextmanager
+def serve(env: dict[str, str] | None = None, workers: int = 1, root: Path = ROOT):
+    """Runs the app of the source tree `root` with uvicorn against a fresh database in a temp dir."""
+    with tempfile.TemporaryDirectory(prefix="iot-bench-") as workdir:
+        for d in ("static", "templates"):
+            os.symlink(root / d, Path(workdir) / d)
+        port = free_port()
+        proc_env = {**os.environ, "PYTHONPATH": str(root), **NO_RATE_LIMITS, **(env or {})}
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "iot_proj:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+            cwd=workdir,
+            env=proc_env,
+        )
+        server = Server(proc, f"127.0.0.1:{port}", Path(workdir))
+        try:
+            wait_for_port(port)
+            yield server
+        finally:
+            server.stop()
+
+
+def wait_for_port(port: int, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"server did not come up on port {port}")
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """p50/p95/p99 in milliseconds of latencies given in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def register_doctor(host: str, i: int, qualifications: list[str] | None = None) -> str:
+    r = httpx.post(
+        f"http://{host}/doctor/register",
+        data={"name": f"doc{i}", "email": f"doc{i}@bench", "mdp": "pw", "cmdp": "pw", "qualifications": qualifications or ["general"]},
+    )
+    return r.cookies["docid"]
+
+
+def register_patient(host: str, i: int) -> str:
+    r = httpx.post(f"http://{host}/register", data={"name": f"pat{i}", "email": f"pat{i}@bench", "mdp": "pw", "cmdp": "pw"})
+    return r.cookies["userid"]
+
+
+def open_conversation(host: str, patient_id: str, doctor_id: str):
+    httpx.post(f"http://{host}/patient/conversation", data={"id": doctor_id}, cookies={"userid": patient_id})
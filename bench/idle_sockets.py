@@ -0,0 +1,135 @@
+"""Memory of idle chat sockets: hold N connections open against one server process.
+
+Client processes open their share of the sockets, answer heartbeat pings and
+otherwise stay silent. The server's RSS is read from /proc before the first
+connection and once all of them are open and settled; the difference divided
+by N is the cost of one idle connection, uvicorn's share included.
+
+Each socket needs a file descriptor on the server, so N is capped by its
+open-files limit (raised to the hard limit here). Clients spread over several
+loopback addresses to stay clear of the ephemeral port range.
+
+Clients do not offer permessage-deflate unless `--deflate` is given. Browsers
+always do, and uvicorn's compressor per socket then dominates the cost.
+
+    python -m bench.idle_sockets --connections 50000 --compare HEAD~1
+    python -m bench.idle_sockets --connections 50000 --deflate
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+
+from websockets.asyncio.client import connect
+
+from bench.common import checkout, serve
+
+PER_ADDRESS = 20_000
+CONNECT_CONCURRENCY = 200
+SETTLE_SECONDS = 3
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    raise RuntimeError("no VmRSS in /proc status")
+
+
+def raise_fd_limit():
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def hold(host: str, first: int, count: int, deflate: bool, ready, release):
+    """Opens sockets `first`..`first + count`, signals `ready` and keeps them until `release` is set."""
+    raise_fd_limit()
+    sockets = []
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def open_one(i: int):
+        async with gate:
+            ws = await connect(
+                f"ws://{host}/ws",
+                additional_headers={"Cookie": f"userid=idle-{i}"},
+                subprotocols=["iot.v2.json"],
+                # no protocol-level pings, the connection stays silent apart from pongs
+                ping_interval=None,
+                local_addr=(f"127.0.0.{2 + i // PER_ADDRESS}", 0),
+                open_timeout=60,
+                compression="deflate" if deflate else None,
+            )
+            sockets.append(ws)
+
+    async def answer_pings(ws):
+        async for frame in ws:
+            if '"ping"' in frame:
+                await ws.send('{"t":"pong"}')
+
+    await asyncio.gather(*(open_one(i) for i in range(first, first + count)))
+    readers = [asyncio.create_task(answer_pings(ws)) for ws in sockets]
+    ready.set()
+    await asyncio.to_thread(release.wait)
+    for r in readers:
+        r.cancel()
+    for ws in sockets:
+        await ws.close()
+
+
+def client(host: str, first: int, count: int, deflate: bool, ready, release):
+    asyncio.run(hold(host, first, count, deflate, ready, release))
+
+
+def run(rev: str | None, connections: int, per_client: int, deflate: bool) -> dict:
+    with checkout(rev) as root, serve(root=root) as server:
+        pid = server.proc.pid
+        time.sleep(SETTLE_SECONDS)
+        before = rss_kb(pid)
+        release = multiprocessing.Event()
+        clients = []
+        started = time.perf_counter()
+        for first in range(0, connections, per_client):
+            ready = multiprocessing.Event()
+            p = multiprocessing.Process(target=client, args=(server.host, first, min(per_client, connections - first), deflate, ready, release))
+            p.start()
+            clients.append((p, ready))
+        for _, ready in clients:
+            ready.wait()
+        connect_seconds = time.perf_counter() - started
+        time.sleep(SETTLE_SECONDS)
+        after = rss_kb(pid)
+        release.set()
+        for p, _ in clients:
+            p.join()
+    return {
+        "rev": rev or "working tree",
+        "connections": connections,
+        "deflate": deflate,
+        "connect_seconds": round(connect_seconds, 1),
+        "rss_before_mb": round(before / 1024, 1),
+        "rss_after_mb": round(after / 1024, 1),
+        "kb_per_connection": round((after - before) / connections, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=50_000)
+    parser.add_argument("--per-client", type=int, default=10_000, help="sockets held by one client process")
+    parser.add_argument("--deflate", action="store_true", help="offer permessage-deflate like a browser")
+    parser.add_argument("--compare", metavar="REV", help="also run against this git revision")
+    args = parser.parse_args()
+    # inherited by the server process
+    raise_fd_limit()
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if args.connections > soft - 100:
+        parser.error(f"the open-files limit is {soft}, too low for {args.connections} server-side sockets")
+    for rev in [None, args.compare] if args.compare else [None]:
+        print(json.dumps(run(rev, args.connections, args.per_client, args.deflate)))
+
+
+if __name__ == "__main__":
+    main()
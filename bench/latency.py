@@ -0,0 +1,87 @@
+"""p50/p99 latency under mixed HTTP polling and WebSocket chat load.
+
+Patients poll their conversation list and latest entries page over HTTP
+while the same patients chat with a doctor over /ws. HTTP latency is the
+request round trip, chat latency is patient send -> doctor receive.
+
+`--compare REV` runs the same load against another git revision too, e.g.
+the sync-engine tree before the async database layer:
+
+    python -m bench.latency --patients 20 --seconds 10 --compare HEAD~1
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from websockets.asyncio.client import connect
+
+from bench.common import checkout, open_conversation, percentiles, register_doctor, register_patient, serve
+
+
+async def load(host: str, doctor_id: str, patient_ids: list[str], seconds: float, msg_interval: float) -> dict:
+    samples: dict[str, list[float]] = {"conversations": [], "entries": [], "chat": []}
+    sent_at: dict[str, float] = {}
+    deadline = time.monotonic() + seconds
+
+    async def poller(patient_id: str):
+        async with httpx.AsyncClient(base_url=f"http://{host}", cookies={"userid": patient_id}, timeout=30) as c:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                await c.get("/patient/conversation")
+                samples["conversations"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                await c.get("/patient/conversation/entries", params={"docId": doctor_id})
+                samples["entries"].append(time.perf_counter() - start)
+
+    async def chatter(ws, patient_id: str):
+        i = 0
+        while time.monotonic() < deadline:
+            tag = f"{patient_id}:{i}"
+            sent_at[tag] = time.perf_counter()
+            await ws.send(json.dumps({"msg": tag, "recvid": doctor_id}))
+            i += 1
+            await asyncio.sleep(msg_interval)
+
+    async def doctor(ws):
+        while True:
+            frame = json.loads(await ws.recv())
+            if frame["type"] == "message":
+                tag = json.loads(frame["data"])["msg"]
+                samples["chat"].append(time.perf_counter() - sent_at.pop(tag))
+
+    async with connect(f"ws://{host}/ws", additional_headers={"Cookie": f"docid={doctor_id}"}, max_queue=None) as doc:
+        sockets = [await connect(f"ws://{host}/ws", additional_headers={"Cookie": f"userid={p}"}) for p in patient_ids]
+        receiver = asyncio.create_task(doctor(doc))
+        await asyncio.gather(*(poller(p) for p in patient_ids), *(chatter(ws, p) for ws, p in zip(sockets, patient_ids)))
+        await asyncio.sleep(0.5)
+        receiver.cancel()
+        for ws in sockets:
+            await ws.close()
+    return {kind: percentiles(values) for kind, values in samples.items()}
+
+
+def run(rev: str | None, patients: int, seconds: float, msg_interval: float) -> dict:
+    with checkout(rev) as root, serve(root=root) as server:
+        doctor_id = register_doctor(server.host, 0)
+        patient_ids = [register_patient(server.host, i) for i in range(patients)]
+        for p in patient_ids:
+            open_conversation(server.host, p, doctor_id)
+        result = asyncio.run(load(server.host, doctor_id, patient_ids, seconds, msg_interval))
+    return {"rev": rev or "working tree", "patients": patients, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--msg-interval", type=float, default=0.05, help="pause between chat messages of one patient")
+    parser.add_argument("--compare", metavar="REV", help="also run against this git revision")
+    args = parser.parse_args()
+    for rev in [None, args.compare] if args.compare else [None]:
+        print(json.dumps(run(rev, args.patients, args.seconds, args.msg_interval)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Login throughput with PBKDF2 inline vs on the hash process pool.
+
+Hammers POST /login with `--clients` concurrent clients for `--seconds`
+and reports successful logins/sec, per hash worker, and how many
+requests were turned away with 503.
+
+    python -m bench.logins --clients 32 --seconds 10 --workers 0 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from bench.common import register_patient, serve
+
+
+async def hammer(host: str, clients: int, seconds: float) -> dict[int, int]:
+    statuses: dict[int, int] = {}
+    deadline = time.monotonic() + seconds
+
+    async def client():
+        async with httpx.AsyncClient(timeout=60) as c:
+            while time.monotonic() < deadline:
+                r = await c.post(f"http://{host}/login", data={"email": "pat0@bench", "mdp": "pw"})
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return statuses
+
+
+def run(workers: int, clients: int, seconds: float) -> dict:
+    with serve({"IOT_HASH_WORKERS": str(workers)}) as server:
+        register_patient(server.host, 0)
+        start = time.perf_counter()
+        statuses = asyncio.run(hammer(server.host, clients, seconds))
+        elapsed = time.perf_counter() - start
+    ok = statuses.get(302, 0)
+    cores = max(workers, 1)
+    return {
+        "hash_workers": workers,
+        "clients": clients,
+        "logins_per_sec": round(ok / elapsed, 1),
+        "logins_per_sec_per_core": round(ok / elapsed / cores, 1),
+        "rejected_503": statuses.get(503, 0),
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--workers", type=int, action="append", help="hash pool sizes to try, 0 hashes inline")
+    args = parser.parse_args()
+    for workers in args.workers or [0, os.cpu_count() or 1]:
+        print(json.dumps(run(workers, args.clients, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
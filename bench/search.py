@@ -0,0 +1,78 @@
+"""Search latency on a synthetic corpus, a million messages by default.
+
+Seeds a fresh database in a temp dir as if the history predated the search
+index, times the backfill, then runs `search_entries` for random doctors and
+patients with common, rare, prefix and two-word queries.
+
+    python -m bench.search --messages 1000000 --queries 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from bench.common import percentiles
+from bench.seed import populate
+
+QUERIES = {
+    "common": ["fievre", "douleur", "traitement"],
+    "rare": ["inhalateur", "pommade", "scanner"],
+    "prefix": ["antibio", "consult", "hydrat"],
+    "two_words": ["douleur dos", "fievre toux", "tension analyse"],
+}
+
+
+async def run_queries(users: list[tuple[str, bool]], queries: int, rng: random.Random) -> dict[str, dict]:
+    from iot_proj.models import async_engine, async_session
+    from iot_proj.search import search_entries
+
+    results = {}
+    for kind, terms in QUERIES.items():
+        samples, hits = [], 0
+        async with async_session() as session:
+            for _ in range(queries):
+                user_id, is_doc = rng.choice(users)
+                started = time.perf_counter()
+                page = await search_entries(user_id, is_doc, rng.choice(terms), session)
+                samples.append(time.perf_counter() - started)
+                hits += len(page.hits) if page else 0
+        results[kind] = {**percentiles(samples), "avg_hits": round(hits / queries, 1)}
+    # aiosqlite's connection threads would keep the process alive
+    await async_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--doctors", type=int, default=100)
+    parser.add_argument("--patients-per-doctor", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200, help="queries per kind")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix="iot-bench-search-") as tmp:
+        # settings are read at import, so point the app at the temp database first
+        os.environ["IOT_DB_PATH"] = os.path.join(tmp, "db.sqlite3")
+        from iot_proj.models import create_db_and_tables
+        from iot_proj.search import backfill, create_search_index
+
+        create_db_and_tables()
+        started = time.perf_counter()
+        dataset = populate(os.environ["IOT_DB_PATH"], args.doctors, args.patients_per_doctor, args.messages, rng)
+        seeded = time.perf_counter() - started
+        started = time.perf_counter()
+        create_search_index()
+        indexed = backfill()
+        backfilled = time.perf_counter() - started
+        print(json.dumps({"bench": "setup", "messages": args.messages, "seed_seconds": round(seeded, 1), "indexed": indexed, "backfill_seconds": round(backfilled, 1)}))
+        users = [(d, True) for d in dataset.doctor_ids] + [(p, False) for p in rng.sample(dataset.patient_ids, min(len(dataset.patient_ids), 100))]
+        for kind, result in asyncio.run(run_queries(users, args.queries, rng)).items():
+            print(json.dumps({"bench": "search", "query": kind, **result}))
+
+
+if __name__ == "__main__":
+    main()
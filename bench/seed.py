@@ -0,0 +1,112 @@
+"""Synthetic doctors, patients, conversations and chat entries.
+
+Writes straight into the SQLite file with executemany, which is orders of
+magnitude faster than registering through the app. Every user can log in
+with `PASSWORD`; emails are `doc<i>@bench` and `pat<i>@bench` like the ones
+`bench.common.register_doctor/register_patient` create.
+
+    IOT_DB_PATH=/tmp/seeded.sqlite3 python -m bench.seed --doctors 50 --patients-per-doctor 20 --messages 200000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+PASSWORD = "pw"
+WORDS = (
+    "fievre toux douleur tete ventre gorge dos allergie traitement ordonnance paracetamol ibuprofene antibiotique "
+    "tension diabete insuline analyse sang radio scanner rendez-vous consultation vaccin grippe rhume fatigue sommeil "
+    "vertige nausee eruption cutanee asthme inhalateur posologie comprime sirop pommade repos hydratation urgence"
+).split()
+FILLER = "bonjour merci docteur oui non je vous il elle depuis hier matin soir jours semaine encore toujours un peu beaucoup".split()
+
+
+@dataclass
+class Dataset:
+    doctor_ids: list[str]
+    patient_ids: list[str]
+    # (doctor id, patient id) of every conversation, patient i talks to doctor i // patients_per_doctor
+    conversations: list[tuple[str, str]]
+    messages: int
+
+
+def message(rng: random.Random) -> str:
+    # rough zipf: low indexes of WORDS come up far more often
+    words = [WORDS[min(int(rng.paretovariate(1.2)) - 1, len(WORDS) - 1)] for _ in range(rng.randint(1, 4))]
+    words += rng.choices(FILLER, k=rng.randint(3, 12))
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def populate(db_path: str, doctors: int, patients_per_doctor: int, messages: int, rng: random.Random) -> Dataset:
+    """Fills an existing, empty schema; messages land in random conversations, one second apart."""
+    from iot_proj.passwords import hasher
+
+    # one hash for everyone, PBKDF2 per user would dominate the seeding time
+    password = hasher.hash(PASSWORD)
+    db = sqlite3.connect(db_path)
+    doctor_ids = [str(uuid.uuid4()) for _ in range(doctors)]
+    patient_ids, convo_ids, conversations = [], [], []
+    db.executemany(
+        "insert into doctor (id, email, password, name, qualifications) values (?, ?, ?, ?, '')",
+        ((d, f"doc{i}@bench", password, f"doc{i}") for i, d in enumerate(doctor_ids)),
+    )
+    db.executemany("insert into doctorqualification (doctor_id, qualification) values (?, 'general')", ((d,) for d in doctor_ids))
+    for d in doctor_ids:
+        for _ in range(patients_per_doctor):
+            p, c = str(uuid.uuid4()), str(uuid.uuid4())
+            patient_ids.append(p)
+            convo_ids.append(c)
+            conversations.append((d, p))
+    db.executemany(
+        "insert into patient (id, email, password, name) values (?, ?, ?, ?)",
+        ((p, f"pat{i}@bench", password, f"pat{i}") for i, p in enumerate(patient_ids)),
+    )
+    db.executemany("insert into conversation (id, doctor_id, patient_id) values (?, ?, ?)", ((c, d, p) for c, (d, p) in zip(convo_ids, conversations)))
+    start = datetime(2023, 1, 1)
+    rows = ((start + timedelta(seconds=i), i % 2, message(rng), convo_ids[rng.randrange(len(convo_ids))]) for i in range(messages))
+    db.executemany("insert into conversationentries (time, from_doctor, message, conversation_id) values (?, ?, ?, ?)", rows)
+    db.commit()
+    db.close()
+    return Dataset(doctor_ids=doctor_ids, patient_ids=patient_ids, conversations=conversations, messages=messages)
+
+
+def create(db_path: str, doctors: int, patients_per_doctor: int, messages: int, seed: int = 1) -> Dataset:
+    """Creates the app's schema and search index at `db_path`, then populates it.
+
+    `IOT_DB_PATH` has to point at `db_path` before iot_proj is first imported,
+    settings are read once at import.
+    """
+    from iot_proj.models import create_db_and_tables
+    from iot_proj.search import create_search_index
+
+    create_db_and_tables()
+    # with the index in place first its triggers cover the seeded rows, so the app has nothing to backfill
+    create_search_index()
+    return populate(db_path, doctors, patients_per_doctor, messages, random.Random(seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--doctors", type=int, default=50)
+    parser.add_argument("--patients-per-doctor", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--manifest", help="also write the generated ids to this JSON file")
+    args = parser.parse_args()
+    db_path = os.environ.get("IOT_DB_PATH", "db.sqlite3")
+    started = time.perf_counter()
+    dataset = create(db_path, args.doctors, args.patients_per_doctor, args.messages, args.seed)
+    if args.manifest:
+        with open(args.manifest, "w") as f:
+            json.dump(asdict(dataset), f)
+    print(json.dumps({"db": db_path, "doctors": args.doctors, "patients": len(dataset.patient_ids), "messages": args.messages, "seconds": round(time.perf_counter() - started, 1)}))
+
+
+if __name__ == "__main__":
+    main()
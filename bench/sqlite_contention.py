@@ -0,0 +1,91 @@
+"""Read/write contention on SQLite with the `default` vs `production` profile.
+
+One writer thread inserts conversation entries with a commit per insert
+while `--readers` threads page through the latest entries, for
+`--seconds` each. Reports reads/sec, commits/sec and how often a reader
+or the writer hit "database is locked".
+
+    python -m bench.sqlite_contention --readers 4 --seconds 5
+"""
+import argparse
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, select
+
+from iot_proj.models import Conversation, ConversationEntries, Doctor, Patient, apply_pragmas, sqlite_pragmas
+from iot_proj.settings import DbProfile
+
+
+def run(profile: DbProfile, readers: int, seconds: float) -> dict:
+    with tempfile.TemporaryDirectory(prefix="iot-bench-") as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.sqlite3'}", connect_args={"check_same_thread": False}, pool_size=readers + 1)
+        pragmas = sqlite_pragmas(profile)
+        event.listen(engine, "connect", lambda con, _: apply_pragmas(con, pragmas))
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as s:
+            s.add(Doctor(id="d", email="d@bench", password="", name="d", qualifications=""))
+            s.add(Patient(id="p", email="p@bench", password="", name="p"))
+            s.add(Conversation(id="c", doctor_id="d", patient_id="p"))
+            s.commit()
+
+        counts = {"reads": 0, "writes": 0, "read_locked": 0, "write_locked": 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + seconds
+
+        def bump(key: str):
+            with lock:
+                counts[key] += 1
+
+        def writer():
+            while time.monotonic() < deadline:
+                try:
+                    with Session(engine) as s:
+                        s.add(ConversationEntries(from_doctor=False, message="hello", conversation_id="c"))
+                        s.commit()
+                    bump("writes")
+                except OperationalError:
+                    bump("write_locked")
+
+        def reader():
+            q = select(ConversationEntries).where(ConversationEntries.conversation_id == "c").order_by(ConversationEntries.id.desc()).limit(50)
+            while time.monotonic() < deadline:
+                try:
+                    with Session(engine) as s:
+                        s.exec(q).all()
+                    bump("reads")
+                except OperationalError:
+                    bump("read_locked")
+
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.dispose()
+    return {
+        "profile": profile.value,
+        "readers": readers,
+        "reads_per_sec": round(counts["reads"] / seconds, 1),
+        "commits_per_sec": round(counts["writes"] / seconds, 1),
+        "read_locked": counts["read_locked"],
+        "write_locked": counts["write_locked"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    for profile in DbProfile:
+        print(json.dumps(run(profile, args.readers, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
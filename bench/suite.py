@@ -0,0 +1,289 @@
+"""Load suite: one seeded database, HTTP and WebSocket scenarios, a JSON report.
+
+Seeds doctors, patients, conversations and entries with `bench.seed`, starts
+the app on that database and runs each scenario against it:
+
+- `logins`: concurrent POST /login of random seeded patients.
+- `polling`: patients revalidating their conversation list and latest
+  entries page with If-None-Match, as the page does.
+- `history`: doctors paging back through a conversation with `before`.
+- `fanout`: N patient sockets; every doctor sends to each of its connected
+  patients per round, latency is doctor send -> patient receive.
+
+Every scenario reports p50/p95/p99 and throughput. `--out` saves the report
+so runs on two trees can be compared with `diff`:
+
+    python -m bench.suite run --out before.json
+    python -m bench.suite run --scenario fanout --sockets 500 --out after.json
+    python -m bench.suite diff before.json after.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import httpx
+from websockets.asyncio.client import connect
+
+from bench.common import ROOT, percentiles, serve
+from bench.seed import Dataset, create
+
+RECV_TIMEOUT = 10
+
+
+def rate(count: int, elapsed: float) -> float:
+    return round(count / elapsed, 1) if elapsed else 0.0
+
+
+async def logins(host: str, ds: Dataset, args: argparse.Namespace, rng: random.Random) -> dict:
+    samples: list[float] = []
+    statuses: dict[int, int] = {}
+    deadline = time.monotonic() + args.seconds
+
+    async def client():
+        async with httpx.AsyncClient(base_url=f"http://{host}", timeout=60) as c:
+            while time.monotonic() < deadline:
+                i = rng.randrange(len(ds.patient_ids))
+                started = time.perf_counter()
+                r = await c.post("/login", data={"email": f"pat{i}@bench", "mdp": "pw"})
+                samples.append(time.perf_counter() - started)
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    return {"clients": args.clients, "latency": percentiles(samples), "logins_per_sec": rate(statuses.get(302, 0), elapsed), "statuses": statuses}
+
+
+async def polling(host: str, ds: Dataset, args: argparse.Namespace, rng: random.Random) -> dict:
+    samples: dict[str, list[float]] = {"conversations": [], "entries": []}
+    not_modified = 0
+    deadline = time.monotonic() + args.seconds
+
+    async def client(doctor_id: str, patient_id: str):
+        nonlocal not_modified
+        etags: dict[str, str] = {}
+        requests = {"conversations": ("/patient/conversation", {}), "entries": ("/patient/conversation/entries", {"docId": doctor_id})}
+        async with httpx.AsyncClient(base_url=f"http://{host}", cookies={"userid": patient_id}, timeout=30) as c:
+            while time.monotonic() < deadline:
+                for kind, (path, params) in requests.items():
+                    headers = {"If-None-Match": etags[kind]} if kind in etags else {}
+                    started = time.perf_counter()
+                    r = await c.get(path, params=params, headers=headers)
+                    samples[kind].append(time.perf_counter() - started)
+                    not_modified += r.status_code == 304
+                    if "etag" in r.headers:
+                        etags[kind] = r.headers["etag"]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(*rng.choice(ds.conversations)) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    total = sum(map(len, samples.values()))
+    return {
+        "clients": args.clients,
+        **{kind: percentiles(values) for kind, values in samples.items()},
+        "requests_per_sec": rate(total, elapsed),
+        "not_modified": not_modified,
+    }
+
+
+async def history(host: str, ds: Dataset, args: argparse.Namespace, rng: random.Random) -> dict:
+    samples: list[float] = []
+    entries = 0
+    deadline = time.monotonic() + args.seconds
+
+    async def client():
+        nonlocal entries
+        while time.monotonic() < deadline:
+            doctor_id, patient_id = rng.choice(ds.conversations)
+            params = {"patId": patient_id, "limit": args.page_size}
+            async with httpx.AsyncClient(base_url=f"http://{host}", cookies={"docid": doctor_id}, timeout=30) as c:
+                for _ in range(args.history_pages):
+                    started = time.perf_counter()
+                    page = (await c.get("/doctor/conversation/entries", params=params)).json()
+                    samples.append(time.perf_counter() - started)
+                    entries += len(page["entries"])
+                    if not page["has_more"] or time.monotonic() >= deadline:
+                        break
+                    params["before"] = min(e["id"] for e in page["entries"])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    return {"clients": args.clients, "page_size": args.page_size, "latency": percentiles(samples), "pages_per_sec": rate(len(samples), elapsed), "entries_per_sec": rate(entries, elapsed)}
+
+
+async def fanout(host: str, ds: Dataset, args: argparse.Namespace, rng: random.Random) -> dict:
+    pairs = rng.sample(ds.conversations, min(args.sockets, len(ds.conversations)))
+    patients_of: dict[str, list[str]] = {}
+    for doctor_id, patient_id in pairs:
+        patients_of.setdefault(doctor_id, []).append(patient_id)
+    connect_samples: list[float] = []
+    latencies: list[float] = []
+    sent_at: dict[str, float] = {}
+    round_done = asyncio.Event()
+    pending = 0
+
+    async def open_socket(cookie: str):
+        started = time.perf_counter()
+        ws = await connect(f"ws://{host}/ws", additional_headers={"Cookie": cookie}, max_queue=None)
+        connect_samples.append(time.perf_counter() - started)
+        return ws
+
+    async def receive(ws):
+        nonlocal pending
+        while True:
+            frame = json.loads(await ws.recv())
+            if frame["type"] != "message":
+                continue
+            latencies.append(time.perf_counter() - sent_at.pop(json.loads(frame["data"])["msg"]))
+            pending -= 1
+            if pending == 0:
+                round_done.set()
+
+    async with contextlib.AsyncExitStack() as stack:
+        doctors = {d: await stack.enter_async_context(await open_socket(f"docid={d}")) for d in patients_of}
+        patients = [await stack.enter_async_context(await open_socket(f"userid={p}")) for _, p in pairs]
+        receivers = [asyncio.create_task(receive(ws)) for ws in patients]
+        # let the presence frames of all those joins settle before timing relays
+        await asyncio.sleep(0.5)
+
+        async def send_round(doctor_id: str, r: int):
+            for patient_id in patients_of[doctor_id]:
+                tag = f"{r}:{patient_id}"
+                sent_at[tag] = time.perf_counter()
+                await doctors[doctor_id].send(json.dumps({"msg": tag, "recvid": patient_id}))
+
+        rounds = 0
+        started = time.perf_counter()
+        for r in range(args.rounds):
+            round_done.clear()
+            pending = len(pairs)
+            await asyncio.gather(*(send_round(d, r) for d in doctors))
+            try:
+                await asyncio.wait_for(round_done.wait(), RECV_TIMEOUT)
+            except TimeoutError:
+                break
+            rounds += 1
+        elapsed = time.perf_counter() - started
+        for task in receivers:
+            task.cancel()
+    return {
+        "sockets": len(pairs),
+        "doctors": len(doctors),
+        "rounds": rounds,
+        "connect": percentiles(connect_samples),
+        "latency": percentiles(latencies),
+        "lost": len(sent_at),
+        "deliveries_per_sec": rate(len(latencies), elapsed),
+    }
+
+
+SCENARIOS: dict[str, Callable[[str, Dataset, argparse.Namespace, random.Random], Awaitable[dict]]] = {
+    "logins": logins,
+    "polling": polling,
+    "history": history,
+    "fanout": fanout,
+}
+
+
+def revision() -> dict:
+    def git(*cmd: str) -> str:
+        return subprocess.run(["git", "-C", str(ROOT), *cmd], capture_output=True, text=True).stdout.strip()
+
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def run(args: argparse.Namespace) -> dict:
+    report = {
+        "meta": {
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            **revision(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("command", "out")},
+        },
+        "scenarios": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="iot-bench-data-") as tmp:
+        db_path = os.path.join(tmp, "db.sqlite3")
+        # settings are read at import, so point the app at the seeded database first
+        os.environ["IOT_DB_PATH"] = db_path
+        started = time.perf_counter()
+        dataset = create(db_path, args.doctors, args.patients_per_doctor, args.messages, args.seed)
+        report["meta"]["seed_seconds"] = round(time.perf_counter() - started, 1)
+        # send queues sized so fan-out measures relays, not frame drops
+        with serve({"IOT_SEND_QUEUE_SIZE": str(max(args.rounds, 1024))}) as server:
+            for name in args.scenario or list(SCENARIOS):
+                rng = random.Random(args.seed)
+                result = asyncio.run(SCENARIOS[name](server.host, dataset, args, rng))
+                report["scenarios"][name] = result
+                print(json.dumps({"scenario": name, **result}), flush=True)
+    return report
+
+
+def flatten(report: dict, prefix: str = "") -> dict[str, float]:
+    out = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            out.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[f"{prefix}{key}"] = value
+    return out
+
+
+def diff(before_path: str, after_path: str):
+    """Prints every metric both reports have, with the relative change."""
+    with open(before_path) as f:
+        before = flatten(json.load(f)["scenarios"])
+    with open(after_path) as f:
+        after = flatten(json.load(f)["scenarios"])
+    width = max(map(len, before.keys() | after.keys()), default=0)
+    print(f"{'metric':<{width}}  {'before':>12}  {'after':>12}  {'change':>8}")
+    for key in sorted(before.keys() & after.keys()):
+        a, b = before[key], after[key]
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"{key:<{width}}  {a:>12}  {b:>12}  {change:>8}")
+    for key in sorted(before.keys() ^ after.keys()):
+        print(f"{key:<{width}}  {before.get(key, '-'):>12}  {after.get(key, '-'):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    r = commands.add_parser("run", help="seed a database and run the scenarios")
+    r.add_argument("--scenario", choices=list(SCENARIOS), action="append", help="scenarios to run, all by default")
+    r.add_argument("--doctors", type=int, default=20)
+    r.add_argument("--patients-per-doctor", type=int, default=25)
+    r.add_argument("--messages", type=int, default=100_000)
+    r.add_argument("--seed", type=int, default=1)
+    r.add_argument("--clients", type=int, default=16, help="concurrent HTTP clients of logins, polling and history")
+    r.add_argument("--seconds", type=float, default=10, help="duration of each HTTP scenario")
+    r.add_argument("--page-size", type=int, default=50)
+    r.add_argument("--history-pages", type=int, default=20, help="pages walked back per conversation")
+    r.add_argument("--sockets", type=int, default=200, help="patient sockets of the fan-out")
+    r.add_argument("--rounds", type=int, default=50, help="messages each fan-out patient receives")
+    r.add_argument("-o", "--out", help="write the report to this JSON file")
+    d = commands.add_parser("diff", help="compare two saved reports")
+    d.add_argument("before")
+    d.add_argument("after")
+    args = parser.parse_args()
+    if args.command == "diff":
+        diff(args.before, args.after)
+        return
+    report = run(args)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Sustained vitals ingestion: N devices pushing batches as fast as they are accepted.
+
+Every device is a patient of one doctor, sending heart rate, SpO2 and
+temperature batches over POST /patient/vitals or the /vitals/ws socket. The
+doctor stays connected to /ws and counts the live aggregate frames.
+
+Reports samples/sec accepted, per-batch latency (HTTP only) and how many
+samples were in VitalsChunk once the server flushed on shutdown.
+
+    python -m bench.vitals --devices 50 --batch 100 --seconds 10 --transport http --transport ws
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import time
+
+import httpx
+from websockets.asyncio.client import connect
+
+from bench.common import open_conversation, percentiles, register_doctor, register_patient, serve
+
+METRICS = {"heart_rate": (55, 110), "spo2": (92, 100), "temperature": (36.0, 38.5)}
+
+
+def make_batch(rng: random.Random, now_ms: int, size: int) -> str:
+    t = [now_ms - (size - i) * 10 for i in range(size)]
+    series = [{"metric": m, "t": t, "v": [round(rng.uniform(lo, hi), 1) for _ in t]} for m, (lo, hi) in METRICS.items()]
+    return json.dumps({"series": series})
+
+
+async def load(host: str, transport: str, doctor_id: str, patient_ids: list[str], batch: int, seconds: float) -> dict:
+    rng = random.Random(1)
+    samples_per_batch = batch * len(METRICS)
+    latencies: list[float] = []
+    accepted = 0
+    rejected = 0
+    live_frames = 0
+    deadline = time.monotonic() + seconds
+
+    async def http_device(patient_id: str):
+        nonlocal accepted, rejected
+        async with httpx.AsyncClient(base_url=f"http://{host}", cookies={"userid": patient_id}, timeout=30) as c:
+            while time.monotonic() < deadline:
+                body = make_batch(rng, int(time.time() * 1000), batch)
+                started = time.perf_counter()
+                r = await c.post("/patient/vitals", content=body, headers={"Content-Type": "application/json"})
+                latencies.append(time.perf_counter() - started)
+                if r.status_code == 202:
+                    accepted += samples_per_batch
+                else:
+                    rejected += samples_per_batch
+                    await asyncio.sleep(0.1)
+
+    async def ws_device(patient_id: str):
+        nonlocal accepted
+        async with connect(f"ws://{host}/vitals/ws", additional_headers={"Cookie": f"userid={patient_id}"}) as ws:
+            while time.monotonic() < deadline:
+                await ws.send(make_batch(rng, int(time.time() * 1000), batch))
+                accepted += samples_per_batch
+
+    async def doctor(ws):
+        nonlocal live_frames
+        while True:
+            frame = json.loads(await ws.recv())
+            live_frames += frame.get("t") == "vitals"
+
+    async with connect(f"ws://{host}/ws", additional_headers={"Cookie": f"docid={doctor_id}"}, subprotocols=["iot.v2.json"], max_queue=None) as doc:
+        receiver = asyncio.create_task(doctor(doc))
+        device = http_device if transport == "http" else ws_device
+        started = time.perf_counter()
+        await asyncio.gather(*(device(p) for p in patient_ids))
+        elapsed = time.perf_counter() - started
+        # let the last live window go out
+        await asyncio.sleep(1.5)
+        receiver.cancel()
+    result = {"samples_per_sec": round(accepted / elapsed, 1), "accepted": accepted, "rejected": rejected, "live_frames": live_frames}
+    if latencies:
+        result["batch_latency"] = percentiles(latencies)
+    return result
+
+
+def run(transport: str, devices: int, batch: int, seconds: float) -> dict:
+    with serve() as server:
+        doctor_id = register_doctor(server.host, 0)
+        patient_ids = [register_patient(server.host, i) for i in range(devices)]
+        for p in patient_ids:
+            open_conversation(server.host, p, doctor_id)
+        result = asyncio.run(load(server.host, transport, doctor_id, patient_ids, batch, seconds))
+        # stopping flushes what the store still buffers
+        server.stop()
+        with sqlite3.connect(server.db_path) as db:
+            stored, chunks = db.execute("select coalesce(sum(count), 0), count(*) from vitalschunk").fetchone()
+    return {"transport": transport, "devices": devices, "batch": batch, **result, "stored": stored, "chunks": chunks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=100, help="readings per metric in one batch")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--transport", choices=["http", "ws"], action="append")
+    args = parser.parse_args()
+    for transport in args.transport or ["http", "ws"]:
+        print(json.dumps(run(transport, args.devices, args.batch, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Chat throughput over /ws: N patient sockets flooding one doctor.
+
+Runs two profiles against a fresh server each:
+
+- `baseline`: one commit per message, relayed only once it is saved
+  (`IOT_DELIVERY=durable`, `IOT_WRITER_BATCH_SIZE=1`), which is what the
+  handler used to do inline.
+- `write_behind`: the default pipeline, relay first and bulk commits.
+
+    python -m bench.ws_messages --sockets 50 --messages 200
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import sqlite3
+import time
+
+from websockets.asyncio.client import connect
+
+from bench.common import open_conversation, register_doctor, register_patient, serve
+
+PROFILES = {
+    "baseline": {"IOT_DELIVERY": "durable", "IOT_WRITER_BATCH_SIZE": "1"},
+    "write_behind": {},
+}
+RECV_TIMEOUT = 10
+
+
+async def flood(host: str, doctor_id: str, patient_ids: list[str], messages: int) -> tuple[float, int]:
+    expected = len(patient_ids) * messages
+    async with connect(f"ws://{host}/ws", additional_headers={"Cookie": f"docid={doctor_id}"}, max_queue=None) as doc:
+        patients = [
+            await connect(f"ws://{host}/ws", additional_headers={"Cookie": f"userid={p}"}, max_queue=None) for p in patient_ids
+        ]
+
+        async def send_all(ws):
+            for i in range(messages):
+                await ws.send(json.dumps({"msg": f"message {i}", "recvid": doctor_id}))
+
+        received = 0
+
+        async def receive_all():
+            nonlocal received
+            while received < expected:
+                # give up once relays stall, dropped frames never arrive
+                frame = json.loads(await asyncio.wait_for(doc.recv(), RECV_TIMEOUT))
+                received += frame["type"] == "message"
+
+        start = time.perf_counter()
+        with contextlib.suppress(TimeoutError):
+            await asyncio.gather(receive_all(), *(send_all(ws) for ws in patients))
+        elapsed = time.perf_counter() - start
+        for ws in patients:
+            await ws.close()
+    return elapsed, received
+
+
+def run_profile(name: str, sockets: int, messages: int) -> dict:
+    # size the send queue for the whole flood so the numbers measure the pipeline, not frame drops
+    env = {"IOT_SEND_QUEUE_SIZE": str(sockets * messages), **PROFILES[name]}
+    with serve(env) as server:
+        doctor_id = register_doctor(server.host, 0)
+        patient_ids = [register_patient(server.host, i) for i in range(sockets)]
+        for p in patient_ids:
+            open_conversation(server.host, p, doctor_id)
+        elapsed, relayed = asyncio.run(flood(server.host, doctor_id, patient_ids, messages))
+        # stopping flushes whatever the writer still has queued
+        server.stop()
+        with sqlite3.connect(server.db_path) as db:
+            persisted = db.execute("select count(*) from conversationentries").fetchone()[0]
+    total = sockets * messages
+    return {"profile": name, "sockets": sockets, "messages": total, "relayed": relayed, "persisted": persisted, "seconds": round(elapsed, 3), "msgs_per_sec": round(total / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200, help="messages per socket")
+    parser.add_argument("--profile", choices=list(PROFILES), action="append")
+    args = parser.parse_args()
+    for name in args.profile or list(PROFILES):
+        print(json.dumps(run_profile(name, args.sockets, args.messages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Wire protocol comparison: `iot.v1` (nested JSON) against `iot.v2.json` (flat).
+
+Three measurements per protocol:
+
+- `encoding`: bytes per chat frame raw and deflated, both per message and
+  with a shared context the way permessage-deflate keeps it, plus encodes/sec.
+- `chat`: N patient sockets flooding one doctor through a real server.
+- `presence`: frames the doctor receives while N patients connect at once.
+
+    python -m bench.ws_protocol --sockets 20 --messages 200
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+import uuid
+import zlib
+
+from websockets.asyncio.client import connect
+
+from bench.common import open_conversation, register_doctor, register_patient, serve
+from iot_proj.wire import Protocol, encode_message
+
+RECV_TIMEOUT = 10
+SAMPLE_MESSAGES = ["ok", "Bonjour docteur, j'ai de la fievre depuis hier soir.", "x" * 400]
+
+
+def deflated_sizes(frames: list[str]) -> tuple[int, int]:
+    """Total size of `frames` deflated one by one and with a context shared across frames."""
+    alone = 0
+    for f in frames:
+        c = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        alone += len(c.compress(f.encode()) + c.flush(zlib.Z_SYNC_FLUSH)) - 4
+    shared = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    together = sum(len(shared.compress(f.encode()) + shared.flush(zlib.Z_SYNC_FLUSH)) - 4 for f in frames)
+    return alone, together
+
+
+def encoding(protocol: Protocol, count: int) -> dict:
+    sender = str(uuid.uuid4())
+    frames = [encode_message(protocol, SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)], sender) for i in range(count)]
+    raw = sum(len(f.encode()) for f in frames)
+    alone, together = deflated_sizes(frames)
+    start = time.perf_counter()
+    for i in range(count):
+        encode_message(protocol, SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)], sender)
+    elapsed = time.perf_counter() - start
+    return {
+        "bench": "encoding",
+        "protocol": protocol.value,
+        "bytes_per_msg": round(raw / count, 1),
+        "deflate_bytes_per_msg": round(alone / count, 1),
+        "deflate_ctx_bytes_per_msg": round(together / count, 1),
+        "encodes_per_sec": round(count / elapsed),
+    }
+
+
+async def chat(host: str, protocol: Protocol, doctor_id: str, patient_ids: list[str], messages: int) -> dict:
+    expected = len(patient_ids) * messages
+    async with connect(
+        f"ws://{host}/ws", additional_headers={"Cookie": f"docid={doctor_id}"}, subprotocols=[protocol.value], max_queue=None
+    ) as doc:
+        patients = [
+            await connect(f"ws://{host}/ws", additional_headers={"Cookie": f"userid={p}"}, subprotocols=[protocol.value], max_queue=None)
+            for p in patient_ids
+        ]
+        # presence from the patients above, not part of the flood
+        await asyncio.sleep(0.5)
+        with contextlib.suppress(TimeoutError):
+            while True:
+                await asyncio.wait_for(doc.recv(), 0.2)
+
+        async def send_all(ws):
+            for i in range(messages):
+                await ws.send(json.dumps({"msg": SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)], "recvid": doctor_id}))
+
+        received = 0
+        received_bytes = 0
+
+        async def receive_all():
+            nonlocal received, received_bytes
+            while received < expected:
+                frame = await asyncio.wait_for(doc.recv(), RECV_TIMEOUT)
+                received_bytes += len(frame.encode())
+                received += 1
+
+        start = time.perf_counter()
+        with contextlib.suppress(TimeoutError):
+            await asyncio.gather(receive_all(), *(send_all(ws) for ws in patients))
+        elapsed = time.perf_counter() - start
+        for ws in patients:
+            await ws.close()
+    return {
+        "bench": "chat",
+        "protocol": protocol.value,
+        "messages": expected,
+        "relayed": received,
+        "bytes_per_msg": round(received_bytes / max(received, 1), 1),
+        "msgs_per_sec": round(received / elapsed, 1),
+    }
+
+
+async def presence(host: str, protocol: Protocol, doctor_id: str, patient_ids: list[str]) -> dict:
+    async with connect(
+        f"ws://{host}/ws", additional_headers={"Cookie": f"docid={doctor_id}"}, subprotocols=[protocol.value], max_queue=None
+    ) as doc:
+        await doc.recv()  # online snapshot
+        patients = await asyncio.gather(
+            *(connect(f"ws://{host}/ws", additional_headers={"Cookie": f"userid={p}"}, subprotocols=[protocol.value]) for p in patient_ids)
+        )
+        frames = 0
+        with contextlib.suppress(TimeoutError):
+            while True:
+                await asyncio.wait_for(doc.recv(), 0.5)
+                frames += 1
+        for ws in patients:
+            await ws.close()
+    return {"bench": "presence", "protocol": protocol.value, "joins": len(patient_ids), "frames": frames}
+
+
+def run(protocol: Protocol, sockets: int, messages: int) -> list[dict]:
+    results = [encoding(protocol, 100_000)]
+    env = {"IOT_SEND_QUEUE_SIZE": str(sockets * messages + sockets)}
+    with serve(env) as server:
+        doctor_id = register_doctor(server.host, 0)
+        patient_ids = [register_patient(server.host, i) for i in range(sockets)]
+        for p in patient_ids:
+            open_conversation(server.host, p, doctor_id)
+        results.append(asyncio.run(chat(server.host, protocol, doctor_id, patient_ids, messages)))
+        results.append(asyncio.run(presence(server.host, protocol, doctor_id, patient_ids)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=200, help="messages per socket")
+    parser.add_argument("--protocol", choices=[p.value for p in Protocol], action="append")
+    args = parser.parse_args()
+    for name in args.protocol or [p.value for p in Protocol]:
+        for result in run(Protocol(name), args.sockets, args.messages):
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
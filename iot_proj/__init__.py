@@ -1,62 +1,145 @@
+import asyncio
+from datetime import datetime
 from typing import Annotated
 from fastapi import Depends, FastAPI, Form, Path, Query, Request, Response, WebSocket, WebSocketDisconnect, WebSocketException, status
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from jinja2 import FileSystemBytecodeCache
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import ValidationError
-from sqlmodel import select
-from iot_proj.deps import get_doctor, get_patient
-from iot_proj.doctor_services import create_doctor, get_doc_conversation_entries, get_doc_convos, get_doctor as get_doc_login, get_doctor_by_id
+from sqlalchemy.exc import SQLAlchemyError
+from iot_proj import metrics
+from iot_proj.admission import Admission, ChatOverloaded
+from iot_proj.assets import PageCache, StaticAssets
+from iot_proj.conversation_cache import ConnectionConversations
+from iot_proj.deps import get_doctor, get_patient, lookup_patient
+from iot_proj.doctor_services import (
+    DIRECTORY_MAX_PAGE_SIZE,
+    DIRECTORY_PAGE_SIZE,
+    create_doctor,
+    get_doc_conversation_entries,
+    get_doc_conversation_sync,
+    get_doc_convos,
+    get_doctor as get_doc_login,
+    get_doctor_by_id,
+    get_doctors_by_ids,
+    list_doctors,
+    migrate_qualifications,
+)
 from iot_proj.form_models import (
     CreateConvo,
+    DeliveryAck,
     DoctorLoginFormData,
     DoctorM,
     DoctorRegisterModel,
+    MarkRead,
     PatientLoginFormData,
     PatientM,
     PatientRegisterFormdata,
+    VitalMetric,
+    VitalsBatch,
     WebsocketRelayMessage,
 )
-from iot_proj.models import Conversation, ConversationEntries, SessionDep, create_db_and_tables
+from iot_proj.export import MEDIA_TYPES, ExportFilter, ExportFormat, export
+from iot_proj.http_cache import etag_json
+from iot_proj.log_config import configure_logging, stop_logging
+from iot_proj.message_writer import MessageWriter, PendingEntry, PersistError
+from iot_proj.models import SessionDep, async_engine, async_session, check_pragmas, create_db_and_tables, engine
+from iot_proj.passwords import HashOverloaded, pool as hash_pool
+from iot_proj.search import SEARCH_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, backfill as search_backfill, backfill_pending, create_search_index, search_entries
+from iot_proj.settings import settings
 import logging
 
-from iot_proj.user_services import Error, create_patient, create_u_convos, get_conversation_entries, get_user, get_user_convos
+from iot_proj.user_services import ENTRIES_MAX_PAGE_SIZE, ENTRIES_PAGE_SIZE, Error, create_patient, create_u_convos, get_conversation_entries, get_conversation_sync, get_user, get_user_convos, mark_read
+from iot_proj.vitals import LiveAggregator, VitalsOverloaded, VitalsStore, check_batch, get_vitals_history
 from iot_proj.websoc import ConnectionManager
+from iot_proj.wire import PONG, Protocol, encode_error
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 templates = Jinja2Templates(directory="templates")
+# compiled templates are kept in a per-user temp dir across restarts
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+templates.env.auto_reload = settings.templates_auto_reload
 app = FastAPI()
+static_assets = StaticAssets("static")
+templates.env.globals["asset_url"] = lambda path: app.url_path_for("static", path=static_assets.url(path))
+pages = PageCache(templates)
 ws_connection_manager = ConnectionManager()
+admission = Admission()
+message_writer = MessageWriter()
+vitals_store = VitalsStore()
+live_vitals = LiveAggregator(ws_connection_manager)
+background_tasks: set[asyncio.Task] = set()
+if settings.metrics_enabled:
+    metrics.install(app, [engine, async_engine.sync_engine], ws_connection_manager, message_writer, hash_pool, admission)
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
+    configure_logging()
+    static_assets.load()
     create_db_and_tables()
+    migrate_qualifications()
+    check_pragmas()
+    create_search_index()
+    if backfill_pending():
+        # entries older than the search index, indexed in the background in short transactions
+        task = asyncio.create_task(asyncio.to_thread(search_backfill))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    message_writer.start()
+    vitals_store.start()
+    await ws_connection_manager.start()
+    live_vitals.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    live_vitals.stop()
+    await ws_connection_manager.stop()
+    await vitals_store.stop()
+    await message_writer.stop()
+    hash_pool.shutdown()
+    stop_logging()
+
+
+@app.exception_handler(HashOverloaded)
+def on_hash_overloaded(request: Request, exc: HashOverloaded):
+    return JSONResponse(
+        content={"error": "Too many sign-ins right now, please retry"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(settings.hash_retry_after)},
+    )
+
+
+@app.exception_handler(VitalsOverloaded)
+def on_vitals_overloaded(request: Request, exc: VitalsOverloaded):
+    return JSONResponse(
+        content={"error": "Too many readings waiting to be saved, please retry"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(settings.hash_retry_after)},
+    )
 
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", static_assets, name="static")
 
 
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request):
-    return templates.TemplateResponse(request, name="index.html", context={})
+async def index(request: Request):
+    return pages.response(request, "index.html")
 
 
 @app.get("/register", response_class=HTMLResponse)
-def register_patient(request: Request):
-    return templates.TemplateResponse(
-        request, name="patients/auth/register.html", context={}
-    )
+async def register_patient(request: Request):
+    return pages.response(request, "patients/auth/register.html")
 
 
 @app.post("/register", response_class=RedirectResponse)
-def register_patient_post(
+async def register_patient_post(
     request: Request,
     formdata: Annotated[PatientRegisterFormdata, Form()],
     session: SessionDep,
 ):
-    result = create_patient(formdata, session)
+    result = await create_patient(formdata, session)
     if isinstance(result, Error):
         return templates.TemplateResponse(
             request,
@@ -72,17 +155,17 @@ def register_patient_post(
 
 
 @app.get("/login")
-def patient_login(request: Request):
-    return templates.TemplateResponse(request, name="patients/auth/login.html")
+async def patient_login(request: Request):
+    return pages.response(request, "patients/auth/login.html")
 
 
 @app.post("/login", response_class=RedirectResponse)
-def patient_login_post(
+async def patient_login_post(
     request: Request,
     formdata: Annotated[PatientLoginFormData, Form()],
     session: SessionDep,
 ):
-    result = get_user(formdata, session)
+    result = await get_user(formdata, session)
     if isinstance(result, Error):
         return templates.TemplateResponse(
             request,
@@ -101,7 +184,7 @@ PatientDep = Annotated[PatientM | RedirectResponse, Depends(get_patient)]
 
 
 @app.get("/patient/home", response_class=HTMLResponse)
-def patient_home(request: Request, user: PatientDep):
+async def patient_home(request: Request, user: PatientDep):
     if isinstance(user, RedirectResponse):
         return user
     return templates.TemplateResponse(
@@ -110,17 +193,17 @@ def patient_home(request: Request, user: PatientDep):
 
 
 @app.get("/doctor/register", response_class=HTMLResponse)
-def doctor_register(request: Request):
-    return templates.TemplateResponse(request, name="doctor/auth/register.html")
+async def doctor_register(request: Request):
+    return pages.response(request, "doctor/auth/register.html")
 
 
 @app.post("/doctor/register", response_class=RedirectResponse)
-def doctor_register_post(
+async def doctor_register_post(
     request: Request,
     formdata: Annotated[DoctorRegisterModel, Form()],
     session: SessionDep,
 ):
-    result = create_doctor(formdata, session)
+    result = await create_doctor(formdata, session)
     if isinstance(result, Error):
         return templates.TemplateResponse(
             request,
@@ -138,12 +221,12 @@ DoctorDep = Annotated[DoctorM | RedirectResponse, Depends(get_doctor)]
 
 
 @app.get("/doctor/login", response_class=HTMLResponse)
-def doctor_login(request: Request):
-    return templates.TemplateResponse(request, name="doctor/auth/login.html")
+async def doctor_login(request: Request):
+    return pages.response(request, "doctor/auth/login.html")
 
 @app.post("/doctor/login", response_class=RedirectResponse)
-def doctor_login_post(request: Request, formdata: Annotated[DoctorLoginFormData, Form()], session: SessionDep):
-    result = get_doc_login(formdata, session)
+async def doctor_login_post(request: Request, formdata: Annotated[DoctorLoginFormData, Form()], session: SessionDep):
+    result = await get_doc_login(formdata, session)
     if isinstance(result, Error):
         return templates.TemplateResponse(
             request,
@@ -160,7 +243,7 @@ def doctor_login_post(request: Request, formdata: Annotated[DoctorLoginFormData,
 
 
 @app.get("/doctor/home", response_class=HTMLResponse)
-def doctor_home(request: Request, user: DoctorDep):
+async def doctor_home(request: Request, user: DoctorDep):
     if isinstance(user, RedirectResponse):
         return user
     return templates.TemplateResponse(
@@ -168,54 +251,282 @@ def doctor_home(request: Request, user: DoctorDep):
     )
 
 @app.get("/get/doctor/{id}")
-def get_doc_by_id(id: Annotated[str, Path()], session: SessionDep):
-    doc = get_doctor_by_id(id, session)
+async def get_doc_by_id(id: Annotated[str, Path()], session: SessionDep):
+    doc = await get_doctor_by_id(id, session)
     if isinstance(doc, Error):
         return JSONResponse(content={"error": doc.error}, status_code=status.HTTP_400_BAD_REQUEST)
     return doc.model_dump_json()
 
+# ids looked up at once by /get/doctors
+DOCTORS_MAX_IDS = 100
+
+
+@app.get("/get/doctors")
+async def get_docs_by_ids(request: Request, session: SessionDep, id: Annotated[list[str], Query(min_length=1, max_length=DOCTORS_MAX_IDS)]):
+    doctors = await get_doctors_by_ids(id, session)
+    if isinstance(doctors, Error):
+        return JSONResponse(content={"error": doctors.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, {"doctors": doctors})
+
+@app.get("/doctors")
+async def doctor_directory(
+    request: Request,
+    user: PatientDep,
+    session: SessionDep,
+    name: Annotated[str | None, Query(min_length=1, max_length=100)] = None,
+    qualification: Annotated[str | None, Query(min_length=1, max_length=100)] = None,
+    after: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=DIRECTORY_MAX_PAGE_SIZE)] = DIRECTORY_PAGE_SIZE,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    page = await list_doctors(session, name=name, qualification=qualification, after=after, limit=limit)
+    if isinstance(page, Error):
+        return JSONResponse(content={"error": page.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, page)
+
 @app.get("/patient/conversation")
-def get_convo_pat(user: PatientDep, session: SessionDep):
+async def get_convo_pat(request: Request, user: PatientDep, session: SessionDep):
     if isinstance(user, RedirectResponse):
         return user
-    convos = get_user_convos(user.id, session)
-    return {"conversations": convos}
+    convos = await get_user_convos(user.id, session)
+    return etag_json(request, {"conversations": convos})
 
 @app.get("/doctor/conversation")
-def get_convo_doc(user: DoctorDep, session: SessionDep):
+async def get_convo_doc(request: Request, user: DoctorDep, session: SessionDep):
+    if isinstance(user, RedirectResponse):
+        return user
+    convos = await get_doc_convos(user.id, session)
+    return etag_json(request, {"conversations": convos})
+
+@app.post("/patient/conversation/read")
+async def mark_read_pat(user: PatientDep, session: SessionDep, formdata: Annotated[MarkRead, Form()]):
+    if isinstance(user, RedirectResponse):
+        return user
+    res = await mark_read(user.id, other_id=formdata.id, is_doc=False, last_id=formdata.last_id, session=session)
+    if isinstance(res, Error):
+        return JSONResponse(content={"error": res.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
+
+@app.post("/doctor/conversation/read")
+async def mark_read_doc(user: DoctorDep, session: SessionDep, formdata: Annotated[MarkRead, Form()]):
     if isinstance(user, RedirectResponse):
         return user
-    convos = get_doc_convos(user.id, session)
-    return {"conversations": convos}
+    res = await mark_read(user.id, other_id=formdata.id, is_doc=True, last_id=formdata.last_id, session=session)
+    if isinstance(res, Error):
+        return JSONResponse(content={"error": res.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
 
 @app.post("/patient/conversation")
-def create_convo_pat(user: PatientDep, session: SessionDep, formdata: Annotated[CreateConvo, Form()]):
+async def create_convo_pat(user: PatientDep, session: SessionDep, formdata: Annotated[CreateConvo, Form()]):
     if isinstance(user, RedirectResponse):
         return user
-    create_u_convos(id=user.id, doc_id=formdata.id, session=session)
+    await create_u_convos(id=user.id, doc_id=formdata.id, session=session)
     return Response(content="", status_code=status.HTTP_201_CREATED)
 
 
+PageLimit = Annotated[int, Query(ge=1, le=ENTRIES_MAX_PAGE_SIZE)]
+
+
 @app.get("/patient/conversation/entries")
-def get_convo_entries(user: PatientDep, session: SessionDep, docId: Annotated[str, Query()]):
+async def get_convo_entries(
+    request: Request,
+    user: PatientDep,
+    session: SessionDep,
+    docId: Annotated[str, Query()],
+    before: Annotated[int | None, Query()] = None,
+    after: Annotated[int | None, Query()] = None,
+    limit: PageLimit = ENTRIES_PAGE_SIZE,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    page = await get_conversation_entries(id=user.id, docId=docId, session=session, before=before, after=after, limit=limit)
+    if isinstance(page, Error):
+        return JSONResponse(content={"error": page.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, page)
+
+@app.get("/patient/conversation/sync")
+async def sync_convo_entries(
+    request: Request,
+    user: PatientDep,
+    session: SessionDep,
+    docId: Annotated[str, Query()],
+    since: Annotated[int, Query(ge=0)],
+    limit: PageLimit = ENTRIES_MAX_PAGE_SIZE,
+):
     if isinstance(user, RedirectResponse):
         return user
-    entries = get_conversation_entries(id=user.id, docId=docId, session=session)
-    return {"entries": entries}
+    page = await get_conversation_sync(id=user.id, docId=docId, session=session, since=since, limit=limit)
+    if isinstance(page, Error):
+        return JSONResponse(content={"error": page.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, page)
 
 @app.get("/doctor/conversation/entries")
-def get_doc_convo_entries(user: DoctorDep, session: SessionDep, patId: Annotated[str, Query()]):
+async def get_doc_convo_entries(
+    request: Request,
+    user: DoctorDep,
+    session: SessionDep,
+    patId: Annotated[str, Query()],
+    before: Annotated[int | None, Query()] = None,
+    after: Annotated[int | None, Query()] = None,
+    limit: PageLimit = ENTRIES_PAGE_SIZE,
+):
     if isinstance(user, RedirectResponse):
         return user
-    entries = get_doc_conversation_entries(id=user.id, patId=patId, session=session)
-    return {"entries": entries}
+    page = await get_doc_conversation_entries(id=user.id, patId=patId, session=session, before=before, after=after, limit=limit)
+    if isinstance(page, Error):
+        return JSONResponse(content={"error": page.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, page)
+
+@app.get("/doctor/conversation/sync")
+async def sync_doc_convo_entries(
+    request: Request,
+    user: DoctorDep,
+    session: SessionDep,
+    patId: Annotated[str, Query()],
+    since: Annotated[int, Query(ge=0)],
+    limit: PageLimit = ENTRIES_MAX_PAGE_SIZE,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    page = await get_doc_conversation_sync(id=user.id, patId=patId, session=session, since=since, limit=limit)
+    if isinstance(page, Error):
+        return JSONResponse(content={"error": page.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return etag_json(request, page)
+
+SearchLimit = Annotated[int, Query(ge=1, le=SEARCH_MAX_PAGE_SIZE)]
+
+
+@app.get("/doctor/search")
+async def search_doc(
+    user: DoctorDep, session: SessionDep, q: Annotated[str, Query(min_length=1)], limit: SearchLimit = SEARCH_PAGE_SIZE, offset: Annotated[int, Query(ge=0)] = 0
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    page = await search_entries(user.id, is_doc=True, q=q, session=session, limit=limit, offset=offset)
+    if page is None:
+        return JSONResponse(content={"error": "Nothing to search for"}, status_code=status.HTTP_400_BAD_REQUEST)
+    return page
+
+@app.get("/patient/search")
+async def search_pat(
+    user: PatientDep, session: SessionDep, q: Annotated[str, Query(min_length=1)], limit: SearchLimit = SEARCH_PAGE_SIZE, offset: Annotated[int, Query(ge=0)] = 0
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    page = await search_entries(user.id, is_doc=False, q=q, session=session, limit=limit, offset=offset)
+    if page is None:
+        return JSONResponse(content={"error": "Nothing to search for"}, status_code=status.HTTP_400_BAD_REQUEST)
+    return page
+
+def export_response(filter: ExportFilter, format: ExportFormat) -> StreamingResponse:
+    # the generator reads the database synchronously, starlette iterates it in the threadpool
+    ext = "ndjson.gz" if format is ExportFormat.gzip else "ndjson"
+    return StreamingResponse(
+        export(filter, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="conversations.{ext}"'},
+    )
+
+@app.get("/doctor/export")
+async def export_doc(
+    user: DoctorDep,
+    patId: Annotated[str | None, Query()] = None,
+    since: Annotated[datetime | None, Query()] = None,
+    until: Annotated[datetime | None, Query()] = None,
+    format: Annotated[ExportFormat, Query()] = ExportFormat.ndjson,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    return export_response(ExportFilter(doctor_id=user.id, patient_id=patId, since=since, until=until), format)
+
+@app.get("/patient/export")
+async def export_pat(
+    user: PatientDep,
+    docId: Annotated[str | None, Query()] = None,
+    since: Annotated[datetime | None, Query()] = None,
+    until: Annotated[datetime | None, Query()] = None,
+    format: Annotated[ExportFormat, Query()] = ExportFormat.ndjson,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    return export_response(ExportFilter(doctor_id=docId, patient_id=user.id, since=since, until=until), format)
+
+def ingest_vitals(patient_id: str, batch: VitalsBatch) -> int | Error:
+    """Buffers a batch for storage and the live aggregates, raises VitalsOverloaded when full."""
+    count = check_batch(batch.series)
+    if isinstance(count, Error):
+        return count
+    vitals_store.add(patient_id, batch.series, count)
+    live_vitals.add(patient_id, batch.series)
+    return count
+
+@app.post("/patient/vitals", status_code=status.HTTP_202_ACCEPTED)
+async def post_vitals(user: PatientDep, batch: VitalsBatch):
+    if isinstance(user, RedirectResponse):
+        return user
+    count = ingest_vitals(user.id, batch)
+    if isinstance(count, Error):
+        return JSONResponse(content={"error": count.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return {"accepted": count}
+
+@app.get("/doctor/vitals")
+async def get_doc_vitals(
+    user: DoctorDep,
+    session: SessionDep,
+    patId: Annotated[str, Query()],
+    metric: Annotated[VitalMetric, Query()],
+    since: Annotated[int, Query(ge=0, description="epoch seconds")],
+    until: Annotated[int | None, Query(ge=0, description="epoch seconds, now when omitted")] = None,
+    bucket: Annotated[int, Query(ge=1, description="window in seconds, rounded down to whole store buckets")] = settings.vitals_bucket_seconds,
+):
+    if isinstance(user, RedirectResponse):
+        return user
+    if until is None:
+        until = int(datetime.now().timestamp())
+    history = await get_vitals_history(user.id, patId, metric, since, until, bucket, session)
+    if isinstance(history, Error):
+        return JSONResponse(content={"error": history.error}, status_code=status.HTTP_400_BAD_REQUEST)
+    return history
+
+@app.websocket("/vitals/ws")
+async def vitals_endp(websocket: WebSocket):
+    """Device socket: every text frame is a VitalsBatch, only errors are answered."""
+    pat = websocket.cookies.get("userid")
+    user = None
+    if pat is not None:
+        async with async_session() as session:
+            try:
+                user = await lookup_patient(pat, session)
+            except SQLAlchemyError as e:
+                logger.error("Couldn't fetch user: %s", e)
+    if user is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Unauthenticated")
+    await websocket.accept()
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                batch = VitalsBatch.model_validate_json(data)
+            except ValidationError:
+                await websocket.send_text(encode_error(Protocol.v2_json, "invalid data"))
+                continue
+            try:
+                count = ingest_vitals(user.id, batch)
+            except VitalsOverloaded:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Overloaded")
+                return
+            if isinstance(count, Error):
+                await websocket.send_text(encode_error(Protocol.v2_json, count.error))
+    except WebSocketDisconnect:
+        pass
 
 @app.websocket("/ws")
-async def websoc_endp(websocket: WebSocket, session: SessionDep):
+async def websoc_endp(websocket: WebSocket):
     doc = websocket.cookies.get("docid")
     pat = websocket.cookies.get("userid")
     if doc is None and pat is None:
-        logger.error(f"Connection failed: doc={doc}, patient={pat}")
+        logger.warning("Connection refused, no docid or userid cookie")
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Unauthenticated")
     is_doc = doc is not None
     id: str
@@ -224,28 +535,69 @@ async def websoc_endp(websocket: WebSocket, session: SessionDep):
     elif pat is not None:
         # doing the check just to avoid annoying typechecker haha
         id = pat
-    await ws_connection_manager.connect(websocket, id=id,is_doc=is_doc)
+    last_ack = websocket.query_params.get("last_ack")
+    con = await ws_connection_manager.connect(
+        websocket,
+        id=id,
+        is_doc=is_doc,
+        last_ack=int(last_ack) if last_ack and last_ack.isdigit() else None,
+        acks=websocket.query_params.get("acks") == "1",
+    )
+    convos = ConnectionConversations()
+    bucket, strikes = admission.connection_buckets()
 
     try:
         while True:
             data = await websocket.receive_text()
+            con.touch()
+            if data == PONG:
+                continue
+            if admission.too_big(data):
+                logger.warning("Frame of %d characters from %s, closing", len(data), id)
+                await ws_connection_manager.close(con, status.WS_1009_MESSAGE_TOO_BIG, "Message too big")
+                break
             try:
                 m = WebsocketRelayMessage.model_validate_json(data,strict=True)
-                d_id = id if is_doc else m.recvid
-                p_id = id if not is_doc else m.recvid
-                logger.info(f"is_doc={is_doc}")
-                c = session.exec(select(Conversation).where(Conversation.doctor_id == d_id,Conversation.patient_id == p_id)).one()
-                convEntr = ConversationEntries(from_doctor=is_doc, message=m.msg, conversation_id=c.id)
-                session.add(convEntr)
-                session.commit()
-                session.refresh(convEntr)
-                logger.info(f"Conversation entry saved: {convEntr}")
-                await ws_connection_manager.relay_message(m.msg, senderid=id, recvid=m.recvid)
             except ValidationError:
-                logger.warn(f"Invalid data: {data}")
-                await websocket.send_text("invalid data")
+                m = None
+                try:
+                    # acks come on a client timer and cost no database work, they stay out of the rate limit like pongs
+                    ws_connection_manager.ack(con, DeliveryAck.model_validate_json(data, strict=True).ack)
+                    continue
+                except ValidationError:
+                    pass
+            if not admission.allow(id, bucket):
+                if not admission.strike(strikes):
+                    logger.warning("%s kept sending over its rate limit, closing", id)
+                    await ws_connection_manager.close(con, status.WS_1008_POLICY_VIOLATION, "Rate limit exceeded")
+                    break
+                ws_connection_manager.send(con, encode_error(con.protocol, "rate limited"))
+                continue
+            if m is None:
+                logger.warning("Invalid data from %s: %.200s", id, data)
+                ws_connection_manager.send(con, encode_error(con.protocol, "invalid data"))
+                continue
+            try:
+                async with admission.slot():
+                    d_id = id if is_doc else m.recvid
+                    p_id = id if not is_doc else m.recvid
+                    convo_id = await convos.resolve(d_id, p_id, other_id=m.recvid)
+                    if convo_id is None:
+                        # also covers a patient writing to a patient and ids naming nobody
+                        ws_connection_manager.send(con, encode_error(con.protocol, "No conversation found"))
+                        continue
+                    try:
+                        await message_writer.submit(PendingEntry(doctor_id=d_id, patient_id=p_id, from_doctor=is_doc, message=m.msg, conversation_id=convo_id))
+                    except PersistError as e:
+                        logger.warning("Message from %s not saved: %s", id, e)
+                        ws_connection_manager.send(con, encode_error(con.protocol, "message not saved"))
+                        continue
+                    await ws_connection_manager.relay_message(m.msg, senderid=id, recvid=m.recvid)
+            except ChatOverloaded:
+                logger.warning("No room for a message from %s, closing", id)
+                await ws_connection_manager.close(con, status.WS_1013_TRY_AGAIN_LATER, "Overloaded")
+                break
     except WebSocketDisconnect:
-        await ws_connection_manager.disconnect(id)
-
-
-    
+        await ws_connection_manager.disconnect(id, con)
+    if id not in ws_connection_manager.active_connections:
+        admission.forget(id)
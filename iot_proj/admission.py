@@ -0,0 +1,127 @@
+"""Admission control on the chat socket: frame size, rate limits and messages in flight.
+
+Every frame a client sends goes through, in this order (pongs skip all of
+it, delivery acks everything but the size check):
+
+1. Size: longer than `ws_max_message_size` characters closes the socket with
+   1009 before anything parses it. uvicorn's `--ws-max-size` (16 MiB by
+   default) still bounds what gets read at all.
+2. Rate: a token from the socket's bucket and from its user's, shared by all
+   of the user's sockets on this worker. A frame without one is answered
+   with a "rate limited" error and dropped. Each throttled frame also costs
+   a strike, strikes refill at one a second; a socket out of strikes is
+   closed with 1008.
+3. In flight: a chat message waits up to `ws_admission_timeout` for one of
+   `ws_max_in_flight` slots before being resolved, saved and relayed. The
+   socket is not read meanwhile, so a flooding client is held back by TCP.
+   Without a slot in time it is closed with 1013.
+"""
+import asyncio
+import contextlib
+import time
+
+from iot_proj.settings import settings
+
+
+class ChatOverloaded(Exception):
+    """No in-flight slot freed up in time, the client should come back later."""
+
+
+class TokenBucket:
+    """`rate` tokens a second, up to `burst`; a rate of 0 or less never runs out."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Admission:
+    def __init__(
+        self,
+        max_size: int = settings.ws_max_message_size,
+        rate: float = settings.ws_rate_limit,
+        burst: int = settings.ws_rate_burst,
+        user_rate: float = settings.ws_user_rate_limit,
+        user_burst: int = settings.ws_user_rate_burst,
+        strikes: int = settings.ws_rate_strikes,
+        max_in_flight: int = settings.ws_max_in_flight,
+        timeout: float = settings.ws_admission_timeout,
+    ):
+        self.max_size = max_size
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.strikes = strikes
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._users: dict[str, TokenBucket] = {}
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.throttled = {"connection": 0, "user": 0}
+        # sockets closed, by reason
+        self.closed = {"rate": 0, "size": 0, "overload": 0}
+
+    def connection_buckets(self) -> tuple[TokenBucket, TokenBucket]:
+        """Rate and strike buckets of a new socket."""
+        return TokenBucket(self.rate, self.burst), TokenBucket(1.0, self.strikes)
+
+    def too_big(self, data: str) -> bool:
+        if len(data) <= self.max_size:
+            return False
+        self.closed["size"] += 1
+        return True
+
+    def allow(self, user_id: str, bucket: TokenBucket) -> bool:
+        now = time.monotonic()
+        if not bucket.take(now):
+            self.throttled["connection"] += 1
+            return False
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        if not user.take(now):
+            self.throttled["user"] += 1
+            return False
+        return True
+
+    def strike(self, strikes: TokenBucket) -> bool:
+        """Records a throttled frame, False once the socket is out of strikes."""
+        if strikes.take(time.monotonic()):
+            return True
+        self.closed["rate"] += 1
+        return False
+
+    def forget(self, user_id: str):
+        """Drops the user's bucket once their last socket here is gone."""
+        self._users.pop(user_id, None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Holds one of the in-flight slots, raises ChatOverloaded when none frees up within the timeout."""
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self._slots.acquire()
+        except TimeoutError:
+            self.closed["overload"] += 1
+            raise ChatOverloaded() from None
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
@@ -0,0 +1,204 @@
+"""Static files and request-independent pages served from memory.
+
+Every file under `static/` is read once at startup, hashed and compressed:
+
+- `asset_url("js/common.js")` in a template gives `/static/js/common.<hash>.js`.
+  That URL changes whenever the file does, so it is served with an immutable
+  one-year Cache-Control.
+- The plain name still works, with `no-cache` so browsers revalidate.
+- Each file gets gzip and, when the `brotli` package is installed, brotli
+  variants. The client gets the smallest one its Accept-Encoding allows, with
+  a strong ETag per variant.
+
+`.gz`/`.br` files next to a source file are used instead of compressing at
+startup when they are newer than it. Build them once per deploy with:
+
+    python -m iot_proj.assets static
+
+Changes under `static/` are only picked up on restart.
+"""
+import argparse
+import gzip
+import hashlib
+import mimetypes
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from fastapi import Request, Response, status
+from fastapi.templating import Jinja2Templates
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+FINGERPRINT_LENGTH = 12
+# (encoding, file suffix) in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def accepted_encodings(header: str | None) -> set[str]:
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        key, _, q = params.strip().partition("=")
+        if key.strip() == "q":
+            try:
+                if float(q) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def compress(body: bytes, encoding: str) -> bytes | None:
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body, quality=11)
+    return None
+
+
+@dataclass
+class Variants:
+    """One body in its identity and compressed encodings."""
+
+    body: bytes
+    media_type: str
+    digest: str = ""
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if not self.digest:
+            self.digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+
+    @classmethod
+    def build(cls, body: bytes, media_type: str, source: Path | None = None) -> "Variants":
+        v = cls(body=body, media_type=media_type)
+        if len(body) < MIN_COMPRESS_SIZE:
+            return v
+        for encoding, suffix in ENCODINGS:
+            precompressed = source.with_name(source.name + suffix) if source is not None else None
+            if precompressed is not None and precompressed.is_file() and precompressed.stat().st_mtime >= source.stat().st_mtime:
+                data = precompressed.read_bytes()
+            else:
+                data = compress(body, encoding)
+            # keep a variant only when it actually saves bytes
+            if data is not None and len(data) < len(body):
+                v.encoded[encoding] = data
+        return v
+
+    def respond(self, request: Request, cache_control: str) -> Response:
+        accepted = accepted_encodings(request.headers.get("accept-encoding"))
+        encoding = next((e for e, _ in ENCODINGS if e in self.encoded and e in accepted), None)
+        body = self.encoded[encoding] if encoding else self.body
+        etag = f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if self.encoded:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        inm = request.headers.get("if-none-match")
+        if inm is not None and (inm.strip() == "*" or etag in (t.strip() for t in inm.split(","))):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=body, headers=headers, media_type=self.media_type)
+
+
+def fingerprinted(path: str, digest: str) -> str:
+    stem, dot, ext = path.rpartition(".")
+    if not dot or "/" in ext:
+        return f"{path}.{digest[:FINGERPRINT_LENGTH]}"
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}.{ext}"
+
+
+class StaticAssets:
+    """ASGI app for /static: fingerprinted and plain names, precompressed variants, ETags."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.files: dict[str, Variants] = {}
+        # fingerprinted name -> plain name
+        self.fingerprints: dict[str, str] = {}
+        self.urls: dict[str, str] = {}
+
+    def load(self):
+        files, fingerprints, urls = {}, {}, {}
+        for source in sorted(self.directory.rglob("*")):
+            if not source.is_file() or source.suffix in (".gz", ".br"):
+                continue
+            path = source.relative_to(self.directory).as_posix()
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            v = Variants.build(source.read_bytes(), media_type, source)
+            files[path] = v
+            urls[path] = fingerprinted(path, v.digest)
+            fingerprints[urls[path]] = path
+        self.files, self.fingerprints, self.urls = files, fingerprints, urls
+
+    def url(self, path: str) -> str:
+        """Fingerprinted name of `path`, relative to the mount; the plain one if it is unknown."""
+        if not self.files:
+            self.load()
+        return self.urls.get(path, path)
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, headers={"Allow": "GET, HEAD"})
+        else:
+            if not self.files:
+                self.load()
+            path = scope["path"].removeprefix(scope.get("root_path", "")).lstrip("/")
+            plain = self.fingerprints.get(path)
+            if plain is not None:
+                response = self.files[plain].respond(request, IMMUTABLE)
+            elif path in self.files:
+                response = self.files[path].respond(request, REVALIDATE)
+            else:
+                response = Response("Not Found", status_code=status.HTTP_404_NOT_FOUND, media_type="text/plain")
+        await response(scope, receive, send)
+
+
+class PageCache:
+    """Pages that do not depend on the request, rendered on first use and then served from memory."""
+
+    def __init__(self, templates: Jinja2Templates):
+        self.templates = templates
+        self._pages: dict[str, Variants] = {}
+
+    def response(self, request: Request, name: str) -> Response:
+        page = self._pages.get(name)
+        if page is None:
+            body = self.templates.get_template(name).render().encode()
+            page = self._pages[name] = Variants.build(body, "text/html; charset=utf-8")
+        return page.respond(request, REVALIDATE)
+
+    def clear(self):
+        self._pages.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write .gz and .br variants next to every static file.")
+    parser.add_argument("directory", nargs="?", default="static")
+    args = parser.parse_args()
+    encodings = [(e, suffix) for e, suffix in ENCODINGS if e != "br" or brotli is not None]
+    if len(encodings) < len(ENCODINGS):
+        print("the brotli package is not installed, writing gzip variants only")
+    for source in sorted(Path(args.directory).rglob("*")):
+        if not source.is_file() or source.suffix in (".gz", ".br"):
+            continue
+        body = source.read_bytes()
+        if len(body) < MIN_COMPRESS_SIZE:
+            continue
+        for encoding, suffix in encodings:
+            data = compress(body, encoding)
+            source.with_name(source.name + suffix).write_bytes(data)
+            print(f"{source}{suffix}: {len(body)} -> {len(data)} bytes")
+
+
+if __name__ == "__main__":
+    main()
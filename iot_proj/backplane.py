@@ -0,0 +1,297 @@
+"""Pub/sub backplane carrying relay and presence events between workers.
+
+Every event published is delivered to every subscribed worker, the publisher
+included. `LocalBackplane` does that in process; `UnixSocketBackplane` goes
+through a small broker listening on a Unix socket so several uvicorn workers
+(`fastapi run --workers N`) share presence and can relay to each other.
+
+The broker is started by whichever worker grabs the lock file first, or can
+be run on its own with `python -m iot_proj.backplane`. When a worker's
+connection to it drops, the worker runs the election again and reconnects;
+the broker going away with its worker gets a new one that way. Events
+published meanwhile are dropped.
+
+The broker remembers which worker each connection belongs to and tells the
+others when one goes away, so they forget who was online there.
+"""
+import abc
+import asyncio
+import contextlib
+import fcntl
+import logging
+import os
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable
+
+from pydantic import BaseModel
+
+from iot_proj.settings import BackplaneKind, settings
+
+log = logging.getLogger(__name__)
+
+# relayed frames carry whole chat messages, so allow long lines
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+class EventKind(str, Enum):
+    join = "join"
+    leave = "leave"
+    relay = "relay"
+    # a worker (re)connected, with its connections, and asks the others for theirs
+    sync = "sync"
+    # answer to sync, replaces what presence held for the answering worker
+    state = "state"
+    # live vitals aggregates for the doctor `id`, `msg` is the JSON payload
+    vitals = "vitals"
+    # sent by the broker when the connection of the worker `origin` closed
+    gone = "gone"
+    # delivered only locally, each time the worker (re)connects to the broker
+    connected = "connected"
+
+
+class Event(BaseModel):
+    kind: EventKind
+    # the worker that published it, presence counts a user online while any worker has one of their sockets
+    origin: str | None = None
+    id: str | None = None
+    is_doc: bool | None = None
+    # relayed chat message, encoded by the worker holding the recipient's socket
+    sender: str | None = None
+    msg: str | None = None
+    doctors: list[str] = []
+    patients: list[str] = []
+
+
+Handler = Callable[[Event], Awaitable[None]]
+
+
+class Backplane(abc.ABC):
+    def __init__(self):
+        self.handler: Handler | None = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def stop(self):
+        pass
+
+    @abc.abstractmethod
+    async def publish(self, event: Event):
+        """Sends `event` to every subscribed worker, this one included."""
+
+    async def _deliver(self, event: Event):
+        if self.handler is not None:
+            await self.handler(event)
+
+
+class LocalBackplane(Backplane):
+    """Single process, events go straight back to the subscriber."""
+
+    async def publish(self, event: Event):
+        await self._deliver(event)
+
+
+class UnixSocketBackplane(Backplane):
+    def __init__(self, path: str = settings.backplane_path):
+        super().__init__()
+        self.path = path
+        self.broker: Broker | None = None
+        self._lock_fd: int | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self.reconnects = 0
+        # events published while disconnected
+        self.dropped = 0
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        reader = await self._connect()
+        self._reader_task = asyncio.create_task(self._read(reader))
+
+    async def _connect(self) -> asyncio.StreamReader:
+        """Connects to the broker, first starting one here if no other worker holds the lock."""
+        while True:
+            if self._lock_fd is None:
+                self._lock_fd = try_lock(self.path)
+                if self._lock_fd is not None:
+                    self.broker = Broker(self.path)
+                    await self.broker.start()
+                    log.info("Backplane broker listening on %s", self.path)
+            try:
+                reader, self._writer = await connect_unix(self.path)
+            except TimeoutError:
+                # the worker that won the lock died before listening
+                log.warning("No backplane broker on %s, running the election again", self.path)
+                continue
+            await self._deliver(Event(kind=EventKind.connected))
+            return reader
+
+    async def stop(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self.broker is not None:
+            await self.broker.stop()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+
+    async def publish(self, event: Event):
+        if self._writer is None:
+            self.dropped += 1
+            return
+        try:
+            self._writer.write(event.model_dump_json().encode() + b"\n")
+            await self._writer.drain()
+        except ConnectionError:
+            # the reader notices too and reconnects
+            self.dropped += 1
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                while line := await reader.readline():
+                    try:
+                        await self._deliver(Event.model_validate_json(line))
+                    except Exception as e:
+                        log.error("Failed to handle backplane event: %s", e)
+            except ConnectionError:
+                pass
+            log.warning("Backplane connection lost, reconnecting")
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self.reconnects += 1
+            reader = await self._connect()
+
+
+class BrokerClient:
+    """A worker connected to the broker. Lines to it queue up here and are written by a task of
+    their own, so a worker that stops reading holds up nobody else; once `queue_size` lines are
+    waiting it is disconnected, and resyncs when it reconnects."""
+
+    __slots__ = ("writer", "queue_size", "outbox", "task")
+
+    def __init__(self, writer: asyncio.StreamWriter, queue_size: int):
+        self.writer = writer
+        self.queue_size = queue_size
+        self.outbox: deque[bytes] = deque()
+        # only exists while lines are queued
+        self.task: asyncio.Task | None = None
+
+    def offer(self, line: bytes) -> bool:
+        """Queues a line, False when the queue is full."""
+        if len(self.outbox) >= self.queue_size:
+            return False
+        self.outbox.append(line)
+        if self.task is None:
+            self.task = asyncio.create_task(self._drain())
+        return True
+
+    async def _drain(self):
+        try:
+            while self.outbox:
+                while self.outbox:
+                    self.writer.write(self.outbox.popleft())
+                await self.writer.drain()
+        except ConnectionError:
+            self.outbox.clear()
+        finally:
+            self.task = None
+
+
+class Broker:
+    """Fans every line received from a worker out to all connected workers."""
+
+    def __init__(self, path: str, queue_size: int = settings.backplane_client_queue_size):
+        self.path = path
+        self.queue_size = queue_size
+        self.clients: dict[asyncio.StreamWriter, BrokerClient] = {}
+        self.server: asyncio.Server | None = None
+        self.slow_disconnects = 0
+
+    async def start(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path, limit=LINE_LIMIT)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+        for w in list(self.clients):
+            w.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients[writer] = BrokerClient(writer, self.queue_size)
+        # the worker on the other end, taken from the first event naming it
+        origin: str | None = None
+        try:
+            while line := await reader.readline():
+                if origin is None:
+                    origin = origin_of(line)
+                self._fan_out(line)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+        if origin is not None and self.server is not None and self.server.is_serving():
+            self._fan_out(Event(kind=EventKind.gone, origin=origin).model_dump_json().encode() + b"\n")
+
+    def _fan_out(self, line: bytes):
+        for client in list(self.clients.values()):
+            if not client.offer(line):
+                self.slow_disconnects += 1
+                log.warning("A backplane client is %d lines behind, disconnecting it", len(client.outbox))
+                self.clients.pop(client.writer, None)
+                client.writer.close()
+
+
+def origin_of(line: bytes) -> str | None:
+    try:
+        return Event.model_validate_json(line).origin
+    except ValueError:
+        return None
+
+
+def try_lock(path: str) -> int | None:
+    """Takes the broker lock for `path`, None when another process holds it."""
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+async def connect_unix(path: str, timeout: float = 10) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    # the broker may still be starting in another worker
+    async with asyncio.timeout(timeout):
+        while True:
+            try:
+                return await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+
+
+def create_backplane() -> Backplane:
+    if settings.backplane is BackplaneKind.unix:
+        return UnixSocketBackplane()
+    return LocalBackplane()
+
+
+async def run_broker(path: str = settings.backplane_path):
+    fd = try_lock(path)
+    if fd is None:
+        raise SystemExit(f"A broker already owns {path}")
+    broker = Broker(path)
+    await broker.start()
+    log.info("Backplane broker listening on %s", path)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_broker())
@@ -0,0 +1,109 @@
+"""Maps a (doctor_id, patient_id) pair to its conversation id.
+
+The pair of a conversation never changes, so the chat socket resolves it once
+and every later message on that socket only inserts. `ConversationCache` is
+the process-wide LRU behind that; `ConnectionConversations` is the small
+per-socket map in front of it.
+"""
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlmodel import select
+
+from iot_proj.models import Conversation, async_session
+from iot_proj.settings import settings
+
+Pair = tuple[str, str]
+
+
+class ConversationCache:
+    """LRU map from (doctor_id, patient_id) to conversation id.
+
+    Also filled from the message writer thread, hence the lock. `version` is
+    bumped on every invalidation so per-socket maps know to drop what they hold.
+    """
+
+    def __init__(self, maxsize: int = settings.conversation_cache_size):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Pair, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, doctor_id: str, patient_id: str) -> str | None:
+        with self._lock:
+            convo_id = self._entries.get((doctor_id, patient_id))
+            if convo_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((doctor_id, patient_id))
+            self.hits += 1
+            return convo_id
+
+    def put(self, doctor_id: str, patient_id: str, convo_id: str):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[(doctor_id, patient_id)] = convo_id
+            self._entries.move_to_end((doctor_id, patient_id))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, doctor_id: str, patient_id: str):
+        with self._lock:
+            self._entries.pop((doctor_id, patient_id), None)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+conversation_cache = ConversationCache()
+
+
+@event.listens_for(Conversation, "after_delete")
+def _forget_deleted(mapper, connection, target: Conversation):
+    conversation_cache.invalidate(target.doctor_id, target.patient_id)
+
+
+async def resolve_conversation(doctor_id: str, patient_id: str) -> str | None:
+    """Conversation id of the pair, from the cache or else the database."""
+    convo_id = conversation_cache.get(doctor_id, patient_id)
+    if convo_id is not None:
+        return convo_id
+    async with async_session() as session:
+        convo_id = (
+            await session.exec(select(Conversation.id).where(Conversation.doctor_id == doctor_id, Conversation.patient_id == patient_id))
+        ).first()
+    if convo_id is not None:
+        conversation_cache.put(doctor_id, patient_id, convo_id)
+    return convo_id
+
+
+class ConnectionConversations:
+    """Per-socket view of `conversation_cache`, keyed by the other party's id."""
+
+    def __init__(self, cache: ConversationCache = conversation_cache):
+        self.cache = cache
+        self.version = cache.version
+        self._ids: dict[str, str] = {}
+
+    async def resolve(self, doctor_id: str, patient_id: str, other_id: str) -> str | None:
+        if self.version != self.cache.version:
+            self._ids.clear()
+            self.version = self.cache.version
+        convo_id = self._ids.get(other_id)
+        if convo_id is None:
+            convo_id = await resolve_conversation(doctor_id, patient_id)
+            if convo_id is not None:
+                self._ids[other_id] = convo_id
+        return convo_id
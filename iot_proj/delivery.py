@@ -0,0 +1,140 @@
+"""Relayed chat messages kept until their recipient acks them.
+
+Every relayed message gets an id (`mid`) that only grows for a given
+recipient, so a client acks cumulatively with the highest id it processed.
+Ids come from the clock, which keeps them growing across restarts and
+workers without any shared state.
+
+A user's devices share one queue, each with its own ack position. Messages
+are only dropped once every connected device acked them, and a device that
+went away holds back what it had not acked for `delivery_resume_window`
+seconds, so it can resume from its `last_ack` instead of reloading history.
+
+Only conversation partners get messages relayed, so only they get queues.
+There are at most `offline_queue_recipients` of those, the least recently
+written to is dropped first, and a queue nothing was pushed to for
+`offline_queue_ttl` seconds is dropped too.
+"""
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+from iot_proj.settings import settings
+
+# parked positions are swept for expired ones whenever their recipients reach this many (then twice what is left)
+PARKED_SWEEP_MIN = 1024
+
+
+@dataclass
+class QueuedMessage:
+    mid: int
+    sender_id: str
+    msg: str
+
+
+class DeliveryQueues:
+    """Bounded queue of unacked messages per recipient, oldest dropped first on overflow."""
+
+    def __init__(
+        self,
+        maxsize: int = settings.offline_queue_size,
+        resume_window: float = settings.delivery_resume_window,
+        max_recipients: int = settings.offline_queue_recipients,
+        ttl: float = settings.offline_queue_ttl,
+    ):
+        self.maxsize = maxsize
+        self.resume_window = resume_window
+        self.max_recipients = max_recipients
+        self.ttl = ttl
+        # least recently pushed to first
+        self._queues: OrderedDict[str, deque[QueuedMessage]] = OrderedDict()
+        self._pushed_at: dict[str, float] = {}
+        # ack positions of devices that disconnected, recipient -> [(expiry, mid)]
+        self._parked: dict[str, list[tuple[float, int]]] = {}
+        self._sweep_at = PARKED_SWEEP_MIN
+        self._last_mid = 0
+        self.dropped = 0
+        # queues dropped whole, past the ttl or the recipient cap
+        self.evicted = 0
+
+    def next_mid(self) -> int:
+        self._last_mid = max(self._last_mid + 1, time.time_ns() // 1000)
+        return self._last_mid
+
+    def push(self, recipient: str, sender_id: str, msg: str) -> QueuedMessage:
+        item = QueuedMessage(mid=self.next_mid(), sender_id=sender_id, msg=msg)
+        if self.maxsize <= 0:
+            return item
+        now = time.monotonic()
+        q = self._queues.get(recipient)
+        if q is None:
+            q = self._queues[recipient] = deque(maxlen=self.maxsize)
+        else:
+            self._queues.move_to_end(recipient)
+            if len(q) == self.maxsize:
+                self.dropped += 1
+        q.append(item)
+        self._pushed_at[recipient] = now
+        self._evict(now)
+        return item
+
+    def _evict(self, now: float):
+        while self._queues:
+            oldest = next(iter(self._queues))
+            if len(self._queues) <= self.max_recipients and self._pushed_at[oldest] + self.ttl > now:
+                return
+            self.dropped += len(self._queues[oldest])
+            self.evicted += 1
+            self._parked.pop(oldest, None)
+            self._drop(oldest)
+
+    def _drop(self, recipient: str) -> deque[QueuedMessage]:
+        self._pushed_at.pop(recipient, None)
+        return self._queues.pop(recipient, deque())
+
+    def ack(self, recipient: str, mid: int):
+        """Forgets every message of `recipient` up to and including `mid`, short of what parked devices still need."""
+        q = self._queues.get(recipient)
+        if q is None:
+            return
+        parked = self._live_parked(recipient)
+        if parked:
+            mid = min(mid, *(m for _, m in parked))
+        while q and q[0].mid <= mid:
+            q.popleft()
+        if not q:
+            self._drop(recipient)
+
+    def park(self, recipient: str, mid: int):
+        """Keeps what a disconnected device has not acked (past `mid`) for it to resume."""
+        if self.resume_window <= 0:
+            return
+        if len(self._parked) >= self._sweep_at:
+            for r in list(self._parked):
+                self._live_parked(r)
+            self._sweep_at = max(PARKED_SWEEP_MIN, 2 * len(self._parked))
+        self._parked.setdefault(recipient, []).append((time.monotonic() + self.resume_window, mid))
+
+    def _live_parked(self, recipient: str) -> list[tuple[float, int]]:
+        parked = self._parked.get(recipient)
+        if not parked:
+            return []
+        now = time.monotonic()
+        parked[:] = [p for p in parked if p[0] > now]
+        if not parked:
+            del self._parked[recipient]
+        return parked
+
+    def pending(self, recipient: str, after: int = 0) -> list[QueuedMessage]:
+        return [item for item in self._queues.get(recipient, ()) if item.mid > after]
+
+    def take(self, recipient: str) -> list[QueuedMessage]:
+        """Removes and returns everything queued for `recipient`."""
+        self._parked.pop(recipient, None)
+        return list(self._drop(recipient))
+
+    def __contains__(self, recipient: str) -> bool:
+        return recipient in self._queues
+
+    def stats(self) -> dict[str, int]:
+        return {"recipients": len(self._queues), "messages": sum(map(len, self._queues.values())), "dropped": self.dropped, "evicted": self.evicted}
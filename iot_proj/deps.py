@@ -5,44 +5,64 @@ from fastapi import Cookie, Request
 from fastapi.responses import RedirectResponse
 from sqlalchemy.exc import SQLAlchemyError
 from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from iot_proj.doctor_services import str_to_qualifications
+from iot_proj.doctor_services import doctor_qualifications
 from iot_proj.form_models import DoctorM, PatientM
+from iot_proj.identity_cache import doctor_cache, patient_cache
 from iot_proj.models import Doctor, Patient, SessionDep
 
 
-def get_patient(request: Request, session: SessionDep,  userid: Annotated[str | None, Cookie()] = None) -> PatientM | RedirectResponse:
-    if userid is None:
-        return RedirectResponse(request.url_for("patient_login"))
+async def lookup_patient(userid: str, session: AsyncSession) -> PatientM | None:
+    """Patient named by a userid cookie, None when it names nobody. May raise SQLAlchemyError."""
+    cached = patient_cache.get(userid)
+    if cached is not None:
+        return cached
     try:
         uuid.UUID(userid, version=4)
     except ValueError:
+        return None
+    patient = (await session.exec(select(Patient).where(Patient.id == userid))).one_or_none()
+    if patient is None:
+        return None
+    user = PatientM(name=patient.name, email=patient.email, id=patient.id)
+    patient_cache.put(userid, user)
+    return user
+
+
+async def get_patient(request: Request, session: SessionDep,  userid: Annotated[str | None, Cookie()] = None) -> PatientM | RedirectResponse:
+    if userid is None:
         return RedirectResponse(request.url_for("patient_login"))
     try:
-        patient = session.exec(select(Patient).where(Patient.id == userid)).one_or_none()
-        if patient is None:
-            return RedirectResponse(request.url_for("patient_login"))
-        return PatientM(name=patient.name, email=patient.email, id=patient.id)
+        user = await lookup_patient(userid, session)
     except SQLAlchemyError as e:
         from iot_proj import logger as log
-        log.error(f"Couldn't fetch user: {e}")
+        log.error("Couldn't fetch user: %s", e)
+        return RedirectResponse(request.url_for("patient_login"))
+    if user is None:
         return RedirectResponse(request.url_for("patient_login"))
+    return user
 
 
 
-def get_doctor(request: Request, session: SessionDep,  docid: Annotated[str | None, Cookie()] = None) -> DoctorM | RedirectResponse:
+async def get_doctor(request: Request, session: SessionDep,  docid: Annotated[str | None, Cookie()] = None) -> DoctorM | RedirectResponse:
     if docid is None:
         return RedirectResponse(request.url_for("doctor_login"))
+    cached = doctor_cache.get(docid)
+    if cached is not None:
+        return cached
     try:
         uuid.UUID(docid, version=4)
     except ValueError:
         return RedirectResponse(request.url_for("doctor_login"))
     try:
-        doctor = session.exec(select(Doctor).where(Doctor.id == docid)).one_or_none()
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == docid))).one_or_none()
         if doctor is None:
             return RedirectResponse(request.url_for("doctor_login"))
-        return DoctorM(name=doctor.name, email=doctor.email, id=doctor.id, qualifications=str_to_qualifications(doctor.qualifications))
+        user = DoctorM(name=doctor.name, email=doctor.email, id=doctor.id, qualifications=await doctor_qualifications(doctor.id, session))
+        doctor_cache.put(docid, user)
+        return user
     except SQLAlchemyError as e:
         from iot_proj import logger as log
-        log.error(f"Couldn't fetch user: {e}")
+        log.error("Couldn't fetch user: %s", e)
         return RedirectResponse(request.url_for("doctor_login"))
@@ -1,79 +1,199 @@
 import logging
-from functools import reduce
 
+from sqlalchemy import func, insert, tuple_, update
 from sqlalchemy.exc import SQLAlchemyError
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from iot_proj.form_models import DoctorLoginFormData, DoctorM, DoctorRegisterModel, Conversation, ConvEntry
-from iot_proj.models import Doctor, Conversation as ConvoT
-from iot_proj.user_services import Error, conv_to_ConvEnt, hash_pwd, pwdmatch
+from iot_proj.conversation_cache import resolve_conversation
+from iot_proj.form_models import DoctorCard, DoctorDirectoryPage, DoctorLoginFormData, DoctorM, DoctorRegisterModel, Conversation, EntriesPage
+from iot_proj.models import Doctor, DoctorQualification, Conversation as ConvoT, engine
+from iot_proj.passwords import hash_pwd, verify_and_update
+from iot_proj.user_services import ENTRIES_MAX_PAGE_SIZE, ENTRIES_PAGE_SIZE, Error, get_entries_page, get_entries_since, list_conversations
 
 log = logging.getLogger(__name__)
-def __qualifications_to_str(qualis: list[str]) -> str:
-    return reduce(lambda a,b: a + "," + b, qualis, "")
+
+DIRECTORY_PAGE_SIZE = 20
+DIRECTORY_MAX_PAGE_SIZE = 100
+# group_concat separator, not something a qualification contains
+QUALIFICATION_SEP = "\x1f"
+
 
 def str_to_qualifications(qualis: str) -> list[str]:
+    """Parses the legacy comma-joined column, which starts with a comma."""
     q = qualis.split(',')
     q = filter(lambda a: len(a.strip()) != 0, q)
     return list(q)
 
-def create_doctor(formdata: DoctorRegisterModel, session: Session) -> Doctor | Error:
-    hash = hash_pwd(formdata.mdp)
-    doctor = Doctor(name=formdata.name, email=formdata.email, password=hash, qualifications=__qualifications_to_str(formdata.qualifications))
+def clean_qualifications(qualis: list[str]) -> list[str]:
+    return sorted({q.strip() for q in qualis if q.strip()})
+
+def name_key(prefix: str) -> str:
+    """What `lower(name)` gives in SQLite, which only folds ASCII letters."""
+    return "".join(c.lower() if c.isascii() else c for c in prefix)
+
+def prefix_upper_bound(prefix: str) -> str | None:
+    """Smallest string above every string starting with `prefix`, None when there is none to build."""
+    # every string starting with `prefix` sorts between it and its last character bumped by one;
+    # U+10FFFF can't be bumped, so it is dropped and the one before it is bumped instead
+    stripped = prefix.rstrip(chr(0x10FFFF))
+    if not stripped:
+        return None
+    bumped = ord(stripped[-1]) + 1
+    if 0xD800 <= bumped <= 0xDFFF:
+        # surrogates can't be encoded for SQLite, which compares UTF-8 bytes in code point order anyway
+        bumped = 0xE000
+    return stripped[:-1] + chr(bumped)
+
+def _cards(rows) -> list[DoctorCard]:
+    return [DoctorCard(id=id, name=name, qualifications=sorted(quals.split(QUALIFICATION_SEP)) if quals else []) for id, name, quals in rows]
+
+
+def migrate_qualifications() -> int:
+    """Moves doctors' legacy comma-joined qualifications into DoctorQualification, returns how many doctors moved."""
+    with engine.begin() as conn:
+        legacy = conn.execute(select(Doctor.id, Doctor.qualifications).where(Doctor.qualifications != "")).all()
+        rows = [{"doctor_id": id, "qualification": q} for id, quals in legacy for q in clean_qualifications(str_to_qualifications(quals))]
+        if rows:
+            # another worker may be running the same migration
+            conn.execute(insert(DoctorQualification).prefix_with("OR IGNORE"), rows)
+        if legacy:
+            conn.execute(update(Doctor).where(Doctor.qualifications != "").values(qualifications=""))
+    if legacy:
+        log.info("Moved the qualifications of %d doctors to their own table", len(legacy))
+    return len(legacy)
+
+async def doctor_qualifications(doctor_id: str, session: AsyncSession) -> list[str]:
+    """May raise SQLAlchemyError."""
+    return list((await session.exec(
+        select(DoctorQualification.qualification).where(DoctorQualification.doctor_id == doctor_id).order_by(DoctorQualification.qualification)
+    )).all())
+
+async def create_doctor(formdata: DoctorRegisterModel, session: AsyncSession) -> Doctor | Error:
+    hash = await hash_pwd(formdata.mdp)
+    doctor = Doctor(name=formdata.name, email=formdata.email, password=hash)
     try:
         session.add(doctor)
-        session.commit()
-        session.refresh(doctor)
+        await session.flush()
+        session.add_all(DoctorQualification(doctor_id=doctor.id, qualification=q) for q in clean_qualifications(formdata.qualifications))
+        await session.commit()
+        await session.refresh(doctor)
     except SQLAlchemyError as e:
-        log.error(f"Failed to insert user: Cause: {e}")
+        log.error("Failed to insert user: Cause: %s", e)
         return Error(f"Error adding user, {e._message}")
     return doctor
 
-def get_doctor(formdata: DoctorLoginFormData, session: Session):
+async def get_doctor(formdata: DoctorLoginFormData, session: AsyncSession):
     try:
-        res = session.exec(select(Doctor).where(Doctor.email == formdata.email)).one_or_none()
+        res = (await session.exec(select(Doctor).where(Doctor.email == formdata.email))).one_or_none()
         if res is None:
             return Error("No entry found")
-        pwd_match = pwdmatch(formdata.mdp, res.password)
+        pwd_match, new_hash = await verify_and_update(formdata.mdp, res.password)
         if not pwd_match:
             return Error("Wrong credentials")
-        return DoctorM(id=res.id, name=res.name, email=res.email, qualifications=str_to_qualifications(res.qualifications))
+        user = DoctorM(id=res.id, name=res.name, email=res.email, qualifications=await doctor_qualifications(res.id, session))
+        if new_hash is not None:
+            res.password = new_hash
+            session.add(res)
+            await session.commit()
+        return user
     except SQLAlchemyError as e:
-        log.error(f"Failed to get user: Cause: {e}")
+        log.error("Failed to get user: Cause: %s", e)
         return Error(f"Error getting user, {e._message}")
         
 
 
-def get_doctor_by_id(id: str, session: Session) -> DoctorM | Error:
+async def get_doctor_by_id(id: str, session: AsyncSession) -> DoctorM | Error:
     try:
-        res = session.exec(select(Doctor).where(Doctor.id == id)).one_or_none()
+        res = (await session.exec(select(Doctor).where(Doctor.id == id))).one_or_none()
         if res is None:
             return Error("No entry found")
-        return DoctorM(id=res.id, name=res.name, email=res.email, qualifications=str_to_qualifications(res.qualifications))
+        return DoctorM(id=res.id, name=res.name, email=res.email, qualifications=await doctor_qualifications(res.id, session))
     except SQLAlchemyError as e:
-        log.error(f"Failed to get user: Cause: {e}")
+        log.error("Failed to get user: Cause: %s", e)
         return Error(f"Error getting user, {e._message}")
 
 
-def get_doc_convos(id: str, session: Session) -> list[Conversation | None] | Error:
+async def get_doctors_by_ids(ids: list[str], session: AsyncSession) -> list[DoctorCard] | Error:
+    """Cards of the doctors among `ids`, in one query; unknown ids are left out."""
     try:
-        res = session.exec(select(ConvoT).where(ConvoT.doctor_id == id)).all()
-        convos = list(map(map_d_convo, res))
-        return convos
+        Q = DoctorQualification
+        rows = (await session.exec(
+            select(Doctor.id, Doctor.name, func.group_concat(Q.qualification, QUALIFICATION_SEP))
+            .outerjoin(Q, Q.doctor_id == Doctor.id)
+            .where(Doctor.id.in_(set(ids)))
+            .group_by(Doctor.id)
+        )).all()
+        return _cards(rows)
     except SQLAlchemyError as e:
-        log.error(f"Failed to get user: Cause: {e}")
-        return Error(f"Error getting user, {e._message}")
+        log.error("Failed to get doctors: Cause: %s", e)
+        return Error(f"Error getting doctors, {e._message}")
 
 
-def map_d_convo(conv: ConvoT) -> Conversation | None:
-    if conv.patient is None:
-        return None
-    return Conversation(name=conv.patient.name, id=conv.patient_id)
+async def list_doctors(
+    session: AsyncSession, name: str | None = None, qualification: str | None = None, after: str | None = None, limit: int = DIRECTORY_PAGE_SIZE
+) -> DoctorDirectoryPage | Error:
+    """Doctors ordered by name, optionally whose name starts with `name` (ASCII case-insensitive) or who hold `qualification`.
 
+    Pages are keyed by the last doctor id of the previous one (`after`),
+    the query walks ix_doctor_name_key from there.
+    """
+    try:
+        key = func.lower(Doctor.name)
+        page = select(Doctor.id, Doctor.name)
+        if name:
+            prefix = name_key(name)
+            upper = prefix_upper_bound(prefix)
+            if upper is None:
+                page = page.where(key >= prefix, func.substr(key, 1, len(prefix)) == prefix)
+            else:
+                page = page.where(key >= prefix, key < upper)
+        if qualification:
+            page = page.where(Doctor.id.in_(select(DoctorQualification.doctor_id).where(DoctorQualification.qualification == qualification)))
+        if after:
+            cursor = (await session.exec(select(func.lower(Doctor.name)).where(Doctor.id == after))).one_or_none()
+            if cursor is None:
+                return Error("Unknown cursor")
+            page = page.where(tuple_(key, Doctor.id) > tuple_(cursor, after))
+        page = page.order_by(key, Doctor.id).limit(limit + 1).subquery()
+        Q = DoctorQualification
+        rows = (await session.exec(
+            select(page.c.id, page.c.name, func.group_concat(Q.qualification, QUALIFICATION_SEP))
+            .outerjoin(Q, Q.doctor_id == page.c.id)
+            .group_by(page.c.id)
+            .order_by(func.lower(page.c.name), page.c.id)
+        )).all()
+        return DoctorDirectoryPage(doctors=_cards(rows[:limit]), has_more=len(rows) > limit)
+    except SQLAlchemyError as e:
+        log.error("Failed to list doctors: Cause: %s", e)
+        return Error(f"Error listing doctors, {e._message}")
+
+
+async def get_doc_convos(id: str, session: AsyncSession) -> list[Conversation] | Error:
+    try:
+        return await list_conversations(id, is_doc=True, session=session)
+    except SQLAlchemyError as e:
+        log.error("Failed to get user: Cause: %s", e)
+        return Error(f"Error getting user, {e._message}")
 
 
-def get_doc_conversation_entries(id: str, patId: str, session: Session) -> list[ConvEntry | None]:
-        res = session.exec(select(ConvoT).where(ConvoT.patient_id == patId, ConvoT.doctor_id == id)).one()
-        conversations = res.conversations
-        log.info(f"Conversation entries count: {len(conversations)}")
-        return list(map(conv_to_ConvEnt, conversations))
+async def get_doc_conversation_entries(id: str, patId: str, session: AsyncSession, before: int | None = None, after: int | None = None, limit: int = ENTRIES_PAGE_SIZE) -> EntriesPage | Error:
+    try:
+        convo_id = (await session.exec(select(ConvoT.id).where(ConvoT.patient_id == patId, ConvoT.doctor_id == id))).first()
+        if convo_id is None:
+            return Error("No conversation found")
+        return await get_entries_page(convo_id, session, before=before, after=after, limit=limit)
+    except SQLAlchemyError as e:
+        log.error("Failed to get conversation entries: Cause: %s", e)
+        return Error(f"Error getting conversation entries, {e._message}")
+
+
+async def get_doc_conversation_sync(id: str, patId: str, session: AsyncSession, since: int, limit: int = ENTRIES_MAX_PAGE_SIZE) -> EntriesPage | Error:
+    try:
+        convo_id = await resolve_conversation(id, patId)
+        if convo_id is None:
+            return Error("No conversation found")
+        return await get_entries_since(convo_id, session, since=since, limit=limit)
+    except SQLAlchemyError as e:
+        log.error("Failed to sync conversation entries: Cause: %s", e)
+        return Error(f"Error syncing conversation entries, {e._message}")
@@ -0,0 +1,110 @@
+"""Streaming export of conversation entries as NDJSON, optionally gzipped.
+
+Rows are read through a server-side cursor in `batch_size` chunks and turned
+into output as they come, so memory stays flat whatever the history size.
+Used by the `/doctor/export` and `/patient/export` routes and on its own:
+
+    python -m iot_proj.export --doctor <id> --since 2024-01-01 --gzip -o export.ndjson.gz
+"""
+import argparse
+import json
+import sys
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from enum import Enum
+from typing import Iterable, Iterator
+
+from sqlmodel import select
+
+from iot_proj.models import Conversation, ConversationEntries, engine
+from iot_proj.settings import settings
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    gzip = "gzip"
+
+
+MEDIA_TYPES = {ExportFormat.ndjson: "application/x-ndjson", ExportFormat.gzip: "application/gzip"}
+
+
+@dataclass
+class ExportFilter:
+    doctor_id: str | None = None
+    patient_id: str | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+
+
+def iter_entries(filter: ExportFilter, batch_size: int = settings.export_batch_size) -> Iterator[dict]:
+    """Entries matching `filter` in id order, with the doctor and patient of their conversation."""
+    E = ConversationEntries
+    q = select(E.id, E.time, E.from_doctor, E.message, E.conversation_id, Conversation.doctor_id, Conversation.patient_id).join(
+        Conversation, Conversation.id == E.conversation_id
+    )
+    if filter.doctor_id is not None:
+        q = q.where(Conversation.doctor_id == filter.doctor_id)
+    if filter.patient_id is not None:
+        q = q.where(Conversation.patient_id == filter.patient_id)
+    if filter.since is not None:
+        q = q.where(E.time >= filter.since)
+    if filter.until is not None:
+        q = q.where(E.time < filter.until)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(q.order_by(E.id))
+        for partition in result.partitions():
+            for row in partition:
+                yield row._asdict()
+
+
+def ndjson_lines(rows: Iterable[dict], batch_size: int = settings.export_batch_size) -> Iterator[bytes]:
+    """One chunk of NDJSON per `batch_size` rows."""
+    chunk: list[str] = []
+    for row in rows:
+        chunk.append(json.dumps(row, default=datetime.isoformat, ensure_ascii=False))
+        if len(chunk) >= batch_size:
+            yield ("\n".join(chunk) + "\n").encode()
+            chunk.clear()
+    if chunk:
+        yield ("\n".join(chunk) + "\n").encode()
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compresses a byte stream into a gzip member incrementally."""
+    z = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def export(filter: ExportFilter, format: ExportFormat = ExportFormat.ndjson, batch_size: int = settings.export_batch_size) -> Iterator[bytes]:
+    chunks = ndjson_lines(iter_entries(filter, batch_size), batch_size)
+    return gzip_chunks(chunks) if format is ExportFormat.gzip else chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export conversation entries as NDJSON.")
+    parser.add_argument("--doctor", help="only conversations of this doctor id")
+    parser.add_argument("--patient", help="only conversations of this patient id")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="entries at or after this ISO time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="entries before this ISO time")
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("--batch-size", type=int, default=settings.export_batch_size)
+    parser.add_argument("-o", "--output", help="file to write, stdout when omitted")
+    args = parser.parse_args()
+    filter = ExportFilter(doctor_id=args.doctor, patient_id=args.patient, since=args.since, until=args.until)
+    format = ExportFormat.gzip if args.gzip else ExportFormat.ndjson
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in export(filter, format, args.batch_size):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from enum import Enum
 from typing import Self
 from pydantic import BaseModel, model_validator
 from datetime import datetime
@@ -9,12 +10,38 @@ class ConvEntry(BaseModel):
     message: str
     conversation_id: str
 
+class SearchHit(BaseModel):
+    entry_id: int
+    conversation_id: str
+    time: datetime
+    from_doctor: bool
+    # the other party of the conversation
+    other_id: str
+    other_name: str
+    # html escaped, matches wrapped in <mark>
+    snippet: str
+
+class SearchPage(BaseModel):
+    hits: list[SearchHit]
+    has_more: bool
+
+class EntriesPage(BaseModel):
+    entries: list[ConvEntry | None]
+    has_more: bool
+
 class CreateConvo(BaseModel):
     id: str
 
 class Conversation(BaseModel):
     name: str
     id: str
+    last_message: str | None = None
+    last_time: datetime | None = None
+    unread: int = 0
+
+class MarkRead(BaseModel):
+    id: str
+    last_id: int
 
 
 class PatientRegisterFormdata(BaseModel):
@@ -39,6 +66,17 @@ class DoctorM(PatientM):
     qualifications: list[str]
 
 
+class DoctorCard(BaseModel):
+    """What the directory shows of a doctor."""
+    id: str
+    name: str
+    qualifications: list[str]
+
+class DoctorDirectoryPage(BaseModel):
+    doctors: list[DoctorCard]
+    has_more: bool
+
+
 class PatientLoginFormData(BaseModel):
     email: str
     mdp: str
@@ -55,3 +93,44 @@ class DoctorRegisterModel(PatientRegisterFormdata):
 class WebsocketRelayMessage(BaseModel):
     msg: str
     recvid: str
+
+class DeliveryAck(BaseModel):
+    ack: int
+
+
+class VitalMetric(str, Enum):
+    heart_rate = "heart_rate"
+    spo2 = "spo2"
+    temperature = "temperature"
+
+
+class VitalSeries(BaseModel):
+    """Readings of one metric, column wise: `t` in epoch milliseconds, `v` the values."""
+
+    metric: VitalMetric
+    t: list[int]
+    v: list[float]
+
+    @model_validator(mode="after")
+    def check_lengths_match(self) -> Self:
+        assert len(self.t) == len(self.v), "t and v must have the same length"
+        return self
+
+
+class VitalsBatch(BaseModel):
+    series: list[VitalSeries]
+
+
+class VitalsWindow(BaseModel):
+    # epoch seconds
+    start: int
+    count: int
+    min: float
+    max: float
+    avg: float
+
+
+class VitalsHistory(BaseModel):
+    metric: VitalMetric
+    bucket: int
+    windows: list[VitalsWindow]
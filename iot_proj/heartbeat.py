@@ -0,0 +1,137 @@
+"""Server-driven ping/pong on the chat socket, with a timing wheel that reaps dead peers.
+
+A half-open TCP connection (a phone that lost signal) never makes
+`receive_text` raise, so without this its `WebSockCon` would stay registered
+and keep getting frames forever.
+
+Each connection records when it last sent anything (`last_seen`, a plain float
+store per frame). The heartbeat keeps every connection in one slot of a hashed
+timing wheel, the slot of the tick it is next due. A tick only visits the
+connections of its own slot:
+
+- something arrived since it was scheduled: put back in the slot `interval`
+  after that frame;
+- silent for `interval`: pinged, and due again `timeout` later;
+- still silent after a ping: handed to `on_dead`.
+
+Nothing is moved when frames arrive, so busy connections cost one visit per
+interval and expiring is proportional to the connections actually due.
+"""
+import asyncio
+import math
+import time
+from typing import Callable, Hashable, Protocol
+
+from iot_proj.settings import settings
+
+
+class Beating(Protocol):
+    """What the heartbeat needs from a connection."""
+
+    last_seen: float
+    # when the unanswered ping went out, 0.0 when there is none
+    pinged_at: float
+    # slot of the wheel holding the connection, -1 when it is not in the wheel
+    slot: int
+
+
+class TimingWheel:
+    """Fixed ring of `tick`-wide slots; adding, removing and expiring an entry are O(1)."""
+
+    def __init__(self, tick: float, horizon: float):
+        self.tick = tick
+        # one spare slot so a delay of `horizon` never lands on the slot being expired
+        self.slots: list[set] = [set() for _ in range(math.ceil(horizon / tick) + 2)]
+        self.now = 0
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self.slots)
+
+    def add(self, item: Hashable, delay: float) -> int:
+        """Files `item` under the tick `delay` seconds from now (at least the next one), returns its slot."""
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        slot = (self.now + ticks) % len(self.slots)
+        self.slots[slot].add(item)
+        return slot
+
+    def remove(self, item: Hashable, slot: int):
+        self.slots[slot].discard(item)
+
+    def advance(self) -> set:
+        """Moves one tick forward and returns what was due on it."""
+        self.now += 1
+        i = self.now % len(self.slots)
+        due, self.slots[i] = self.slots[i], set()
+        return due
+
+
+class Heartbeat:
+    def __init__(
+        self,
+        on_ping: Callable[[Beating], None],
+        on_dead: Callable[[Beating], None],
+        interval: float = settings.ws_ping_interval,
+        timeout: float = settings.ws_ping_timeout,
+        tick: float = settings.ws_reaper_tick,
+    ):
+        self.on_ping = on_ping
+        self.on_dead = on_dead
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimingWheel(tick, max(interval, timeout))
+        self.pings = 0
+        self.reaped = 0
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, con: Beating):
+        con.last_seen = time.monotonic()
+        con.pinged_at = 0.0
+        if self.enabled:
+            con.slot = self.wheel.add(con, self.interval)
+
+    def remove(self, con: Beating):
+        if con.slot >= 0:
+            self.wheel.remove(con, con.slot)
+            con.slot = -1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tick = self.wheel.tick
+        while True:
+            # catch up on ticks missed while the loop was busy
+            due = int((loop.time() - started) / tick)
+            while self.wheel.now < due:
+                self.expire()
+            await asyncio.sleep(started + (self.wheel.now + 1) * tick - loop.time())
+
+    def expire(self):
+        now = time.monotonic()
+        for con in self.wheel.advance():
+            con.slot = -1
+            if con.pinged_at and con.last_seen >= con.pinged_at:
+                con.pinged_at = 0.0
+            idle = now - con.last_seen
+            if idle < self.interval:
+                con.slot = self.wheel.add(con, self.interval - idle)
+            elif not con.pinged_at:
+                con.pinged_at = now
+                self.pings += 1
+                self.on_ping(con)
+                con.slot = self.wheel.add(con, self.timeout)
+            else:
+                self.reaped += 1
+                self.on_dead(con)
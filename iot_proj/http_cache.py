@@ -0,0 +1,33 @@
+"""Conditional GET for JSON endpoints.
+
+The body is serialized once, hashed into a weak ETag and dropped in favor of
+an empty 304 when the client already holds it. `no-cache` makes browsers
+revalidate every time, so `fetch` transparently reuses its copy on a 304.
+"""
+import hashlib
+import json
+
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+
+CACHE_CONTROL = "private, no-cache"
+
+
+def etag_for(body: bytes) -> str:
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    return header.strip() == "*" or etag in (t.strip() for t in header.split(","))
+
+
+def etag_json(request: Request, content) -> Response:
+    body = json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+    etag = etag_for(body)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if if_none_match(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+from typing import Generic, TypeVar
+
+from iot_proj.form_models import DoctorM, PatientM
+from iot_proj.settings import settings
+
+T = TypeVar("T")
+
+
+class IdentityCache(Generic[T]):
+    """TTL + LRU map from a cookie id to the user it authenticates.
+
+    Only touched by the async dependencies on the event loop, so it needs no lock.
+    """
+
+    def __init__(self, maxsize: int = settings.identity_cache_size, ttl: float = settings.identity_cache_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> T | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: T):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+patient_cache: IdentityCache[PatientM] = IdentityCache()
+doctor_cache: IdentityCache[DoctorM] = IdentityCache()
@@ -0,0 +1,128 @@
+"""Logging set up once at startup: JSON lines written by a background thread.
+
+Callers only hand records to a queue. Formatting and the stderr write happen
+on the listener thread, so a log call on the event loop never blocks on I/O.
+Messages use %-style arguments, so a record dropped by a level, a filter or
+the rate limit is never formatted at all.
+
+Two filters run before a record is queued:
+
+- Rate limit: a token bucket per message template. A record that gets
+  through after others were suppressed carries their `suppressed` count.
+- Sampling: records logged with `extra=SAMPLED` (per-message events) are
+  kept with probability `log_sample_rate`.
+"""
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from iot_proj.settings import LogFormat, settings
+
+# pass as `extra=` on per-message events so they are sampled
+SAMPLED = {"sampled": True}
+# LogRecord attributes, anything else on a record came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener: QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                out[key] = value
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per (logger, message template): `rate` records a second, bursts up to `burst`."""
+
+    def __init__(self, rate: float = settings.log_rate_limit, burst: int = settings.log_rate_burst, max_keys: int = 10_000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, last refill, records suppressed since the last one let through]
+        self._buckets: dict[tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate: float = settings.log_sample_rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queues the record as is; the stock `prepare` formats it on the calling thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(level: str = settings.log_level, format: LogFormat = settings.log_format):
+    """Routes the root logger through the queue, replacing whatever handlers it had."""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if format is LogFormat.json else logging.Formatter(TEXT_FORMAT))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(SampleFilter())
+    handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Writes out whatever is still queued and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlmodel import Session
+
+from iot_proj import metrics
+from iot_proj.models import ConversationEntries, engine
+from iot_proj.settings import Delivery, settings
+
+log = logging.getLogger(__name__)
+
+
+class PersistError(Exception):
+    pass
+
+
+@dataclass
+class PendingEntry:
+    doctor_id: str
+    patient_id: str
+    from_doctor: bool
+    message: str
+    # resolved by the socket, which refuses messages outside a conversation
+    conversation_id: str
+    time: datetime = field(default_factory=datetime.now)
+    done: asyncio.Future | None = None
+
+
+class MessageWriter:
+    """Write-behind queue draining chat messages into ConversationEntries.
+
+    Entries are committed in bulk transactions on a worker thread so the event
+    loop never waits on SQLite. The queue is bounded: once full, `submit` waits,
+    which pushes back on the sockets producing the messages.
+    """
+
+    def __init__(
+        self,
+        delivery: Delivery = settings.delivery,
+        queue_size: int = settings.writer_queue_size,
+        batch_size: int = settings.writer_batch_size,
+        flush_interval: float = settings.writer_flush_interval,
+        retries: int = settings.writer_retries,
+        retry_backoff: float = settings.writer_retry_backoff,
+    ):
+        self.delivery = delivery
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.queue: asyncio.Queue[PendingEntry | None] = asyncio.Queue(maxsize=queue_size)
+        self.written = 0
+        self.failed = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes everything still queued, then stops the writer."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+        while not self.queue.empty():
+            await self._flush(self._drain_nowait([]))
+
+    async def submit(self, entry: PendingEntry):
+        """Queues `entry`. With durable delivery, returns once it is committed.
+
+        Raises PersistError if a durable entry could not be saved.
+        """
+        if self.delivery is Delivery.durable:
+            entry.done = asyncio.get_running_loop().create_future()
+        await self.queue.put(entry)
+        if entry.done is not None:
+            await entry.done
+
+    def _drain_nowait(self, batch: list[PendingEntry]) -> list[PendingEntry]:
+        while len(batch) < self.batch_size:
+            try:
+                entry = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if entry is not None:
+                batch.append(entry)
+        return batch
+
+    async def _run(self):
+        # a None entry is the stop signal
+        while True:
+            batch: list[PendingEntry] = []
+            entry = await self.queue.get()
+            closing = entry is None
+            if entry is not None:
+                batch.append(entry)
+                try:
+                    # give a burst a moment to fill up the batch
+                    async with asyncio.timeout(self.flush_interval):
+                        while len(batch) < self.batch_size:
+                            entry = await self.queue.get()
+                            if entry is None:
+                                closing = True
+                                break
+                            batch.append(entry)
+                except TimeoutError:
+                    pass
+            await self._flush(batch)
+            if closing:
+                return
+
+    async def _flush(self, batch: list[PendingEntry]):
+        if not batch:
+            return
+        errors = await self._write(batch)
+        self.failed += len(errors)
+        self.written += len(batch) - len(errors)
+        if metrics.enabled:
+            now = datetime.now()
+            for p in batch:
+                metrics.persist_lag.observe((now - p.time).total_seconds())
+        for p in batch:
+            if p.done is None or p.done.done():
+                continue
+            err = errors.get(id(p))
+            if err is None:
+                p.done.set_result(None)
+            else:
+                p.done.set_exception(err)
+
+    async def _write(self, batch: list[PendingEntry]) -> dict[int, PersistError]:
+        """Writes a batch, returns the errors keyed by entry identity.
+
+        With write-behind delivery the entries were relayed already, so a failed
+        transaction (a busy database, say) is retried with backoff, then the
+        entries are written one each so a bad one only loses itself.
+        """
+        delay = self.retry_backoff
+        for attempt in range(1, self.retries + 2):
+            try:
+                await asyncio.to_thread(write_entries, batch)
+                return {}
+            except Exception as e:
+                log.warning("Failed to persist %d conversation entries (attempt %d): Cause: %s", len(batch), attempt, e)
+            if attempt <= self.retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        log.error("Giving up on persisting %d conversation entries together, writing them one by one", len(batch))
+        return await asyncio.to_thread(write_entries_each, batch)
+
+
+def write_entries(batch: list[PendingEntry]):
+    """Inserts a batch in one transaction."""
+    with Session(engine) as session:
+        session.add_all(
+            ConversationEntries(from_doctor=p.from_doctor, message=p.message, time=p.time, conversation_id=p.conversation_id) for p in batch
+        )
+        session.commit()
+
+
+def write_entries_each(batch: list[PendingEntry]) -> dict[int, PersistError]:
+    errors: dict[int, PersistError] = {}
+    for p in batch:
+        try:
+            write_entries([p])
+        except Exception as e:
+            log.error("Failed to persist a message from conversation %s, dropping it: Cause: %s", p.conversation_id, e)
+            errors[id(p)] = PersistError(str(e))
+    return errors
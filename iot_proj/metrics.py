@@ -0,0 +1,259 @@
+"""Request, database, socket and hashing metrics in the Prometheus text format.
+
+Off unless `IOT_METRICS_ENABLED` is set. When off, no middleware or engine
+listener is installed and `/metrics` does not exist; the hot paths only test
+`enabled` or bump a plain integer. Every uvicorn worker keeps its own registry,
+so with several workers each scrape sees whichever one answered.
+"""
+import abc
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Iterable
+
+from fastapi import FastAPI, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from iot_proj.identity_cache import doctor_cache, patient_cache
+from iot_proj.settings import settings
+
+enabled = settings.metrics_enabled
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Labels, values: Labels) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.lines()
+
+    @abc.abstractmethod
+    def lines(self) -> Iterable[str]:
+        """Sample lines, without the HELP and TYPE header."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def lines(self) -> Iterable[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # per label set: count of each bucket (not cumulative, the last one is +Inf), sum
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    def lines(self) -> Iterable[str]:
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = bound if isinstance(bound, str) else _number(float(bound))
+                yield f"{self.name}_bucket{_labels((*self.labelnames, 'le'), (*labels, le))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Callback(Metric):
+    """Gauge or counter whose values are read from the app at scrape time."""
+
+    def __init__(self, name: str, help: str, read: Callable[[], dict[Labels, float] | float], labelnames: Labels = (), type: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.read = read
+
+    def lines(self) -> Iterable[str]:
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def add(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics.values() for line in m.render()) + "\n"
+
+
+registry = Registry()
+http_latency = registry.add(Histogram("iot_http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route")))
+http_requests = registry.add(Counter("iot_http_requests_total", "HTTP responses by route template and status.", ("method", "route", "status")))
+http_db_queries = registry.add(Histogram("iot_http_request_db_queries", "SQL statements run while serving one request.", ("route",), COUNT_BUCKETS))
+http_db_seconds = registry.add(Histogram("iot_http_request_db_seconds", "Time spent in SQL while serving one request.", ("route",)))
+db_queries = registry.add(Counter("iot_db_queries_total", "SQL statements run, requests and background work alike."))
+db_seconds = registry.add(Histogram("iot_db_query_duration_seconds", "Duration of single SQL statements."))
+hash_seconds = registry.add(Histogram("iot_password_hash_duration_seconds", "PBKDF2 time on the hash pool, queueing included.", ("op",)))
+persist_lag = registry.add(Histogram("iot_writer_persist_lag_seconds", "Time from a chat message arriving to its entry being committed."))
+
+# (statement count, seconds in SQL) of the request being served, None outside requests
+_request_db: contextvars.ContextVar[list | None] = contextvars.ContextVar("request_db", default=None)
+
+
+def _route(scope) -> str:
+    """Route template rather than the raw path, which would give a series per id."""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # mounts like /static leave their prefix there
+    return scope.get("root_path") or "unmatched"
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, BaseHTTPMiddleware would add a task and a stream per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        db = [0, 0.0]
+        token = _request_db.set(db)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_db.reset(token)
+            route = _route(scope)
+            http_latency.observe(elapsed, (scope["method"], route))
+            http_requests.inc((scope["method"], route, str(status)))
+            http_db_queries.observe(db[0], (route,))
+            http_db_seconds.observe(db[1], (route,))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    db_queries.inc()
+    db_seconds.observe(elapsed)
+    db = _request_db.get()
+    if db is not None:
+        db[0] += 1
+        db[1] += elapsed
+
+
+def _handle_error(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: Engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def install(app: FastAPI, engines: list[Engine], manager, writer, hash_pool, admission):
+    """Wires everything up and adds the /metrics route; only called when metrics are enabled."""
+    app.add_middleware(MetricsMiddleware)
+    for engine in engines:
+        instrument_engine(engine)
+    role = lambda: {("doctor",): sum(map(len, manager.doctors.values())), ("patient",): sum(map(len, manager.patients.values()))}
+    identity_caches = {"doctor": doctor_cache, "patient": patient_cache}
+    identity_lookups = lambda: {
+        **{(k, "hit"): c.hits for k, c in identity_caches.items()},
+        **{(k, "miss"): c.misses for k, c in identity_caches.items()},
+    }
+    for metric in (
+        Callback("iot_ws_connections", "Open chat sockets on this worker by role.", role, ("role",)),
+        Callback("iot_ws_send_queue_depth", "Frames waiting in all send queues.", lambda: manager.metrics()["send_queue_depth_total"]),
+        Callback("iot_ws_send_queue_depth_max", "Frames waiting in the fullest send queue.", lambda: manager.metrics()["send_queue_depth_max"]),
+        Callback("iot_ws_messages_relayed_total", "Chat messages handed to a local socket.", lambda: manager.relayed, type="counter"),
+        Callback("iot_ws_dropped_frames_total", "Frames dropped on full send queues.", lambda: manager.dropped_frames, type="counter"),
+        Callback("iot_ws_slow_disconnects_total", "Sockets closed for not keeping up.", lambda: manager.slow_disconnects, type="counter"),
+        Callback("iot_ws_pings_total", "Heartbeat pings sent to silent sockets.", lambda: manager.heartbeat.pings, type="counter"),
+        Callback("iot_ws_reaped_total", "Sockets closed for not answering a ping.", lambda: manager.heartbeat.reaped, type="counter"),
+        Callback("iot_ws_throttled_frames_total", "Frames dropped by a socket or user rate limit.", lambda: {(k,): v for k, v in admission.throttled.items()}, ("scope",), type="counter"),
+        Callback("iot_ws_admission_closes_total", "Sockets closed by admission control.", lambda: {(k,): v for k, v in admission.closed.items()}, ("reason",), type="counter"),
+        Callback("iot_ws_messages_in_flight", "Chat messages being resolved, saved and relayed.", lambda: admission.in_flight),
+        Callback("iot_ws_pending_messages", "Relayed messages waiting for an ack or a reconnect.", lambda: manager.deliveries.stats()["messages"]),
+        Callback("iot_ws_pending_evicted_total", "Pending message queues dropped for going idle or past the recipient cap.", lambda: manager.deliveries.evicted, type="counter"),
+        Callback("iot_writer_queue_depth", "Chat messages waiting to be persisted.", lambda: writer.queue.qsize()),
+        Callback("iot_writer_written_total", "Chat entries committed.", lambda: writer.written, type="counter"),
+        Callback("iot_writer_failed_total", "Chat entries that could not be saved.", lambda: writer.failed, type="counter"),
+        Callback("iot_identity_cache_lookups_total", "Cookie lookups answered by the identity cache (hit) or the database (miss).", identity_lookups, ("cache", "result"), type="counter"),
+        Callback("iot_identity_cache_size", "Users held by the identity cache.", lambda: {(k,): c.stats()["size"] for k, c in identity_caches.items()}, ("cache",)),
+        Callback("iot_identity_cache_evictions_total", "Users pushed out of a full identity cache.", lambda: {(k,): c.evictions for k, c in identity_caches.items()}, ("cache",), type="counter"),
+        Callback("iot_password_hash_pending", "Hashes running or queued on the pool.", lambda: hash_pool.pending),
+        Callback("iot_password_hash_rejected_total", "Sign-ins turned away with 503.", lambda: hash_pool.rejected, type="counter"),
+    ):
+        registry.add(metric)
+
+    async def metrics():
+        return Response(registry.render(), media_type=CONTENT_TYPE)
+
+    app.add_api_route("/metrics", metrics, include_in_schema=False)
@@ -1,10 +1,19 @@
+import fcntl
+import logging
 import uuid
 from typing import Annotated, Optional
 
 from fastapi import Depends
-from sqlmodel import Field, Relationship, Session, SQLModel, create_engine
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import Field, Index, Relationship, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import datetime
 
+from iot_proj.settings import DbProfile, settings
+
+log = logging.getLogger(__name__)
 
 def create_uuid() -> str:
     return f"{uuid.uuid4()}"
@@ -17,14 +26,28 @@ class Patient(SQLModel, table=True):
     conversations: list["Conversation"] = Relationship(back_populates="patient")
 
 class Doctor(SQLModel, table=True):
+    # the directory's name prefix search and its ordering
+    __table_args__ = (Index("ix_doctor_name_key", text("lower(name)"), "id"),)
+
     id: str = Field(default_factory=create_uuid, primary_key=True)
     email: str = Field(index=True, unique=True)
     password: str
     name: str
-    qualifications: str
+    # legacy comma-joined list, moved to DoctorQualification at startup and left empty
+    qualifications: str = ""
     conversations: list["Conversation"] = Relationship(back_populates="doctor")
 
+class DoctorQualification(SQLModel, table=True):
+    """One qualification of a doctor, the directory looks doctors up by qualification first."""
+
+    __table_args__ = (Index("ix_doctorqualification_qualification_doctor", "qualification", "doctor_id"),)
+
+    doctor_id: str = Field(foreign_key="doctor.id", primary_key=True)
+    qualification: str = Field(primary_key=True)
+
 class Conversation(SQLModel, table=True):
+    __table_args__ = (Index("ix_conversation_doctor_patient", "doctor_id", "patient_id"),)
+
     id: str = Field(default_factory=create_uuid, primary_key=True)
     doctor_id: str = Field(foreign_key="doctor.id", primary_key=True)
     patient_id: str = Field(foreign_key="patient.id", primary_key=True)
@@ -33,6 +56,12 @@ class Conversation(SQLModel, table=True):
     conversations: list["ConversationEntries"] = Relationship(back_populates="conversation")
 
 class ConversationEntries(SQLModel, table=True):
+    # keyset pagination walks (time, id) inside a single conversation, sync walks ids past a high-water mark
+    __table_args__ = (
+        Index("ix_conversationentries_conv_time_id", "conversation_id", "time", "id"),
+        Index("ix_conversationentries_conv_id", "conversation_id", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     time: datetime = Field(default_factory=datetime.now)
     from_doctor: bool
@@ -40,20 +69,112 @@ class ConversationEntries(SQLModel, table=True):
     conversation_id: str = Field(foreign_key="conversation.id")
     conversation: Conversation = Relationship(back_populates="conversations")
 
-db_file = "db.sqlite3"
+class ConversationRead(SQLModel, table=True):
+    """How far one side of a conversation has read, used for unread counts."""
+
+    conversation_id: str = Field(foreign_key="conversation.id", primary_key=True)
+    is_doctor: bool = Field(primary_key=True)
+    last_read_id: int
+    last_read_time: datetime
+
+class VitalsChunk(SQLModel, table=True):
+    """Readings of one patient and metric inside one time bucket, as packed arrays.
+
+    A bucket may hold several chunks, one per flush; the aggregates let windows
+    of whole buckets be computed without unpacking samples.
+    """
+
+    __table_args__ = (Index("ix_vitalschunk_patient_metric_bucket", "patient_id", "metric", "bucket_start"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    patient_id: str = Field(foreign_key="patient.id")
+    metric: str
+    # epoch seconds, a multiple of settings.vitals_bucket_seconds
+    bucket_start: int
+    count: int
+    min: float
+    max: float
+    sum: float
+    # uint32 millisecond offsets from bucket_start and float32 values, native byte order
+    offsets: bytes
+    values: bytes
+
+db_file = settings.db_path
 db_url = f"sqlite:///{db_file}"
+async_db_url = f"sqlite+aiosqlite:///{db_file}"
 
+pool_args = {
+    "pool_size": settings.db_pool_size,
+    "max_overflow": settings.db_max_overflow,
+    "pool_timeout": settings.db_pool_timeout,
+}
 connect_args = {"check_same_thread": False}
-engine = create_engine(db_url, connect_args=connect_args)
+# the sync engine is left to schema creation and the background message writer
+engine = create_engine(db_url, connect_args=connect_args, **pool_args)
+# aiosqlite would default to NullPool, reopening the file for every session
+async_engine = create_async_engine(async_db_url, poolclass=AsyncAdaptedQueuePool, **pool_args)
+async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+SYNCHRONOUS_LEVELS = {"OFF": 0, "NORMAL": 1, "FULL": 2, "EXTRA": 3}
+
+
+def sqlite_pragmas(profile: DbProfile = settings.db_profile) -> dict[str, str | int]:
+    if profile is DbProfile.default:
+        return {"busy_timeout": settings.db_busy_timeout}
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": settings.db_mmap_size,
+        "cache_size": settings.db_cache_size,
+        "busy_timeout": settings.db_busy_timeout,
+    }
+
+
+def apply_pragmas(dbapi_connection, pragmas: dict[str, str | int]):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+@event.listens_for(engine, "connect")
+@event.listens_for(async_engine.sync_engine, "connect")
+def on_connect(dbapi_connection, connection_record):
+    apply_pragmas(dbapi_connection, sqlite_pragmas())
+
+
+def check_pragmas() -> dict[str, str | int]:
+    """Reads the pragmas back from a pooled connection and warns about any that didn't stick."""
+    expected = sqlite_pragmas()
+    names = ["journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout"]
+    with engine.connect() as conn:
+        active = {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in names}
+    for name, value in expected.items():
+        want = SYNCHRONOUS_LEVELS.get(str(value), value) if name == "synchronous" else value
+        if str(active[name]).lower() != str(want).lower():
+            log.warning("SQLite pragma %s is %s, expected %s", name, active[name], value)
+    log.info("SQLite %s profile on %s: %s", settings.db_profile.value, db_file, active)
+    return active
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # every worker runs this at startup, only one may create the schema at a time
+    with open(f"{db_file}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        SQLModel.metadata.create_all(engine)
+        # create_all only builds indexes alongside new tables, so add them to existing databases too;
+        # looked up by name since reflection skips expression indexes
+        with engine.connect() as conn:
+            existing = set(conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(engine)
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with async_session() as session:
         yield session
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, TypeVar
+
+from passlib.hash import pbkdf2_sha256
+
+from iot_proj import metrics
+from iot_proj.settings import settings
+
+log = logging.getLogger(__name__)
+T = TypeVar("T")
+
+hasher = pbkdf2_sha256.using(rounds=settings.pbkdf2_rounds)
+
+
+class HashOverloaded(Exception):
+    """Too many hashes are already waiting on the pool, the caller should retry later."""
+
+
+def _hash(pwd: str) -> str:
+    return hasher.hash(pwd)
+
+
+def _verify_and_update(pwd: str, hash: str) -> tuple[bool, str | None]:
+    if not hasher.verify(pwd, hash):
+        return False, None
+    if hasher.needs_update(hash):
+        return True, hasher.hash(pwd)
+    return True, None
+
+
+class HashPool:
+    """Runs PBKDF2 in worker processes so it never holds the event loop or its GIL.
+
+    At most `max_pending` hashes may wait on the pool at once, further
+    callers get HashOverloaded right away instead of queueing up.
+    """
+
+    def __init__(self, workers: int = settings.hash_workers, max_pending: int = settings.hash_max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashOverloaded()
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return await asyncio.to_thread(fn, *args)
+            return await asyncio.wrap_future(self._get_executor().submit(fn, *args))
+        finally:
+            self.pending -= 1
+            if metrics.enabled:
+                metrics.hash_seconds.observe(time.perf_counter() - started, (fn.__name__.lstrip("_"),))
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+pool = HashPool()
+
+
+async def hash_pwd(pwd: str) -> str:
+    return await pool.run(_hash, pwd)
+
+
+async def verify_and_update(pwd: str, hash: str) -> tuple[bool, str | None]:
+    """Checks `pwd`, also returns a fresh hash when `hash` uses outdated parameters."""
+    return await pool.run(_verify_and_update, pwd, hash)
@@ -0,0 +1,205 @@
+"""Full-text search over chat messages with an SQLite FTS5 index.
+
+`conversationentries_fts` is an external-content FTS5 table: it stores only
+the index and reads text back from `ConversationEntries` through a view, and
+triggers keep it in step with inserts, updates and deletes. Besides the
+message it indexes a `scope` column, the conversation id squeezed into one
+token, so a search is narrowed to the caller's conversations inside the index
+instead of ranking every match in the database first.
+
+Entries that existed before the index are added by `backfill`, in batches,
+which the app starts in the background and which can also be run on its own:
+
+    python -m iot_proj.search backfill
+    python -m iot_proj.search rebuild
+"""
+import argparse
+import contextlib
+import html
+import logging
+import re
+import sqlite3
+from typing import Iterator
+
+from sqlalchemy import column, func, literal_column, table
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from iot_proj.form_models import SearchHit, SearchPage
+from iot_proj.models import Conversation, ConversationEntries, Doctor, Patient, engine
+from iot_proj.settings import settings
+
+log = logging.getLogger(__name__)
+
+FTS_TABLE = "conversationentries_fts"
+# last entry id the backfill has to cover and how far it got
+BACKFILL_TABLE = "conversationentries_fts_backfill"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SNIPPET_TOKENS = 12
+# snippet() markers, swapped for <mark> once the text is escaped
+HL_START, HL_END = "\x02", "\x03"
+
+CONTENT_VIEW = f"{FTS_TABLE}_content"
+SCHEMA = [
+    f"""CREATE VIEW {CONTENT_VIEW} AS
+        SELECT id, message, replace(conversation_id, '-', '') AS scope FROM conversationentries""",
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        message, scope, content='{CONTENT_VIEW}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON conversationentries BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, message, scope) VALUES (new.id, new.message, replace(new.conversation_id, '-', ''));
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON conversationentries BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message, scope) VALUES ('delete', old.id, old.message, replace(old.conversation_id, '-', ''));
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF message, conversation_id ON conversationentries BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message, scope) VALUES ('delete', old.id, old.message, replace(old.conversation_id, '-', ''));
+        INSERT INTO {FTS_TABLE}(rowid, message, scope) VALUES (new.id, new.message, replace(new.conversation_id, '-', ''));
+    END""",
+]
+
+fts = table(FTS_TABLE, column("rowid"), column(FTS_TABLE))
+
+
+@contextlib.contextmanager
+def _raw() -> Iterator[sqlite3.Cursor]:
+    """Cursor on a pooled connection with manual transactions, the backfill needs BEGIN IMMEDIATE."""
+    conn = engine.raw_connection()
+    driver = conn.driver_connection
+    level = driver.isolation_level
+    driver.isolation_level = None
+    try:
+        yield driver.cursor()
+    except BaseException:
+        if driver.in_transaction:
+            driver.execute("ROLLBACK")
+        raise
+    finally:
+        # the connection goes back to the pool, where pysqlite's implicit transactions are expected
+        driver.isolation_level = level
+        conn.close()
+
+
+def create_search_index():
+    """Creates the index and its triggers once; entries already there are left to `backfill`."""
+    with _raw() as cur:
+        cur.execute("BEGIN IMMEDIATE")
+        exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone()
+        if exists is None:
+            cur.execute(f"CREATE TABLE {BACKFILL_TABLE} (target INTEGER NOT NULL, done INTEGER NOT NULL)")
+            # rows up to here predate the triggers
+            target = cur.execute("SELECT coalesce(max(id), 0) FROM conversationentries").fetchone()[0]
+            cur.execute(f"INSERT INTO {BACKFILL_TABLE} VALUES (?, 0)", (target,))
+            for statement in SCHEMA:
+                cur.execute(statement)
+            log.info("Created the search index, %d existing entries left to backfill", target)
+        cur.execute("COMMIT")
+
+
+def backfill_pending() -> bool:
+    with _raw() as cur:
+        row = cur.execute(f"SELECT target, done FROM {BACKFILL_TABLE}").fetchone()
+    return row is not None and row[1] < row[0]
+
+
+def backfill(batch_size: int = settings.search_backfill_batch_size) -> int:
+    """Indexes the entries older than the index, one short write transaction per batch.
+
+    Progress is committed with each batch, so several workers or an interrupted
+    run never index a row twice. Returns how many entries were indexed.
+    """
+    indexed = 0
+    with _raw() as cur:
+        while True:
+            cur.execute("BEGIN IMMEDIATE")
+            target, done = cur.execute(f"SELECT target, done FROM {BACKFILL_TABLE}").fetchone()
+            if done >= target:
+                cur.execute("COMMIT")
+                break
+            upto = min(done + batch_size, target)
+            cur.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, message, scope) SELECT id, message, scope FROM {CONTENT_VIEW} WHERE id > ? AND id <= ?",
+                (done, upto),
+            )
+            indexed += cur.rowcount
+            cur.execute(f"UPDATE {BACKFILL_TABLE} SET done = ?", (upto,))
+            cur.execute("COMMIT")
+    if indexed:
+        log.info("Search backfill indexed %d entries", indexed)
+    return indexed
+
+
+def rebuild():
+    """Reindexes everything from ConversationEntries, for when the index is suspected stale."""
+    with _raw() as cur:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cur.execute(f"UPDATE {BACKFILL_TABLE} SET done = target")
+        cur.execute("COMMIT")
+
+
+def to_match_query(q: str) -> str | None:
+    """Turns free text into an FTS5 query: every word required, the last one as a prefix."""
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    return " ".join(f'"{w}"' for w in words[:-1]) + f' "{words[-1]}"*'
+
+
+def scoped(match: str, convo_ids: list[str]) -> str:
+    return f"message : ({match}) AND scope : ({' OR '.join(c.replace('-', '') for c in convo_ids)})"
+
+
+def highlight(snippet: str) -> str:
+    return html.escape(snippet).replace(HL_START, "<mark>").replace(HL_END, "</mark>")
+
+
+async def search_entries(id: str, is_doc: bool, q: str, session: AsyncSession, limit: int = SEARCH_PAGE_SIZE, offset: int = 0) -> SearchPage | None:
+    """Best matches first among the conversations of `id`, None when `q` has nothing to search for."""
+    match = to_match_query(q)
+    if match is None:
+        return None
+    E = ConversationEntries
+    other = Patient if is_doc else Doctor
+    other_id = Conversation.patient_id if is_doc else Conversation.doctor_id
+    own_id = Conversation.doctor_id if is_doc else Conversation.patient_id
+    convo_ids = list((await session.exec(select(Conversation.id).where(own_id == id))).all())
+    if not convo_ids:
+        return SearchPage(hits=[], has_more=False)
+    # the scope column only narrows, it takes no part in the ranking
+    rank = func.bm25(literal_column(FTS_TABLE), 1.0, 0.0).label("rank")
+    snippet = func.snippet(literal_column(FTS_TABLE), 0, HL_START, HL_END, "…", SNIPPET_TOKENS)
+    stmt = (
+        select(E.id, E.conversation_id, E.time, E.from_doctor, other_id, other.name, snippet, rank)
+        .select_from(fts)
+        .join(E, E.id == fts.c.rowid)
+        .join(Conversation, Conversation.id == E.conversation_id)
+        .join(other, other.id == other_id)
+        .where(literal_column(FTS_TABLE).op("MATCH")(scoped(match, convo_ids)), own_id == id)
+        .order_by(rank, E.id.desc())
+        .limit(limit + 1)
+        .offset(offset)
+    )
+    rows = (await session.exec(stmt)).all()
+    hits = [
+        SearchHit(entry_id=eid, conversation_id=cid, time=time, from_doctor=fd, other_id=oid, other_name=name, snippet=highlight(snip))
+        for eid, cid, time, fd, oid, name, snip, _ in rows[:limit]
+    ]
+    return SearchPage(hits=hits, has_more=len(rows) > limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the message search index.")
+    parser.add_argument("command", choices=["backfill", "rebuild"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    create_search_index()
+    if args.command == "backfill":
+        print(f"indexed {backfill()} entries")
+    else:
+        rebuild()
+
+
+if __name__ == "__main__":
+    main()
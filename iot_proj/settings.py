@@ -0,0 +1,146 @@
+import os
+from dataclasses import dataclass, fields
+from enum import Enum
+
+
+class Delivery(str, Enum):
+    # relay right away, entries are persisted by the background writer
+    write_behind = "write_behind"
+    # relay only once the entry is committed
+    durable = "durable"
+
+
+class SlowConsumerPolicy(str, Enum):
+    # drop frames that don't fit in the connection's send queue
+    drop = "drop"
+    # close the connection once its send queue overflows
+    disconnect = "disconnect"
+
+
+class BackplaneKind(str, Enum):
+    # relay and presence stay inside this process
+    local = "local"
+    # workers share relay and presence through a Unix socket broker
+    unix = "unix"
+
+
+class DbProfile(str, Enum):
+    # WAL journal, relaxed fsync, large page cache and mmap
+    production = "production"
+    # SQLite's own defaults (rollback journal, synchronous=FULL)
+    default = "default"
+
+
+class LogFormat(str, Enum):
+    # one JSON object per line
+    json = "json"
+    # plain lines for reading in a terminal
+    text = "text"
+
+
+def _cast(tp, raw: str):
+    if tp is bool:
+        return raw.strip().lower() in ("1", "true", "yes", "on")
+    return tp(raw)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Runtime knobs, each one can be overridden with an `IOT_<NAME>` env variable."""
+
+    delivery: Delivery = Delivery.write_behind
+    writer_queue_size: int = 10_000
+    writer_batch_size: int = 500
+    writer_flush_interval: float = 0.05
+    # a batch that fails is tried again this many times, waiting twice as long each time, then entry by entry
+    writer_retries: int = 3
+    writer_retry_backoff: float = 0.1
+    send_queue_size: int = 1024
+    slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.drop
+    # joins and leaves within this window go out as one presence frame (0 sends each one right away)
+    presence_batch_interval: float = 0.05
+    # a chat socket silent for this long gets a ping (0 turns the heartbeat off)
+    ws_ping_interval: float = 25.0
+    # and is closed when nothing comes back within this long
+    ws_ping_timeout: float = 20.0
+    # resolution of the reaper's timing wheel
+    ws_reaper_tick: float = 1.0
+    # frames a chat socket may send a second, and at once (0 turns the limit off)
+    ws_rate_limit: float = 10.0
+    ws_rate_burst: int = 30
+    # the same for all sockets of one user on a worker
+    ws_user_rate_limit: float = 20.0
+    ws_user_rate_burst: int = 60
+    # throttled frames a socket gets away with (one more each second) before it is closed
+    ws_rate_strikes: int = 20
+    # longer frames (in characters) close the socket before they are parsed
+    ws_max_message_size: int = 16 * 1024
+    # chat messages being resolved, saved and relayed at once across all sockets
+    ws_max_in_flight: int = 256
+    # how long a message waits for one of those before its socket is closed
+    ws_admission_timeout: float = 2.0
+    # unacked relayed messages kept per recipient for replay on reconnect
+    offline_queue_size: int = 500
+    # recipients with such a queue, the least recently written to is dropped beyond that
+    offline_queue_recipients: int = 100_000
+    # a queue nothing was added to for this long is dropped
+    offline_queue_ttl: float = 24 * 3600.0
+    # a disconnected device's ack position keeps its unacked messages this long, so it can resume
+    delivery_resume_window: float = 120.0
+    backplane: BackplaneKind = BackplaneKind.local
+    backplane_path: str = "/tmp/iot_proj_backplane.sock"
+    # after reconnecting to the backplane, workers not heard from within this long are taken as gone
+    backplane_resync_grace: float = 2.0
+    # events the broker queues for a worker that is not reading before it disconnects it
+    backplane_client_queue_size: int = 10_000
+    identity_cache_size: int = 10_000
+    identity_cache_ttl: float = 60.0
+    conversation_cache_size: int = 50_000
+    export_batch_size: int = 1000
+    search_backfill_batch_size: int = 5000
+    pbkdf2_rounds: int = 29_000
+    hash_workers: int = os.cpu_count() or 1
+    hash_max_pending: int = 32
+    hash_retry_after: int = 1
+    db_path: str = "db.sqlite3"
+    db_profile: DbProfile = DbProfile.production
+    db_mmap_size: int = 256 * 1024 * 1024
+    # negative means KiB rather than pages
+    db_cache_size: int = -64 * 1024
+    db_busy_timeout: int = 5000
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    # Prometheus metrics at /metrics, nothing is recorded while off
+    metrics_enabled: bool = False
+    # vitals are stored in chunks per patient, metric and bucket of this many seconds
+    vitals_bucket_seconds: int = 60
+    vitals_flush_interval: float = 1.0
+    # buffered samples that trigger a flush before the interval is up
+    vitals_flush_samples: int = 50_000
+    # ingestion answers 503 while this many samples wait to be written
+    vitals_max_buffered: int = 1_000_000
+    vitals_max_batch: int = 10_000
+    # window of the min/max/avg aggregates streamed live to doctors
+    vitals_live_interval: float = 1.0
+    # re-read templates that changed on disk, costs a stat per render
+    templates_auto_reload: bool = False
+    log_level: str = "INFO"
+    log_format: LogFormat = LogFormat.json
+    # records a second let through per message template, 0 disables the limit
+    log_rate_limit: float = 10.0
+    log_rate_burst: int = 20
+    # share of per-message events (logged with extra=SAMPLED) that are kept
+    log_sample_rate: float = 0.01
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        overrides = {}
+        for f in fields(cls):
+            raw = os.environ.get(f"IOT_{f.name.upper()}")
+            if raw is not None:
+                overrides[f.name] = _cast(f.type, raw)
+        return cls(**overrides)
+
+
+settings = Settings.from_env()
@@ -1,63 +1,200 @@
 from dataclasses import dataclass
 import logging
 from sqlalchemy.exc import SQLAlchemyError
-from sqlmodel import Session, select
-from iot_proj.form_models import ConvEntry, Conversation, PatientLoginFormData, PatientM, PatientRegisterFormdata
-from iot_proj.models import ConversationEntries, Patient, Conversation as ConvoT
-from passlib.hash import pbkdf2_sha256
+from sqlalchemy.orm import aliased
+from sqlmodel import and_, func, or_, select, tuple_
+from sqlmodel.ext.asyncio.session import AsyncSession
+from iot_proj.conversation_cache import conversation_cache, resolve_conversation
+from iot_proj.form_models import ConvEntry, Conversation, EntriesPage, PatientLoginFormData, PatientM, PatientRegisterFormdata
+from iot_proj.models import ConversationEntries, ConversationRead, Doctor, Patient, Conversation as ConvoT
+from iot_proj.passwords import hash_pwd, verify_and_update
 
 
 log = logging.getLogger(__name__)
+
+ENTRIES_PAGE_SIZE = 50
+ENTRIES_MAX_PAGE_SIZE = 200
+
 @dataclass
 class Error:
     error: str
 
-def hash_pwd(pwd: str) -> str:
-    return pbkdf2_sha256.hash(pwd)
-
-def pwdmatch(pwd: str, hash: str) -> bool:
-    return pbkdf2_sha256.verify(pwd, hash)
-
-def create_patient(formdata: PatientRegisterFormdata, session: Session) -> Patient | Error:
-    hash = hash_pwd(formdata.mdp)
+async def create_patient(formdata: PatientRegisterFormdata, session: AsyncSession) -> Patient | Error:
+    hash = await hash_pwd(formdata.mdp)
     patient = Patient(name = formdata.name, email = formdata.email, password=hash)
     try:
         session.add(patient)
-        session.commit()
-        session.refresh(patient)
+        await session.commit()
+        await session.refresh(patient)
     except SQLAlchemyError as e:
-        log.error(f"Failed to insert user: Cause: {e}")
+        log.error("Failed to insert user: Cause: %s", e)
         return Error(f"Error adding user, {e._message}")
     return patient
 
 
-def get_user(formdata: PatientLoginFormData, session: Session) -> PatientM | Error:
+async def get_user(formdata: PatientLoginFormData, session: AsyncSession) -> PatientM | Error:
     try:
-        res = session.exec(select(Patient).where(Patient.email == formdata.email)).one_or_none()
+        res = (await session.exec(select(Patient).where(Patient.email == formdata.email))).one_or_none()
         if res is None:
             return Error("No entry found")
-        pwd_match = pwdmatch(formdata.mdp, res.password)
+        pwd_match, new_hash = await verify_and_update(formdata.mdp, res.password)
         if not pwd_match:
             return Error("Wrong credentials")
-        return PatientM(name=res.name, email=res.email, id=res.id)
+        user = PatientM(name=res.name, email=res.email, id=res.id)
+        if new_hash is not None:
+            res.password = new_hash
+            session.add(res)
+            await session.commit()
+        return user
     except SQLAlchemyError as e:
         log.error(e)
         return Error(f"Error adding user, {e._message}")
     
 
-def get_user_convos(id: str, session: Session) -> list[Conversation | None] | Error:
+async def get_user_convos(id: str, session: AsyncSession) -> list[Conversation] | Error:
     try:
-        res = session.exec(select(ConvoT).where(ConvoT.patient_id == id)).all()
-        convos = list(map(map_u_convo, res))
-        return convos
+        return await list_conversations(id, is_doc=False, session=session)
     except SQLAlchemyError as e:
-        log.error(f"Failed to get user: Cause: {e}")
+        log.error("Failed to get user: Cause: %s", e)
         return Error(f"Error getting user, {e._message}")
 
-def get_conversation_entries(id: str, docId: str, session: Session) -> list[ConvEntry | None]:
-        res = session.exec(select(ConvoT).where(ConvoT.patient_id == id, ConvoT.doctor_id == docId)).one()
-        conversations = res.conversations
-        return list(map(conv_to_ConvEnt, conversations))
+
+async def list_conversations(id: str, is_doc: bool, session: AsyncSession) -> list[Conversation]:
+    """Conversations of `id` with the other party's name, the last message and the unread count.
+
+    Everything comes from one statement: the last entry and the unread count
+    are correlated subqueries walking the (conversation_id, time, id) index.
+    """
+    E = ConversationEntries
+    other = Patient if is_doc else Doctor
+    other_id = ConvoT.patient_id if is_doc else ConvoT.doctor_id
+    own_id = ConvoT.doctor_id if is_doc else ConvoT.patient_id
+    last = aliased(E)
+    last_id = (
+        select(E.id)
+        .where(E.conversation_id == ConvoT.id)
+        .order_by(E.time.desc(), E.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    unread = (
+        select(func.count())
+        .where(
+            E.conversation_id == ConvoT.id,
+            E.from_doctor != is_doc,
+            or_(
+                ConversationRead.last_read_id.is_(None),
+                tuple_(E.time, E.id) > tuple_(ConversationRead.last_read_time, ConversationRead.last_read_id),
+            ),
+        )
+        .scalar_subquery()
+    )
+    q = (
+        select(other.name, other_id, last.message, last.time, unread)
+        .select_from(ConvoT)
+        .join(other, other.id == other_id)
+        .outerjoin(ConversationRead, and_(ConversationRead.conversation_id == ConvoT.id, ConversationRead.is_doctor == is_doc))
+        .outerjoin(last, last.id == last_id)
+        .where(own_id == id)
+    )
+    rows = (await session.exec(q)).all()
+    return [Conversation(name=name, id=oid, last_message=msg, last_time=time, unread=n) for name, oid, msg, time, n in rows]
+
+
+async def mark_read(id: str, other_id: str, is_doc: bool, last_id: int, session: AsyncSession) -> None | Error:
+    """Moves the read marker of `id` in its conversation with `other_id` forward to entry `last_id`."""
+    doctor_id, patient_id = (id, other_id) if is_doc else (other_id, id)
+    try:
+        convo_id = (await session.exec(select(ConvoT.id).where(ConvoT.doctor_id == doctor_id, ConvoT.patient_id == patient_id))).first()
+        if convo_id is None:
+            return Error("No conversation found")
+        entry = await session.get(ConversationEntries, last_id)
+        if entry is None or entry.conversation_id != convo_id or entry.id is None:
+            return Error("Unknown entry")
+        read = await session.get(ConversationRead, (convo_id, is_doc))
+        if read is None:
+            read = ConversationRead(conversation_id=convo_id, is_doctor=is_doc, last_read_id=entry.id, last_read_time=entry.time)
+        elif (read.last_read_time, read.last_read_id) < (entry.time, entry.id):
+            read.last_read_id = entry.id
+            read.last_read_time = entry.time
+        else:
+            return None
+        session.add(read)
+        await session.commit()
+    except SQLAlchemyError as e:
+        log.error("Failed to mark conversation read: Cause: %s", e)
+        return Error(f"Error marking conversation read, {e._message}")
+    return None
+
+async def get_conversation_entries(id: str, docId: str, session: AsyncSession, before: int | None = None, after: int | None = None, limit: int = ENTRIES_PAGE_SIZE) -> EntriesPage | Error:
+    try:
+        convo_id = (await session.exec(select(ConvoT.id).where(ConvoT.patient_id == id, ConvoT.doctor_id == docId))).first()
+        if convo_id is None:
+            return Error("No conversation found")
+        return await get_entries_page(convo_id, session, before=before, after=after, limit=limit)
+    except SQLAlchemyError as e:
+        log.error("Failed to get conversation entries: Cause: %s", e)
+        return Error(f"Error getting conversation entries, {e._message}")
+
+
+async def get_entries_page(convo_id: str, session: AsyncSession, before: int | None = None, after: int | None = None, limit: int = ENTRIES_PAGE_SIZE) -> EntriesPage | Error:
+    """Keyset page over (time, id) of one conversation, always returned oldest first.
+
+    Without a cursor the latest `limit` entries are returned, `before` walks back
+    in history and `after` walks forward from the given entry id.
+    """
+    if before is not None and after is not None:
+        return Error("Only one of before and after can be given")
+    cursor_id = before if before is not None else after
+    q = select(ConversationEntries).where(ConversationEntries.conversation_id == convo_id)
+    key = tuple_(ConversationEntries.time, ConversationEntries.id)
+    if cursor_id is not None:
+        cursor = (
+            await session.exec(
+                select(ConversationEntries.time, ConversationEntries.id).where(
+                    ConversationEntries.id == cursor_id, ConversationEntries.conversation_id == convo_id
+                )
+            )
+        ).one_or_none()
+        if cursor is None:
+            return Error("Unknown cursor")
+        q = q.where(key > tuple_(*cursor)) if after is not None else q.where(key < tuple_(*cursor))
+    if after is not None:
+        q = q.order_by(ConversationEntries.time, ConversationEntries.id)
+    else:
+        q = q.order_by(ConversationEntries.time.desc(), ConversationEntries.id.desc())
+    rows = list((await session.exec(q.limit(limit + 1))).all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is None:
+        rows.reverse()
+    return EntriesPage(entries=list(map(conv_to_ConvEnt, rows)), has_more=has_more)
+
+
+async def get_conversation_sync(id: str, docId: str, session: AsyncSession, since: int, limit: int = ENTRIES_MAX_PAGE_SIZE) -> EntriesPage | Error:
+    try:
+        convo_id = await resolve_conversation(docId, id)
+        if convo_id is None:
+            return Error("No conversation found")
+        return await get_entries_since(convo_id, session, since=since, limit=limit)
+    except SQLAlchemyError as e:
+        log.error("Failed to sync conversation entries: Cause: %s", e)
+        return Error(f"Error syncing conversation entries, {e._message}")
+
+
+async def get_entries_since(convo_id: str, session: AsyncSession, since: int, limit: int = ENTRIES_MAX_PAGE_SIZE) -> EntriesPage:
+    """Entries of one conversation with an id above the high-water mark `since`, oldest first.
+
+    With nothing new this is a single probe of the (conversation_id, id) index.
+    """
+    q = (
+        select(ConversationEntries)
+        .where(ConversationEntries.conversation_id == convo_id, ConversationEntries.id > since)
+        .order_by(ConversationEntries.id)
+        .limit(limit + 1)
+    )
+    rows = list((await session.exec(q)).all())
+    return EntriesPage(entries=list(map(conv_to_ConvEnt, rows[:limit])), has_more=len(rows) > limit)
 
 
 def conv_to_ConvEnt(conv: ConversationEntries) -> ConvEntry | None:
@@ -67,17 +204,13 @@ def conv_to_ConvEnt(conv: ConversationEntries) -> ConvEntry | None:
     
     
 
-def create_u_convos(id: str, doc_id: str, session: Session):
+async def create_u_convos(id: str, doc_id: str, session: AsyncSession):
     try:
         c = ConvoT(doctor_id=doc_id, patient_id=id)
         session.add(c)
-        session.commit()
+        await session.commit()
+        conversation_cache.put(doc_id, id, c.id)
     except SQLAlchemyError as e:
         log.error(e)
         pass
 
-
-def map_u_convo(conv: ConvoT) -> Conversation | None:
-    if conv.doctor is None:
-        return None
-    return Conversation(name=conv.doctor.name, id=conv.doctor_id)
@@ -0,0 +1,285 @@
+"""Patient vitals telemetry: batched ingestion, a time-bucketed store and live aggregates.
+
+Devices push column-wise batches (`VitalsBatch`) to POST /patient/vitals or
+over the /vitals/ws socket.
+
+- `VitalsStore` buffers readings per (patient, metric, bucket). Each flush
+  writes one `VitalsChunk` row per group, with the samples packed into two
+  arrays and the chunk's min/max/sum/count alongside. A second of readings
+  from thousands of devices is then a single executemany.
+- `LiveAggregator` keeps min/max/sum/count per patient and metric over
+  `vitals_live_interval` windows. At the end of a window each online doctor
+  gets one frame with the windows of their patients, never the raw samples.
+"""
+import asyncio
+import logging
+import math
+import time
+from array import array
+
+from sqlalchemy import func, insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from iot_proj.conversation_cache import resolve_conversation
+from iot_proj.form_models import VitalMetric, VitalSeries, VitalsHistory, VitalsWindow
+from iot_proj.models import Conversation, VitalsChunk, async_session, engine
+from iot_proj.settings import settings
+from iot_proj.user_services import Error
+
+log = logging.getLogger(__name__)
+
+# how long the doctors of a patient are remembered by the live aggregator
+DOCTORS_TTL = 30.0
+# beyond this a timestamp is not epoch milliseconds (it is JS's largest safe integer)
+MAX_TIMESTAMP_MS = 2**53 - 1
+OFFSET_TYPE = "I"
+VALUE_TYPE = "f"
+# largest finite value of VALUE_TYPE, anything beyond would be stored as infinity
+MAX_VALUE = 3.4028234663852886e38
+
+Key = tuple[str, str, int]
+
+
+class VitalsOverloaded(Exception):
+    """Too many samples are already waiting to be written, the device should retry later."""
+
+
+def check_batch(series: list[VitalSeries]) -> int | Error:
+    """Sample count of a batch, or why it is refused."""
+    total = sum(len(s.t) for s in series)
+    if total > settings.vitals_max_batch:
+        return Error(f"At most {settings.vitals_max_batch} samples per batch")
+    if any(s.t and (min(s.t) < 0 or max(s.t) > MAX_TIMESTAMP_MS) for s in series):
+        return Error("Timestamps must be epoch milliseconds")
+    # a NaN or an infinity makes the sum non-finite, and NaN could slip past min and max
+    if any(s.v and not (math.isfinite(sum(s.v)) and -MAX_VALUE <= min(s.v) and max(s.v) <= MAX_VALUE) for s in series):
+        return Error("Values must be finite numbers")
+    return total
+
+
+class VitalsStore:
+    """Write-behind buffer of readings, flushed as chunks every `flush_interval` or `flush_samples`."""
+
+    def __init__(
+        self,
+        bucket_seconds: int = settings.vitals_bucket_seconds,
+        flush_interval: float = settings.vitals_flush_interval,
+        flush_samples: int = settings.vitals_flush_samples,
+        max_buffered: int = settings.vitals_max_buffered,
+    ):
+        self.bucket_ms = bucket_seconds * 1000
+        self.flush_interval = flush_interval
+        self.flush_samples = flush_samples
+        self.max_buffered = max_buffered
+        self._buffer: dict[Key, tuple[array, array]] = {}
+        # samples buffered plus those being written
+        self.buffered = 0
+        self.written = 0
+        self.failed = 0
+        self._flush_now = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Writes out what is buffered, then stops flushing."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._flush_now.set()
+        await self._task
+        self._task = None
+
+    def add(self, patient_id: str, series: list[VitalSeries], count: int):
+        """Buffers a checked batch, raises VitalsOverloaded when the buffer is full."""
+        if self.buffered + count > self.max_buffered:
+            raise VitalsOverloaded()
+        bucket_ms = self.bucket_ms
+        for s in series:
+            if not s.t:
+                continue
+            first = s.t[0] // bucket_ms
+            if min(s.t) // bucket_ms == first and max(s.t) // bucket_ms == first:
+                # a device batch almost always sits in one bucket
+                offsets, values = self._group(patient_id, s.metric, first)
+                base = first * bucket_ms
+                offsets.extend([t - base for t in s.t])
+                values.extend(s.v)
+                continue
+            for t, v in zip(s.t, s.v):
+                bucket = t // bucket_ms
+                offsets, values = self._group(patient_id, s.metric, bucket)
+                offsets.append(t - bucket * bucket_ms)
+                values.append(v)
+        self.buffered += count
+        if self.buffered >= self.flush_samples:
+            self._flush_now.set()
+
+    def _group(self, patient_id: str, metric: VitalMetric, bucket: int) -> tuple[array, array]:
+        key = (patient_id, metric.value, bucket)
+        group = self._buffer.get(key)
+        if group is None:
+            group = self._buffer[key] = (array(OFFSET_TYPE), array(VALUE_TYPE))
+        return group
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self._flush_now.wait()
+            except TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self._flush()
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, {}
+        count = sum(len(values) for _, values in buffer.values())
+        bucket_seconds = self.bucket_ms // 1000
+        rows = [
+            {
+                "patient_id": patient_id,
+                "metric": metric,
+                "bucket_start": bucket * bucket_seconds,
+                "count": len(values),
+                "min": min(values),
+                "max": max(values),
+                "sum": sum(values),
+                "offsets": offsets.tobytes(),
+                "values": values.tobytes(),
+            }
+            for (patient_id, metric, bucket), (offsets, values) in buffer.items()
+        ]
+        try:
+            await asyncio.to_thread(write_chunks, rows)
+            self.written += count
+        except SQLAlchemyError as e:
+            log.error("Failed to persist %d vitals samples, retrying chunk by chunk: Cause: %s", count, e)
+            failed = await asyncio.to_thread(write_chunks_each, rows)
+            self.failed += failed
+            self.written += count - failed
+        finally:
+            self.buffered -= count
+
+
+def write_chunks(rows: list[dict]):
+    with engine.begin() as conn:
+        conn.execute(insert(VitalsChunk), rows)
+
+
+def write_chunks_each(rows: list[dict]) -> int:
+    """Writes the chunks one transaction each so a bad one costs only its own samples, returns how many samples failed."""
+    failed = 0
+    for row in rows:
+        try:
+            write_chunks([row])
+        except SQLAlchemyError as e:
+            log.error("Failed to persist %d %s samples of patient %s: Cause: %s", row["count"], row["metric"], row["patient_id"], e)
+            failed += row["count"]
+    return failed
+
+
+class LiveAggregator:
+    """Per-window min/max/avg of every patient's metrics, pushed to their doctors over the chat socket."""
+
+    def __init__(self, manager, interval: float = settings.vitals_live_interval):
+        self.manager = manager
+        self.interval = interval
+        # (patient, metric) -> [count, min, max, sum] of the current window
+        self._windows: dict[tuple[str, str], list] = {}
+        self._window_start = time.time()
+        self._doctors: dict[str, tuple[float, list[str]]] = {}
+        self._task: asyncio.Task | None = None
+        self.frames = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, patient_id: str, series: list[VitalSeries]):
+        for s in series:
+            if not s.v:
+                continue
+            lo, hi, total = min(s.v), max(s.v), sum(s.v)
+            w = self._windows.get((patient_id, s.metric.value))
+            if w is None:
+                self._windows[(patient_id, s.metric.value)] = [len(s.v), lo, hi, total]
+            else:
+                w[0] += len(s.v)
+                w[1] = min(w[1], lo)
+                w[2] = max(w[2], hi)
+                w[3] += total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except SQLAlchemyError as e:
+                log.error("Failed to look up the doctors of live vitals: Cause: %s", e)
+
+    async def flush(self):
+        windows, self._windows = self._windows, {}
+        start, self._window_start = self._window_start, time.time()
+        if not windows or not self.manager.presence[True]:
+            return
+        per_doctor: dict[str, list[dict]] = {}
+        for (patient_id, metric), (count, lo, hi, total) in windows.items():
+            item = {"patient_id": patient_id, "metric": metric, "n": count, "min": lo, "max": hi, "avg": total / count}
+            for doctor_id in await self.doctors_of(patient_id):
+                if doctor_id in self.manager.presence[True]:
+                    per_doctor.setdefault(doctor_id, []).append(item)
+        window = {"start": int(start * 1000), "window": int(self.interval * 1000)}
+        for doctor_id, items in per_doctor.items():
+            await self.manager.send_vitals(doctor_id, {**window, "series": items})
+            self.frames += 1
+
+    async def doctors_of(self, patient_id: str) -> list[str]:
+        now = time.monotonic()
+        cached = self._doctors.get(patient_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        async with async_session() as session:
+            doctors = list((await session.exec(select(Conversation.doctor_id).where(Conversation.patient_id == patient_id))).all())
+        self._doctors[patient_id] = (now + DOCTORS_TTL, doctors)
+        return doctors
+
+
+async def get_vitals_history(
+    doctor_id: str, patient_id: str, metric: VitalMetric, since: int, until: int, bucket: int, session: AsyncSession
+) -> VitalsHistory | Error:
+    """min/max/avg per `bucket` seconds over [since, until), from chunk aggregates only."""
+    try:
+        if await resolve_conversation(doctor_id, patient_id) is None:
+            return Error("No conversation found")
+        step = settings.vitals_bucket_seconds
+        # windows are made of whole store buckets
+        bucket = max(step, bucket - bucket % step)
+        C = VitalsChunk
+        start = (C.bucket_start - C.bucket_start % bucket).label("start")
+        rows = (
+            await session.exec(
+                select(start, func.sum(C.count), func.min(C.min), func.max(C.max), func.sum(C.sum))
+                .where(C.patient_id == patient_id, C.metric == metric.value, C.bucket_start >= since - since % step, C.bucket_start < until)
+                .group_by(start)
+                .order_by(start)
+            )
+        ).all()
+        windows = [VitalsWindow(start=s, count=n, min=lo, max=hi, avg=total / n) for s, n, lo, hi, total in rows]
+        return VitalsHistory(metric=metric, bucket=bucket, windows=windows)
+    except SQLAlchemyError as e:
+        log.error("Failed to get vitals history: Cause: %s", e)
+        return Error(f"Error getting vitals history, {e._message}")
@@ -1,120 +1,431 @@
-from enum import Enum
-from fastapi import WebSocket, WebSocketDisconnect
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Iterator
+from fastapi import WebSocket, WebSocketDisconnect, status
 import logging
 
-from pydantic import BaseModel
+from iot_proj.backplane import Backplane, Event, EventKind, create_backplane
+from iot_proj.delivery import DeliveryQueues
+from iot_proj.heartbeat import Heartbeat
+from iot_proj.log_config import SAMPLED
+from iot_proj.settings import SlowConsumerPolicy, settings
+# the payload models live in iot_proj.wire now, still importable from here
+from iot_proj.wire import (
+    ConPayload,
+    DisconPayload,
+    MsgPayload,
+    OnlinePayload,
+    Payload,
+    PayloadTypeEnum,
+    Protocol,
+    encode_message,
+    encode_online,
+    encode_ping,
+    encode_presence,
+    encode_start,
+    encode_vitals,
+    negotiate,
+)
 
 
 log = logging.getLogger(__name__)
 
-class PayloadTypeEnum(str, Enum):
-    discon = "disconnect"
-    con = "connect"
-    msg = "message"
-
-class DisconPayload(BaseModel):
-    id: str
-
-class ConPayload(BaseModel):
-    id: str
-
-class MsgPayload(BaseModel):
-    msg: str
-    sender_id: str
-
-class Payload(BaseModel):
-    type: PayloadTypeEnum
-    data: str
-
 class WebSockCon:
-    is_doc: bool
-    id: str
-    con: WebSocket
+    """One chat socket. Slotted and without a writer task while idle, tens of thousands sit in a worker."""
+
+    __slots__ = ("id", "con", "is_doc", "protocol", "acks", "acked", "queue_size", "outbox", "writer", "closing", "last_seen", "pinged_at", "slot")
 
-    def __init__(self, id: str, con: WebSocket, is_doc: bool):
+    def __init__(
+        self, id: str, con: WebSocket, is_doc: bool, protocol: Protocol = Protocol.v1, acks: bool = False, queue_size: int = settings.send_queue_size
+    ):
         self.id = id
         self.con = con
         self.is_doc = is_doc
+        self.protocol = protocol
+        # the client acks relayed messages, so they are kept until it does
+        self.acks = acks
+        # highest mid this socket acked
+        self.acked = 0
+        # frames are serialized once by the manager and written by a task that only lives while some are queued
+        self.queue_size = queue_size
+        self.outbox: deque[str] = deque()
+        self.writer: asyncio.Task | None = None
+        self.closing = False
+        # heartbeat state, see iot_proj/heartbeat.py
+        self.last_seen = 0.0
+        self.pinged_at = 0.0
+        self.slot = -1
 
-    def filter_opp_of_me(self, w: "WebSockCon") -> bool:
-        if w.is_doc and not self.is_doc:
-            return True
-        return False
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def stop(self):
+        self.closing = True
+        self.outbox.clear()
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
 
-    def filter_not_me(self, w: "WebSockCon") -> bool:
-        if w.id == self.id:
+    def offer(self, frame: str) -> bool:
+        """Queues a frame without waiting, False when the send queue is full."""
+        if self.closing:
+            # going away, nobody will read it
+            return True
+        if len(self.outbox) >= self.queue_size:
             return False
+        self.outbox.append(frame)
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._drain())
         return True
-            
-        
+
+    async def _drain(self):
+        try:
+            while self.outbox:
+                try:
+                    await self.con.send_text(self.outbox.popleft())
+                except (WebSocketDisconnect, RuntimeError, OSError) as e:
+                    log.warning("Socket of %s closed, couldn't send message: %s", self.id, e)
+                    self.closing = True
+                    self.outbox.clear()
+                    return
+        finally:
+            self.writer = None
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, WebSockCon] = dict()
-
-    @staticmethod
-    def map_wcon_payload(w: WebSockCon) -> Payload | None:
-        if w.con.client is None:
-            return None
-        data = ConPayload(id=w.id).model_dump_json()
-        p = Payload(type=PayloadTypeEnum.con, data=data)
-        return p
-
-    async def connect(self, wsoc: WebSocket, id: str, is_doc):
-            await wsoc.accept()
-            con = WebSockCon(id=id, con=wsoc, is_doc=is_doc)
-            self.active_connections[id] = con
-            data = ConPayload(id=con.id).model_dump_json()
-            payload = Payload(type=PayloadTypeEnum.con, data=data)
-            log.info("New conenction. Broadcasting to interested parties")
-            await self.broadcast(to_clients=con.is_doc, payload=payload)
-            f = filter(con.filter_opp_of_me, list(self.active_connections.values()))
-            f = filter(con.filter_not_me, list(self.active_connections.values()))
-            f = map(self.map_wcon_payload, f)
-
-            for e in f:
-                if e is None:
-                    continue
-                await wsoc.send_text(e.model_dump_json())
-
-
-
-
-    async def disconnect(self, id: str):
-        con = self.active_connections.pop(id)
-        data = DisconPayload(id=con.id).model_dump_json()
-        payload = Payload(type=PayloadTypeEnum.discon, data=data)
-        await self.broadcast(to_clients=con.is_doc, payload=payload)
+    """Sockets of this worker, several per user (tabs, devices), and who is online on any worker.
+
+    Presence is refcounted: a worker publishes a join when a user's first
+    socket on it connects and a leave when their last one goes, and a user is
+    online while at least one worker has them. Clients only hear about the
+    first and the last device.
+    """
+
+    def __init__(
+        self,
+        slow_consumer_policy: SlowConsumerPolicy = settings.slow_consumer_policy,
+        backplane: Backplane | None = None,
+        presence_batch_interval: float = settings.presence_batch_interval,
+        deliveries: DeliveryQueues | None = None,
+        heartbeat: Heartbeat | None = None,
+        resync_grace: float = settings.backplane_resync_grace,
+    ):
+        self.active_connections: dict[str, set[WebSockCon]] = dict()
+        # local connections are indexed per role so fan-out never scans the other side
+        self.doctors: dict[str, set[WebSockCon]] = dict()
+        self.patients: dict[str, set[WebSockCon]] = dict()
+        # identifies this worker's events on the backplane
+        self.origin = uuid.uuid4().hex
+        # who is online on any worker, id -> workers holding one of their sockets, kept up to date by backplane events
+        self.presence: dict[bool, dict[str, set[str | None]]] = {True: {}, False: {}}
+        # serialized "online" frame of each role and protocol, rebuilt lazily after a join or leave of that role
+        self._snapshots: dict[tuple[bool, Protocol], str] = {}
+        # joins and leaves of each role not announced yet, id -> online
+        self._presence_changes: dict[bool, dict[str, bool]] = {True: {}, False: {}}
+        self._presence_flush: asyncio.TimerHandle | None = None
+        self.presence_batch_interval = presence_batch_interval
+        self.backplane = backplane or create_backplane()
+        self.resync_grace = resync_grace
+        # workers that answered since the last (re)connect to the backplane, None outside that window
+        self._heard: set[str | None] | None = None
+        self._resync: asyncio.TimerHandle | None = None
+        self.deliveries = deliveries or DeliveryQueues()
+        self.slow_consumer_policy = slow_consumer_policy
+        self.heartbeat = heartbeat or Heartbeat(on_ping=self._ping, on_dead=self._reap)
+        self.relayed = 0
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+        self._closers: set[asyncio.Task] = set()
+
+    async def start(self):
+        await self.backplane.start(self.on_event)
+        self.heartbeat.start()
+
+    async def stop(self):
+        self.heartbeat.stop()
+        if self._presence_flush is not None:
+            self._presence_flush.cancel()
+        if self._resync is not None:
+            self._resync.cancel()
+        await self.backplane.stop()
+
+    def _role(self, is_doc: bool) -> dict[str, set[WebSockCon]]:
+        return self.doctors if is_doc else self.patients
+
+    def connections(self) -> Iterator[WebSockCon]:
+        for cons in self.active_connections.values():
+            yield from cons
+
+    def _elsewhere(self, id: str) -> bool:
+        """Whether another worker holds a socket of `id`."""
+        for role in self.presence.values():
+            origins = role.get(id)
+            if origins and (len(origins) > 1 or self.origin not in origins):
+                return True
+        return False
+
+    def online_snapshot(self, is_doc: bool, protocol: Protocol = Protocol.v1) -> str:
+        """Frame listing everybody of the given role online on any worker."""
+        snap = self._snapshots.get((is_doc, protocol))
+        if snap is None:
+            snap = encode_online(protocol, list(self.presence[is_doc]))
+            self._snapshots[(is_doc, protocol)] = snap
+        return snap
+
+    def _invalidate_snapshots(self, is_doc: bool):
+        for p in Protocol:
+            self._snapshots.pop((is_doc, p), None)
+
+    async def connect(self, wsoc: WebSocket, id: str, is_doc, last_ack: int | None = None, acks: bool = False) -> WebSockCon:
+            """Registers a socket. Clients passing `last_ack` get what they have not acked replayed.
+
+            Those only passing `acks` load their history from the database and
+            are sent the position to pass as `last_ack` when they reconnect.
+            """
+            protocol = negotiate(wsoc.scope.get("subprotocols", []))
+            await wsoc.accept(subprotocol=protocol.value if protocol else None)
+            con = WebSockCon(id=id, con=wsoc, is_doc=is_doc, protocol=protocol or Protocol.v1, acks=acks or last_ack is not None)
+            self.heartbeat.add(con)
+            cons = self.active_connections.get(id)
+            first = cons is None
+            if first:
+                cons = self.active_connections[id] = set()
+                self._role(is_doc)[id] = cons
+            cons.add(con)
+            # one frame with everybody already online on the other side
+            self.send(con, self.online_snapshot(not is_doc, con.protocol))
+            if last_ack is not None:
+                con.acked = last_ack
+                self._trim(id, cons)
+                for item in self.deliveries.pending(id, after=last_ack):
+                    self.send(con, encode_message(con.protocol, item.msg, item.sender_id, item.mid))
+            elif acks:
+                # what is queued so far is in the history the client loads; ids come from the clock, so this holds on any worker
+                con.acked = self.deliveries.next_mid()
+                self._trim(id, cons)
+                self.send(con, encode_start(con.protocol, con.acked))
+            elif first:
+                # without acks the client reloads its history instead
+                self.deliveries.take(id)
+            log.debug("%s connected, is_doc = %s, sockets = %d", id, is_doc, len(cons))
+            if first:
+                await self.backplane.publish(Event(kind=EventKind.join, origin=self.origin, id=id, is_doc=is_doc))
+            return con
+
+    async def disconnect(self, id: str, con: WebSockCon):
+        """Unregisters one socket of `id`, the user leaves once it was their last one here."""
+        con.stop()
+        self.heartbeat.remove(con)
+        cons = self.active_connections.get(id)
+        if cons is None or con not in cons:
+            # reaped already
+            return
+        cons.discard(con)
+        if con.acks:
+            self.deliveries.park(id, con.acked)
+        if cons:
+            return
+        del self.active_connections[id]
+        self._role(con.is_doc).pop(id, None)
+        await self.backplane.publish(Event(kind=EventKind.leave, origin=self.origin, id=id, is_doc=con.is_doc))
 
     async def relay_message(self, message: str, senderid: str, recvid: str):
-        r = self.active_connections.get(recvid)
-        if r is None:
-            log.warning(f"Connection not found, no relaying, recv: {recvid}")
+        log.debug("Relaying a message from %s to %s", senderid, recvid, extra=SAMPLED)
+        cons = self.active_connections.get(recvid)
+        if cons:
+            self.deliver(recvid, cons, message, senderid)
+        if self._elsewhere(recvid):
+            await self.backplane.publish(Event(kind=EventKind.relay, origin=self.origin, id=recvid, sender=senderid, msg=message))
+        elif not cons:
+            # offline, kept for replay when the recipient reconnects
+            self.deliveries.push(recvid, senderid, message)
+
+    def deliver(self, id: str, cons: set[WebSockCon], message: str, senderid: str):
+        """Sends a message to every socket of `id` here; all of them get the same `mid`."""
+        mid = self.deliveries.push(id, senderid, message).mid if any(c.acks for c in cons) else None
+        # encoded once per protocol and whether the socket acks
+        frames: dict[tuple[Protocol, bool], str] = {}
+        for con in list(cons):
+            frame = frames.get((con.protocol, con.acks))
+            if frame is None:
+                frame = frames[(con.protocol, con.acks)] = encode_message(con.protocol, message, senderid, mid if con.acks else None)
+            self.send(con, frame)
+        self.relayed += 1
+
+    def ack(self, con: WebSockCon, mid: int):
+        if mid > con.acked:
+            con.acked = mid
+        cons = self.active_connections.get(con.id)
+        if cons:
+            self._trim(con.id, cons)
+
+    def _trim(self, id: str, cons: set[WebSockCon]):
+        """Drops what every acking socket of `id` here has acked."""
+        acked = [c.acked for c in cons if c.acks]
+        if acked:
+            self.deliveries.ack(id, min(acked))
+
+    async def send_vitals(self, doctor_id: str, payload: dict):
+        """Live vitals frame for a doctor on any worker, dropped when they are offline."""
+        for con in list(self.doctors.get(doctor_id, ())):
+            self.send(con, encode_vitals(con.protocol, payload))
+        if self._elsewhere(doctor_id):
+            await self.backplane.publish(Event(kind=EventKind.vitals, origin=self.origin, id=doctor_id, msg=json.dumps(payload)))
+
+    async def _forward_pending(self, id: str):
+        """Hands what is queued here for `id` to the worker it just connected to."""
+        for item in self.deliveries.take(id):
+            await self.backplane.publish(Event(kind=EventKind.relay, origin=self.origin, id=id, sender=item.sender_id, msg=item.msg))
+
+    async def on_event(self, event: Event):
+        """Applies an event published by any worker, this one included."""
+        match event.kind:
+            case EventKind.join if event.id is not None and event.is_doc is not None:
+                self._add_presence(event.is_doc, event.id, event.origin)
+                if event.id not in self.active_connections and event.id in self.deliveries:
+                    await self._forward_pending(event.id)
+            case EventKind.leave if event.id is not None and event.is_doc is not None:
+                self._remove_presence(event.is_doc, event.id, event.origin)
+            # relays and vitals of this worker were handed to its own sockets already
+            case EventKind.relay if event.id is not None and event.sender is not None and event.msg is not None and event.origin != self.origin:
+                cons = self.active_connections.get(event.id)
+                if cons:
+                    self.deliver(event.id, cons, event.msg, event.sender)
+            case EventKind.vitals if event.id is not None and event.msg is not None and event.origin != self.origin:
+                cons = self.doctors.get(event.id)
+                if cons:
+                    payload = json.loads(event.msg)
+                    for con in list(cons):
+                        self.send(con, encode_vitals(con.protocol, payload))
+            case EventKind.connected:
+                # after a reconnect, workers that do not answer within the grace period are taken as gone
+                self._heard = {self.origin}
+                if self._resync is not None:
+                    self._resync.cancel()
+                self._resync = asyncio.get_running_loop().call_later(self.resync_grace, self._forget_silent)
+                # joins and leaves of our own published while disconnected were lost
+                self._replace_presence(self.origin, list(self.doctors), list(self.patients))
+                await self.backplane.publish(Event(kind=EventKind.sync, origin=self.origin, doctors=list(self.doctors), patients=list(self.patients)))
+            case EventKind.sync | EventKind.state if event.origin != self.origin:
+                if self._heard is not None:
+                    self._heard.add(event.origin)
+                self._replace_presence(event.origin, event.doctors, event.patients)
+                if event.kind is EventKind.sync:
+                    await self.backplane.publish(Event(kind=EventKind.state, origin=self.origin, doctors=list(self.doctors), patients=list(self.patients)))
+            case EventKind.gone if event.origin != self.origin:
+                log.info("Worker %s left the backplane, dropping its presence", event.origin)
+                self._replace_presence(event.origin, [], [])
+
+    def _add_presence(self, is_doc: bool, id: str, origin: str | None):
+        origins = self.presence[is_doc].setdefault(id, set())
+        if not origins:
+            self._invalidate_snapshots(is_doc)
+            self._presence_changed(id, is_doc, online=True)
+        origins.add(origin)
+
+    def _remove_presence(self, is_doc: bool, id: str, origin: str | None):
+        origins = self.presence[is_doc].get(id)
+        if origins is None:
             return
+        origins.discard(origin)
+        if not origins:
+            del self.presence[is_doc][id]
+            self._invalidate_snapshots(is_doc)
+            self._presence_changed(id, is_doc, online=False)
+
+    def _replace_presence(self, origin: str | None, doctors: list[str], patients: list[str]):
+        """Makes `origin`'s share of presence exactly the given ids, announcing the differences."""
+        for is_doc, ids in ((True, doctors), (False, patients)):
+            listed = set(ids)
+            for id, origins in list(self.presence[is_doc].items()):
+                if origin in origins and id not in listed:
+                    self._remove_presence(is_doc, id, origin)
+            for id in listed:
+                self._add_presence(is_doc, id, origin)
+
+    def _forget_silent(self):
+        self._resync = None
+        heard, self._heard = self._heard or set(), None
+        silent = {o for role in self.presence.values() for origins in role.values() for o in origins} - heard
+        for origin in silent:
+            log.info("Worker %s did not answer after the backplane reconnect, dropping its presence", origin)
+            self._replace_presence(origin, [], [])
+
+    def _presence_changed(self, id: str, is_doc: bool, online: bool):
+        """Queues a join or leave, announced together with the others of the same batch window."""
+        self._presence_changes[is_doc][id] = online
+        if self.presence_batch_interval <= 0:
+            self.flush_presence()
+        elif self._presence_flush is None:
+            self._presence_flush = asyncio.get_running_loop().call_later(self.presence_batch_interval, self.flush_presence)
+
+    def flush_presence(self):
+        self._presence_flush = None
+        for is_doc, changes in self._presence_changes.items():
+            if not changes:
+                continue
+            self._presence_changes[is_doc] = {}
+            # each protocol's frames are encoded once for the whole role
+            frames: dict[Protocol, list[str]] = {}
+            targets = [con for cons in self._role(not is_doc).values() for con in cons]
+            for con in targets:
+                if con.protocol not in frames:
+                    frames[con.protocol] = encode_presence(con.protocol, changes)
+                for frame in frames[con.protocol]:
+                    self.send(con, frame)
+            log.debug("Announced %d presence changes to %d clients, is_doc = %s", len(changes), len(targets), is_doc)
+
+    def send(self, con: WebSockCon, frame: str):
+        """Hands a serialized frame to the connection's writer, never waits on the socket."""
+        if con.offer(frame):
+            return
+        self.dropped_frames += 1
+        if self.slow_consumer_policy is SlowConsumerPolicy.disconnect and not con.closing:
+            con.closing = True
+            self.slow_disconnects += 1
+            log.warning("Send queue of %s is full, disconnecting slow consumer", con.id)
+            con.stop()
+            self._spawn_close(con, status.WS_1013_TRY_AGAIN_LATER, "Too slow")
+
+    def _ping(self, con: WebSockCon):
+        self.send(con, encode_ping(con.protocol))
+
+    def _reap(self, con: WebSockCon):
+        """Heartbeat timeout: unregistered right away, the close handshake may never finish on a dead peer."""
+        log.info("No pong from %s, closing the socket", con.id)
+        self._spawn_close(con, status.WS_1001_GOING_AWAY, "Heartbeat timeout", unregister=True)
+
+    async def close(self, con: WebSockCon, code: int, reason: str):
+        """Unregisters and closes a socket the server is done with."""
+        con.stop()
+        await self._close(con, code, reason, unregister=True)
+
+    def _spawn_close(self, con: WebSockCon, code: int, reason: str, unregister: bool = False):
+        task = asyncio.create_task(self._close(con, code, reason, unregister))
+        self._closers.add(task)
+        task.add_done_callback(self._closers.discard)
+
+    async def _close(self, con: WebSockCon, code: int, reason: str, unregister: bool):
+        if unregister:
+            await self.disconnect(con.id, con)
         try:
-            sender = self.active_connections.get(senderid)
-            if sender:
-                data = MsgPayload(msg=message, sender_id=sender.id)
-                payload = Payload(type=PayloadTypeEnum.msg, data=data.model_dump_json())
-                await r.con.send_text(payload.model_dump_json())
-                log.info(f"Sent message to {recvid}, {payload.model_dump_json()}")
-        except WebSocketDisconnect as e:
-            log.warn(f"Socket closed couldn't send message: {e}")
+            await con.con.close(code=code, reason=reason)
+        except (RuntimeError, OSError):
             pass
-            
-
-    async def broadcast(self, to_clients: bool, payload: Payload):
-        connections = list(self.active_connections.values())
-        log.info(f"Connections: {self.active_connections}")
-        c = list(filter(lambda con: con.is_doc is not to_clients, connections))
-        log.info(f"Making broadcast to {len(c)} clients, to_clients = {to_clients}")
-        for cons in c:
-            try:
-                await cons.con.send_text(payload.model_dump_json())
-            except WebSocketDisconnect as e:
-                log.warn(f"Socket closed couldn't send message: {e}")
-                pass
-            
-            
-
-            
+
+    def metrics(self) -> dict[str, int]:
+        depths = [len(c.outbox) for c in self.connections()]
+        return {
+            "connections": len(depths),
+            "send_queue_depth_total": sum(depths),
+            "send_queue_depth_max": max(depths, default=0),
+            "relayed": self.relayed,
+            "dropped_frames": self.dropped_frames,
+            "slow_disconnects": self.slow_disconnects,
+            "pings": self.heartbeat.pings,
+            "reaped": self.heartbeat.reaped,
+            **{f"pending_{k}": v for k, v in self.deliveries.stats().items()},
+        }
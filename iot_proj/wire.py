@@ -0,0 +1,137 @@
+"""Frame encodings of the chat socket, picked per connection by subprotocol.
+
+- `iot.v1` (also what a client asking for no subprotocol gets): a `Payload`
+  whose `data` is itself a JSON string, one frame per presence change.
+- `iot.v2.json`: flat objects tagged by `t`, joins and leaves batched into
+  `presence` frames.
+
+    {"t": "message", "msg": "hi", "sender_id": "...", "mid": 1718000000000000}
+    {"t": "online", "ids": ["..."]}
+    {"t": "presence", "online": ["..."], "offline": ["..."]}
+    {"t": "error", "error": "invalid data"}
+    {"t": "ping"}
+    {"t": "start", "mid": 1718000000000000}
+    {"t": "vitals", "start": 1718000000000, "window": 1000, "series": [{"patient_id": "...", "metric": "spo2", "n": 50, "min": 96.0, "max": 98.0, "avg": 97.1}]}
+
+Clients that ack send `{"ack": <mid>}` back, see iot_proj/delivery.py. One
+connecting with `acks=1` instead of a `last_ack` loads history itself and is
+told with `start` where to resume from should it reconnect. Every
+client answers a ping with exactly `{"t":"pong"}`, see iot_proj/heartbeat.py.
+
+Compression is permessage-deflate, negotiated by the server (uvicorn enables
+it by default, see `--ws-per-message-deflate`). Its state is about 40 KB per
+idle socket, more than everything else together, see bench/idle_sockets.py.
+"""
+import json
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class PayloadTypeEnum(str, Enum):
+    discon = "disconnect"
+    con = "connect"
+    msg = "message"
+    online = "online"
+    vitals = "vitals"
+    ping = "ping"
+    start = "start"
+
+class DisconPayload(BaseModel):
+    id: str
+
+class ConPayload(BaseModel):
+    id: str
+
+class OnlinePayload(BaseModel):
+    ids: list[str]
+
+class MsgPayload(BaseModel):
+    msg: str
+    sender_id: str
+    mid: int | None = None
+
+class Payload(BaseModel):
+    type: PayloadTypeEnum
+    data: str
+
+
+class Protocol(str, Enum):
+    v1 = "iot.v1"
+    v2_json = "iot.v2.json"
+
+
+# compared as a string, the one inbound frame that skips validation
+PONG = '{"t":"pong"}'
+
+# preferred first when a client offers several
+SUPPORTED = (Protocol.v2_json, Protocol.v1)
+
+
+def negotiate(offered: list[str]) -> Protocol | None:
+    """Subprotocol to accept from those the client offered, None to accept without one (v1)."""
+    for p in SUPPORTED:
+        if p.value in offered:
+            return p
+    return None
+
+
+def _v2(**fields) -> str:
+    return json.dumps(fields, separators=(",", ":"))
+
+
+def encode_message(protocol: Protocol, msg: str, sender_id: str, mid: int | None = None) -> str:
+    """A relayed chat message, `mid` is set when the recipient acks what it gets."""
+    if protocol is Protocol.v2_json:
+        if mid is None:
+            return _v2(t="message", msg=msg, sender_id=sender_id)
+        return _v2(t="message", msg=msg, sender_id=sender_id, mid=mid)
+    data = MsgPayload(msg=msg, sender_id=sender_id, mid=mid).model_dump_json(exclude_none=True)
+    return Payload(type=PayloadTypeEnum.msg, data=data).model_dump_json()
+
+
+def encode_online(protocol: Protocol, ids: list[str]) -> str:
+    if protocol is Protocol.v2_json:
+        return _v2(t="online", ids=ids)
+    return Payload(type=PayloadTypeEnum.online, data=OnlinePayload(ids=ids).model_dump_json()).model_dump_json()
+
+
+def encode_presence(protocol: Protocol, changes: dict[str, bool]) -> list[str]:
+    """Frames announcing `changes` (id -> online), one for v2 and one per id for v1."""
+    if protocol is Protocol.v2_json:
+        online = [id for id, on in changes.items() if on]
+        offline = [id for id, on in changes.items() if not on]
+        return [_v2(t="presence", online=online, offline=offline)]
+    frames = []
+    for id, on in changes.items():
+        if on:
+            frames.append(Payload(type=PayloadTypeEnum.con, data=ConPayload(id=id).model_dump_json()).model_dump_json())
+        else:
+            frames.append(Payload(type=PayloadTypeEnum.discon, data=DisconPayload(id=id).model_dump_json()).model_dump_json())
+    return frames
+
+
+def encode_error(protocol: Protocol, error: str) -> str:
+    if protocol is Protocol.v2_json:
+        return _v2(t="error", error=error)
+    return error
+
+
+def encode_vitals(protocol: Protocol, payload: dict) -> str:
+    """Live vitals aggregates of one window, see iot_proj/vitals.py."""
+    if protocol is Protocol.v2_json:
+        return _v2(t="vitals", **payload)
+    return Payload(type=PayloadTypeEnum.vitals, data=json.dumps(payload, separators=(",", ":"))).model_dump_json()
+
+
+def encode_ping(protocol: Protocol) -> str:
+    if protocol is Protocol.v2_json:
+        return _v2(t="ping")
+    return Payload(type=PayloadTypeEnum.ping, data="").model_dump_json()
+
+
+def encode_start(protocol: Protocol, mid: int) -> str:
+    """Ack position of a socket that loaded history instead of resuming."""
+    if protocol is Protocol.v2_json:
+        return _v2(t="start", mid=mid)
+    return Payload(type=PayloadTypeEnum.start, data=json.dumps({"mid": mid})).model_dump_json()
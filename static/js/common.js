@@ -8,12 +8,18 @@ const CON_PREFIX = "d";
 const conversations = new Map();
 /** @type {Map<string, ChatEntry[]>} */
 const chatEntries = new Map();
+/** @type {Map<string, boolean>} */
+const chatHasMore = new Map();
+/** @type {Set<string>} */
+const chatLoadingOlder = new Set();
+const ENTRIES_PAGE_SIZE = 50;
+const LOAD_OLDER_THRESHOLD_PX = 80;
 const conversationsCont = document.querySelector(`#conversations`);
 const chatsPane = document.querySelector("#chatsPane");
 const noChatsPlaceholder = document.querySelector("#nosel");
 const pleaseWaitMsgPlaceholder = document.querySelector("#loadingCh");
 const metrics = document.getElementById("metrics")
-/** @type {Map<string, DoctorM>} */
+/** @type {Map<string, DoctorCard>} */
 const activeConnections = new Map();
 const activeConnectionsCont = document.querySelector("#actCon");
 /** @type {string|undefined} */
@@ -54,21 +60,120 @@ queryForm.addEventListener("submit", function (e) {
   }
 });
 
-const ws = new WebSocket(`ws://${API_URL}/ws`);
+const WS_PROTOCOL = "iot.v2.json";
+const ACK_DELAY_MS = 100;
+const PONG_FRAME = '{"t":"pong"}';
+const RECONNECT_MAX_MS = 30000;
+/**
+ * highest message id processed, acked cumulatively and resumed from on reconnect;
+ * undefined until the server's `start` frame, a page load takes its history from the database instead
+ * @type {number|undefined}
+ */
+let lastAck = undefined;
+let pendingAck = 0;
+let ackTimer = undefined;
+let reconnectDelay = 500;
+/** @type {WebSocket} */
+let ws = connectSocket();
 
-ws.addEventListener("message", onMessageReceived);
+function connectSocket() {
+  const query = lastAck === undefined ? "acks=1" : `last_ack=${lastAck}`;
+  const sock = new WebSocket(`ws://${API_URL}/ws?${query}`, [WS_PROTOCOL]);
+  sock.addEventListener("message", onMessageReceived);
+  sock.addEventListener("open", () => {
+    reconnectDelay = 500;
+  });
+  sock.addEventListener("close", (e) => {
+    // jittered so tabs and devices dropped together don't all come back at once
+    const delay = Math.round(reconnectDelay * (0.5 + Math.random()));
+    console.warn(`Socket closed (${e.code}), reconnecting in ${delay}ms`);
+    setTimeout(() => {
+      ws = connectSocket();
+    }, delay);
+    reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+  });
+  return sock;
+}
 
 /**
- *
+ * Acks everything up to `mid`, batched over ACK_DELAY_MS.
+ * @param {number} mid
+ */
+function scheduleAck(mid) {
+  pendingAck = Math.max(pendingAck, mid);
+  if (ackTimer !== undefined) {
+    return;
+  }
+  ackTimer = setTimeout(() => {
+    ackTimer = undefined;
+    if (ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ ack: pendingAck }));
+    }
+    lastAck = Math.max(lastAck ?? 0, pendingAck);
+  }, ACK_DELAY_MS);
+}
+
+/**
+ * Dispatches one flat `iot.v2.json` frame, see iot_proj/wire.py.
  * @param {MessageEvent<string>} event
  */
 function onMessageReceived(event) {
-  const payload = Payload.fromString(event.data);
-  if (payload === null) {
-    console.error("Invalid payload received");
+  /** @type {Object} */
+  let frame;
+  try {
+    frame = JSON.parse(event.data);
+  } catch (e) {
+    console.error(`Invalid frame received: ${e}`);
     return;
   }
-  payload.process();
+  switch (frame.t) {
+    case PayloadType.MSG:
+      if (typeof frame.msg !== "string" || typeof frame.sender_id !== "string") {
+        console.error("Invalid message frame");
+        return;
+      }
+      if (typeof frame.mid === "number") {
+        // replays after a reconnect may repeat what was shown before the ack went out
+        if (frame.mid <= Math.max(lastAck ?? 0, pendingAck)) {
+          return;
+        }
+        scheduleAck(frame.mid);
+      }
+      showMessage(new MsgPayload(frame.msg, frame.sender_id));
+      break;
+    case PayloadType.ONLINE:
+      if (!Array.isArray(frame.ids)) {
+        console.error("Invalid online frame");
+        return;
+      }
+      frame.ids.forEach((id) => onConnect(new ConPayload(id)));
+      break;
+    case PayloadType.PRESENCE:
+      (frame.offline ?? []).forEach((id) => onDisconnect(new DisconPayload(id)));
+      (frame.online ?? []).forEach((id) => onConnect(new ConPayload(id)));
+      break;
+    case PayloadType.ERROR:
+      console.error(`Server error: ${frame.error}`);
+      break;
+    case PayloadType.START:
+      // everything up to here is in the history loaded with the page
+      if (typeof frame.mid === "number") {
+        lastAck = Math.max(lastAck ?? 0, frame.mid);
+      }
+      break;
+    case PayloadType.PING:
+      // the server closes sockets that stop answering, see iot_proj/heartbeat.py
+      ws.send(PONG_FRAME);
+      break;
+    case PayloadType.VITALS:
+      // live aggregates of the doctor's patients, handled by doctor.js
+      if (typeof onVitals === "function" && Array.isArray(frame.series)) {
+        onVitals(frame);
+      }
+      break;
+    default:
+      console.warn("Type for frame not found: ", frame.t);
+  }
 }
 
 /**
@@ -91,90 +196,74 @@ function showMessage(msg) {
   if (curConvo && msg.sender_id === curConvo.substring(1)) {
     const div = createChatEntryDiv(entry);
     chatsPane.appendChild(div);
+  } else {
+    const c = conversations.get(msg.sender_id);
+    if (c) {
+      c.unread = (c.unread ?? 0) + 1;
+      updateConversationLi(c, msg.msg);
+    }
   }
 }
 
-class Payload {
-  /** @type {PayloadType} */
-  #type;
-  #data;
+/**
+ * Builds the list item of a conversation with its last message and unread badge.
+ * @param {Conversation} c
+ * @returns {HTMLLIElement}
+ */
+function createConversationLi(c) {
+  const li = document.createElement("li");
+  li.id = CON_PREFIX + c.id;
+  li.className = "p-4 border-b border-gray-200 cursor-pointer hover:bg-blue-50 transition duration-150 ease-in-out";
+  li.innerHTML = `
+    <div class="flex items-center justify-between gap-2">
+      <span class="text-gray-700 font-medium">${c.name}</span>
+      <span class="unread-badge hidden bg-blue-500 text-white text-xs rounded-full px-2"></span>
+    </div>
+    <p class="last-message text-sm text-gray-500 truncate"></p>
+  `;
+  updateConversationLi(c, c.last_message ?? "", li);
+  return li;
+}
 
-  /**
-   *
-   * @param {PayloadType} type
-   * @param {string} data
-   */
-  constructor(type, data) {
-    this.#type = type;
-    this.#data = data;
+/**
+ * @param {Conversation} c
+ * @param {string} lastMessage
+ * @param {HTMLElement|null} li
+ */
+function updateConversationLi(c, lastMessage, li = document.getElementById(CON_PREFIX + c.id)) {
+  if (!li) {
+    return;
   }
+  li.querySelector(".last-message").textContent = lastMessage;
+  const badge = li.querySelector(".unread-badge");
+  badge.textContent = `${c.unread ?? 0}`;
+  badge.classList.toggle("hidden", !c.unread);
+}
 
-  get type() {
-    return this.#type;
+/**
+ * Moves the read marker of conversation `cid` to its newest saved entry.
+ * @param {string} cid
+ */
+function markRead(cid) {
+  const entries = chatEntries.get(cid) ?? [];
+  const last = entries.findLast((e) => typeof e.id === "number");
+  const c = conversations.get(cid);
+  if (c && c.unread) {
+    c.unread = 0;
+    updateConversationLi(c, entries.length ? entries[entries.length - 1].message : c.last_message ?? "");
   }
-
-  process() {
-    /** @type {Object} */
-    let json;
-    try {
-      json = JSON.parse(this.#data);
-    } catch (e) {
-      console.error(`Invalid payload data: {e}`);
-      return;
-    }
-    switch (this.#type) {
-      case PayloadType.CONN:
-        if (!Object.hasOwn(json, "id") && !Object.hasOwn(json, "wsip")) {
-          console.error("Invalid connect payload");
-          return;
-        }
-        const conn = new ConPayload(json["id"]);
-        onConnect(conn);
-        break;
-      case PayloadType.DISCON:
-        if (!Object.hasOwn(json, "id")) {
-          console.error("Invalid disconnect payload");
-          return;
-        }
-        const discon = new DisconPayload(json["id"]);
-        onDisconnect(discon);
-        break;
-      case PayloadType.MSG:
-        if (!Object.hasOwn(json, "msg") && !Object.hasOwn(json, "sender_id")) {
-          console.error("Invalid message payload");
-          return;
-        }
-        const msg = new MsgPayload(json["msg"], json["sender_id"]);
-        showMessage(msg);
-        break;
-      default:
-        console.warn("Type for message not found: ", this.#type);
-    }
+  if (last === undefined) {
+    return;
   }
-
-  /**
-   *
-   * @param {string} json
-   * @returns {Payload | null}
-   */
-  static fromString(json) {
-    try {
-      const j = JSON.parse(json);
-      if (!Object.hasOwn(j, "type") && !Object.hasOwn(j, "data")) {
-        console.error(`Invalid message payload received: ${j}`);
-        return null;
-      }
-      const ty = getPayloadType(j.type);
-      if (!ty) {
-        console.error("Couldn't get payload type aborting");
-        return null;
-      }
-      return new Payload(ty, j.data);
-    } catch (e) {
-      console.error(e);
-      return null;
+  const fd = new FormData();
+  fd.set("id", cid);
+  fd.set("last_id", `${last.id}`);
+  const who = IS_DOC ? "doctor" : "patient";
+  fetch(`http://${API_URL}/${who}/conversation/read`, { method: "POST", body: fd }).then((r) => {
+    if (!r.ok) {
+      r.text().then((t) => console.error(`Error marking conversation read: ${t}`));
     }
-  }
+  });
 }
 
 /**
@@ -207,7 +296,7 @@ function onDisconnect(disconn) {
 function onConversationClicked(event) {
   /** @type {HTMLDivElement} */
   let target = event.target;
-  if (target.id === "") {
+  while (target.id === "" && target.parentElement) {
     target = target.parentElement;
   }
 
@@ -253,13 +342,140 @@ function onConversationClicked(event) {
   if (pleaseWaitMsgPlaceholder) {
     pleaseWaitMsgPlaceholder.classList.add("hidden");
   }
+  chatsPane.scrollTop = chatsPane.scrollHeight;
   curConvo = target.id;
   target.classList.add("bg-gray-100");
+  markRead(cid);
   if (metrics) {
     metrics.classList.remove("hidden")
   }
 }
 
+/**
+ * Fetches one page of entries of the conversation with `cid`, oldest first.
+ * @param {string} cid
+ * @param {number|null} before id of the oldest entry already loaded
+ * @returns {Promise<EntriesRes|null>}
+ */
+function fetchEntries(cid, before = null) {
+  const params = new URLSearchParams();
+  params.set(IS_DOC ? "patId" : "docId", cid);
+  params.set("limit", `${ENTRIES_PAGE_SIZE}`);
+  if (before !== null) {
+    params.set("before", `${before}`);
+  }
+  const who = IS_DOC ? "doctor" : "patient";
+  return fetch(`http://${API_URL}/${who}/conversation/entries?${params}`).then(
+    (r) => {
+      if (!r.ok) {
+        console.error("error fetching chat entries for chat ", cid);
+        r.text().then((t) => console.error(t));
+        return null;
+      }
+      return r.json();
+    }
+  );
+}
+
+/**
+ * Fetches the entries of conversation `cid` saved after entry `since`, oldest first.
+ * @param {string} cid
+ * @param {number} since high-water mark, id of the newest entry already held
+ * @returns {Promise<EntriesRes|null>}
+ */
+function fetchEntriesSince(cid, since) {
+  const params = new URLSearchParams();
+  params.set(IS_DOC ? "patId" : "docId", cid);
+  params.set("since", `${since}`);
+  const who = IS_DOC ? "doctor" : "patient";
+  return fetch(`http://${API_URL}/${who}/conversation/sync?${params}`).then((r) => {
+    if (!r.ok) {
+      console.error("error syncing chat entries for chat ", cid);
+      r.text().then((t) => console.error(t));
+      return null;
+    }
+    return r.json();
+  });
+}
+
+/**
+ * Entries of conversation `cid` from the local cache topped up with what is
+ * newer on the server, or the latest page when nothing usable is cached.
+ * @param {string} cid
+ * @returns {Promise<EntriesRes>}
+ */
+async function syncEntries(cid) {
+  const cached = await entryStore.load(cid);
+  if (cached !== null) {
+    const since = cached.entries[cached.entries.length - 1].id;
+    const delta = await fetchEntriesSince(cid, since);
+    // a gap wider than one sync page is cheaper to refetch than to walk
+    if (delta !== null && !delta.has_more) {
+      await entryStore.merge(cid, delta.entries);
+      return { entries: cached.entries.concat(delta.entries), has_more: cached.hasMore };
+    }
+    await entryStore.clear(cid);
+  }
+  const page = (await fetchEntries(cid)) ?? { entries: [], has_more: false };
+  await entryStore.merge(cid, page.entries, page.has_more);
+  return page;
+}
+
+/**
+ * Loads the entries of every conversation into the cache.
+ * @param {Conversation[]} convos
+ */
+async function loadLatestEntries(convos) {
+  const entriesResp = await Promise.all(convos.map((c) => syncEntries(c.id).then((e) => [c.id, e])));
+  entriesResp.forEach((e) => {
+    chatEntries.set(e[0], e[1].entries);
+    chatHasMore.set(e[0], e[1].has_more);
+  });
+}
+
+async function loadOlderEntries() {
+  if (!curConvo) {
+    return;
+  }
+  const cid = curConvo.substring(1);
+  const entries = chatEntries.get(cid);
+  if (!entries || !chatHasMore.get(cid) || chatLoadingOlder.has(cid)) {
+    return;
+  }
+  const oldest = entries.find((e) => e.id !== null);
+  if (oldest === undefined) {
+    return;
+  }
+  chatLoadingOlder.add(cid);
+  try {
+    const page = await fetchEntries(cid, oldest.id);
+    if (page === null) {
+      return;
+    }
+    entries.unshift(...page.entries);
+    chatHasMore.set(cid, page.has_more);
+    entryStore.merge(cid, page.entries, page.has_more);
+    if (curConvo !== CON_PREFIX + cid) {
+      return;
+    }
+    // keep the message under the cursor in place while prepending
+    const prevHeight = chatsPane.scrollHeight;
+    const anchor = chatsPane.querySelector(".chat-entry");
+    page.entries.forEach((e) => {
+      chatsPane.insertBefore(createChatEntryDiv(e), anchor);
+    });
+    chatsPane.scrollTop += chatsPane.scrollHeight - prevHeight;
+  } finally {
+    chatLoadingOlder.delete(cid);
+  }
+}
+
+chatsPane.addEventListener("scroll", function () {
+  if (chatsPane.scrollTop < LOAD_OLDER_THRESHOLD_PX) {
+    loadOlderEntries();
+  }
+});
+
 class Conversation {
   /**
    *
@@ -271,6 +487,11 @@ class Conversation {
     this.name = name;
     this.id = id;
     this.onlineStatus = onlineStatus;
+    /** @type {string|null} */
+    this.last_message = null;
+    /** @type {string|null} */
+    this.last_time = null;
+    this.unread = 0;
   }
 }
 
@@ -315,6 +536,12 @@ const PayloadType = Object.freeze({
   DISCON: "disconnect",
   CONN: "connect",
   MSG: "message",
+  ONLINE: "online",
+  PRESENCE: "presence",
+  ERROR: "error",
+  VITALS: "vitals",
+  PING: "ping",
+  START: "start",
 });
 
 /**
@@ -325,7 +552,7 @@ const PayloadType = Object.freeze({
 function createChatEntryDiv(e) {
   const div = document.createElement("div");
   if (e.from_doctor === !IS_DOC) {
-    div.className = "flex items-start gap-1 mb-4";
+    div.className = "chat-entry flex items-start gap-1 mb-4";
     div.innerHTML = `
           <div
             class="bg-white text-gray-800 px-4 py-2 rounded-lg shadow-sm max-w-md"
@@ -334,7 +561,7 @@ function createChatEntryDiv(e) {
           </div>
         `;
   } else {
-    div.className = "flex items-start space-x-3 mb-4 flex-row-reverse gap-1";
+    div.className = "chat-entry flex items-start space-x-3 mb-4 flex-row-reverse gap-1";
     div.innerHTML = `
           <div
             class="bg-blue-500 text-white px-4 py-2 rounded-lg shadow-sm max-w-md"
@@ -346,24 +573,6 @@ function createChatEntryDiv(e) {
   return div;
 }
 
-/**
- *
- * @param {string} type
- * @returns {PayloadType | null}
- */
-function getPayloadType(type) {
-  switch (type) {
-    case PayloadType.DISCON:
-      return PayloadType.DISCON;
-    case PayloadType.CONN:
-      return PayloadType.CONN;
-    case PayloadType.MSG:
-      return PayloadType.MSG;
-    default:
-      return null;
-  }
-}
-
 /**
  * @typedef {Object} ChatEntry
  * @property {number} id
@@ -375,6 +584,7 @@ function getPayloadType(type) {
 /**
  * @typedef {Object} EntriesRes
  * @property {ChatEntry[]} entries
+ * @property {boolean} has_more
  */
 
 /**
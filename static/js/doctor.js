@@ -16,11 +16,7 @@ const IS_DOC = true;
   j.conversations.forEach((c) => {
     conversations.set(c.id, c);
 
-    const li = document.createElement("li");
-    li.id = CON_PREFIX + c.id;
-    li.className = "p-4 border-b border-gray-200 cursor-pointer hover:bg-blue-50 transition duration-150 ease-in-out";
-    li.innerHTML = `<span class="text-gray-700 font-medium">${c.name}</span>`;
-
+    const li = createConversationLi(c);
     li.addEventListener("click", onConversationClicked);
 
     if (conversationsCont) {
@@ -28,31 +24,7 @@ const IS_DOC = true;
     }
   });
 
-  const entriesReqs = j.conversations.map((c) =>
-    fetch(`http://${API_URL}/doctor/conversation/entries?patId=${c.id}`)
-  .then((r) => {
-    if (!r.ok) {
-      console.error("error fetching chat entries for chat ", c.id);
-      r.text().then((t) => console.error(t));
-      return null;
-    }
-    return r.json();
-  })
-  .then((e) => {
-    if (e !== null) {
-      /** @type {EntriesRes} */
-      const json = e;
-      return [c.id, json];
-    }
-    return [c.id, { entries: [] }];
-  })
-);
-
-const entriesResp = await Promise.all(entriesReqs);
-
-entriesResp.forEach((e) => {
-chatEntries.set(e[0], e[1].entries);
-});
+  await loadLatestEntries(j.conversations);
 })();
 
 /**
@@ -70,5 +42,36 @@ function onConnect(conn) {
   }
 }
 
+const VITALS_LABELS = Object.freeze({
+  heart_rate: (v) => `♥ ${Math.round(v)}`,
+  spo2: (v) => `SpO₂ ${Math.round(v)}%`,
+  temperature: (v) => `${v.toFixed(1)}°C`,
+});
 
-
+/**
+ * Shows the latest window averages of each patient under their conversation.
+ * @param {{start: number, window: number, series: {patient_id: string, metric: string, n: number, min: number, max: number, avg: number}[]}} frame
+ */
+function onVitals(frame) {
+  frame.series.forEach((s) => {
+    const li = document.getElementById(CON_PREFIX + s.patient_id);
+    const label = VITALS_LABELS[s.metric];
+    if (!li || !label) {
+      return;
+    }
+    let span = li.querySelector(`.vitals-${s.metric}`);
+    if (!span) {
+      let row = li.querySelector(".vitals");
+      if (!row) {
+        row = document.createElement("div");
+        row.className = "vitals flex gap-2 text-xs text-gray-500 mt-1";
+        li.append(row);
+      }
+      span = document.createElement("span");
+      span.className = `vitals-${s.metric}`;
+      row.append(span);
+    }
+    span.textContent = label(s.avg);
+    span.title = `min ${s.min.toFixed(1)} / max ${s.max.toFixed(1)} over ${s.n} readings`;
+  });
+}
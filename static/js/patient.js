@@ -15,11 +15,7 @@ const IS_DOC = false;
   j.conversations.forEach((c) => {
     conversations.set(c.id, c);
 
-    const li = document.createElement("li");
-    li.id = CON_PREFIX + c.id;
-    li.className = "p-4 border-b border-gray-200 cursor-pointer hover:bg-blue-50 transition duration-150 ease-in-out";
-    li.innerHTML = `<span class="text-gray-700 font-medium">${c.name}</span>`;
-
+    const li = createConversationLi(c);
     li.addEventListener("click", onConversationClicked);
 
     if (conversationsCont) {
@@ -27,31 +23,7 @@ const IS_DOC = false;
     }
   });
 
-  const entriesReqs = j.conversations.map((c) =>
-    fetch(`http://${API_URL}/patient/conversation/entries?docId=${c.id}`)
-      .then((r) => {
-        if (!r.ok) {
-          console.error("error fetching chat entries for chat ", c.id);
-          r.text().then((t) => console.error(t));
-          return null;
-        }
-        return r.json();
-      })
-      .then((e) => {
-        if (e !== null) {
-          /** @type {EntriesRes} */
-          const json = e;
-          return [c.id, json];
-        }
-        return [c.id, { entries: [] }];
-      })
-  );
-
-  const entriesResp = await Promise.all(entriesReqs);
-  
-  entriesResp.forEach((e) => {
-    chatEntries.set(e[0], e[1].entries);
-  });
+  await loadLatestEntries(j.conversations);
 })();
 
 /**
@@ -66,44 +38,79 @@ function onConnect(conn) {
     if (conv) {
       conv.classList.add(ONLINE_CLASS);
     }
-  } else {
-    console.log("Fetching doctor");
-    if (activeConnectionsCont) {
-      fetch(`http://${API_URL}/get/doctor/${conn.id}`)
-        .then((r) => {
-          if (!r.ok) {
-            r.text().then((t) => console.error(`Error getting doc info: ${t}`));
-            return;
-          }
-          return r.json();
-        })
-        .then((json) => {
-          if (json) {
-            /** @type {DoctorM} */
-            const data = JSON.parse(json);
-            activeConnections.set(data.id, data);
-
-            const div = document.createElement("div");
-            div.className = "flex items-center space-x-4 w-max cursor-pointer";
-            div.id = CON_PREFIX + data["id"];
-            div.innerHTML = `
-            <div class="relative">
-              <div class="rounded-full w-12 h-12 bg-blue-500 text-white grid place-content-center text-xl font-semibold">
-                <p>${data.name[0].toUpperCase()}</p>
-              </div>
-              <div class="absolute w-3 h-3 bg-green-400 rounded-full right-0 top-0 animate-ping"></div>
-              </div>
-               <p class="text-sm font-medium text-gray-800 truncate">Dr. ${data.name}</p>
-          `;
-            div.addEventListener("click", onActiveConnectionClicked);
-            console.log("Updating ui with new available doctor");
-            activeConnectionsCont.appendChild(div);
-          }
-        });
+  } else if (!activeConnections.has(conn.id)) {
+    const card = doctorCards.get(conn.id);
+    if (card) {
+      showActiveDoctor(card);
+      return;
     }
+    // doctors coming online together are looked up in one request
+    pendingDoctors.add(conn.id);
+    if (pendingDoctors.size === 1) {
+      setTimeout(fetchPendingDoctors, 0);
+    }
+  }
+}
+
+/** @type {Map<string, DoctorCard>} */
+const doctorCards = new Map();
+/** @type {Set<string>} */
+const pendingDoctors = new Set();
+// the server looks up at most this many ids per request
+const DOCTORS_PER_LOOKUP = 100;
+
+function fetchPendingDoctors() {
+  const ids = [...pendingDoctors];
+  pendingDoctors.clear();
+  for (let i = 0; i < ids.length; i += DOCTORS_PER_LOOKUP) {
+    const query = new URLSearchParams(ids.slice(i, i + DOCTORS_PER_LOOKUP).map((id) => ["id", id]));
+    console.log("Fetching doctors");
+    fetch(`http://${API_URL}/get/doctors?${query}`)
+      .then((r) => {
+        if (!r.ok) {
+          r.text().then((t) => console.error(`Error getting doc info: ${t}`));
+          return;
+        }
+        return r.json();
+      })
+      .then((json) => {
+        if (json) {
+          json.doctors.forEach((card) => {
+            doctorCards.set(card.id, card);
+            showActiveDoctor(card);
+          });
+        }
+      });
   }
 }
 
+/**
+ *
+ * @param {DoctorCard} data
+ */
+function showActiveDoctor(data) {
+  if (!activeConnectionsCont || activeConnections.has(data.id) || conversations.has(data.id)) {
+    return;
+  }
+  activeConnections.set(data.id, data);
+
+  const div = document.createElement("div");
+  div.className = "flex items-center space-x-4 w-max cursor-pointer";
+  div.id = CON_PREFIX + data["id"];
+  div.innerHTML = `
+    <div class="relative">
+      <div class="rounded-full w-12 h-12 bg-blue-500 text-white grid place-content-center text-xl font-semibold">
+        <p>${data.name[0].toUpperCase()}</p>
+      </div>
+      <div class="absolute w-3 h-3 bg-green-400 rounded-full right-0 top-0 animate-ping"></div>
+      </div>
+       <p class="text-sm font-medium text-gray-800 truncate">Dr. ${data.name}</p>
+  `;
+  div.addEventListener("click", onActiveConnectionClicked);
+  console.log("Updating ui with new available doctor");
+  activeConnectionsCont.appendChild(div);
+}
+
 function onActiveConnectionClicked(event) {
   /** @type {HTMLDivElement} */
   let target = event.target;
@@ -154,4 +161,10 @@ function onActiveConnectionClicked(event) {
  * @property {string} name
  * @property {string} id
  * @property {string[]} qualifications
- */
\ No newline at end of file
+ */
+/**
+ * @typedef {Object} DoctorCard
+ * @property {string} id
+ * @property {string} name
+ * @property {string[]} qualifications
+ */
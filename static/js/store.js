@@ -0,0 +1,113 @@
+"use strict";
+
+/**
+ * IndexedDB cache of chat entries, one database per signed in user.
+ *
+ * `entries` holds saved entries (numeric id) keyed by [chat, id], so a chat's
+ * entries come back in id order; `chats` remembers per chat whether older
+ * history is left on the server.
+ * Every call resolves to an empty result when IndexedDB is unavailable, so the
+ * page falls back to plain fetches.
+ */
+const entryStore = (function () {
+  const DB_VERSION = 1;
+  /** @type {Promise<IDBDatabase|null>|null} */
+  let dbPromise = null;
+
+  function open() {
+    if (dbPromise) {
+      return dbPromise;
+    }
+    dbPromise = new Promise((resolve) => {
+      if (!("indexedDB" in window)) {
+        resolve(null);
+        return;
+      }
+      const req = indexedDB.open(`iot-chat-${IS_DOC ? "d" : "p"}-${USER_ID}`, DB_VERSION);
+      req.onupgradeneeded = () => {
+        const db = req.result;
+        db.createObjectStore("entries", { keyPath: ["chat", "id"] });
+        db.createObjectStore("chats", { keyPath: "chat" });
+      };
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => {
+        console.warn("IndexedDB unavailable, chat history is not cached", req.error);
+        resolve(null);
+      };
+    });
+    return dbPromise;
+  }
+
+  /**
+   * @param {IDBRequest|IDBTransaction} req
+   */
+  function done(req) {
+    return new Promise((resolve, reject) => {
+      if (req instanceof IDBTransaction) {
+        req.oncomplete = () => resolve(undefined);
+      } else {
+        req.onsuccess = () => resolve(req.result);
+      }
+      req.onerror = () => reject(req.error);
+    });
+  }
+
+  /**
+   * Cached entries of chat `cid`, oldest first, and whether older ones exist.
+   * @param {string} cid
+   * @returns {Promise<{entries: ChatEntry[], hasMore: boolean}|null>}
+   */
+  async function load(cid) {
+    const db = await open();
+    if (!db) {
+      return null;
+    }
+    const tx = db.transaction(["entries", "chats"], "readonly");
+    const range = IDBKeyRange.bound([cid, -Infinity], [cid, Infinity]);
+    const [entries, meta] = await Promise.all([
+      done(tx.objectStore("entries").getAll(range)),
+      done(tx.objectStore("chats").get(cid)),
+    ]);
+    if (meta === undefined || entries.length === 0) {
+      return null;
+    }
+    return { entries, hasMore: meta.hasMore };
+  }
+
+  /**
+   * Merges `entries` into the cache of chat `cid`.
+   * @param {string} cid
+   * @param {ChatEntry[]} entries
+   * @param {boolean|undefined} hasMore new value of the older history flag, kept when undefined
+   */
+  async function merge(cid, entries, hasMore = undefined) {
+    const db = await open();
+    if (!db) {
+      return;
+    }
+    const tx = db.transaction(["entries", "chats"], "readwrite");
+    const store = tx.objectStore("entries");
+    entries.filter((e) => typeof e.id === "number").forEach((e) => store.put({ ...e, chat: cid }));
+    if (hasMore !== undefined) {
+      tx.objectStore("chats").put({ chat: cid, hasMore });
+    }
+    await done(tx);
+  }
+
+  /**
+   * Drops everything cached for chat `cid`.
+   * @param {string} cid
+   */
+  async function clear(cid) {
+    const db = await open();
+    if (!db) {
+      return;
+    }
+    const tx = db.transaction(["entries", "chats"], "readwrite");
+    tx.objectStore("entries").delete(IDBKeyRange.bound([cid, -Infinity], [cid, Infinity]));
+    tx.objectStore("chats").delete(cid);
+    await done(tx);
+  }
+
+  return { load, merge, clear };
+})();
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# settings are read once at import, so point the app at a scratch database before anything imports it
+_tmp = tempfile.mkdtemp(prefix="iot_proj_tests_")
+os.environ.setdefault("IOT_DB_PATH", os.path.join(_tmp, "db.sqlite3"))
+os.environ.setdefault("IOT_HASH_WORKERS", "0")
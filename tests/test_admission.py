@@ -0,0 +1,97 @@
+import asyncio
+import sys
+
+import pytest
+
+from iot_proj.admission import Admission, ChatOverloaded, TokenBucket
+
+# `iot_proj.admission` is also the name of the instance iot_proj exports
+admission = sys.modules["iot_proj.admission"]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.take(clock.now) for _ in range(4)] == [True, True, True, False]
+    assert not bucket.take(clock.now + 0.4)
+    assert bucket.take(clock.now + 0.5)
+    assert not bucket.take(clock.now + 0.5)
+
+
+def test_bucket_refill_is_capped_at_the_burst(clock):
+    bucket = TokenBucket(rate=1, burst=2)
+    later = clock.now + 3600
+    assert [bucket.take(later) for _ in range(3)] == [True, True, False]
+
+
+def test_bucket_without_a_rate_never_runs_out(clock):
+    bucket = TokenBucket(rate=0, burst=0)
+    assert all(bucket.take(clock.now) for _ in range(1000))
+
+
+def test_user_bucket_is_shared_between_sockets(clock):
+    a = Admission(rate=10, burst=10, user_rate=1, user_burst=2)
+    first, _ = a.connection_buckets()
+    second, _ = a.connection_buckets()
+    assert a.allow("u", first)
+    assert a.allow("u", second)
+    assert not a.allow("u", first)
+    assert a.throttled == {"connection": 0, "user": 1}
+    # another user has a bucket of their own
+    assert a.allow("v", second)
+
+
+def test_connection_bucket_throttles_first(clock):
+    a = Admission(rate=1, burst=1, user_rate=0, user_burst=0)
+    bucket, _ = a.connection_buckets()
+    assert a.allow("u", bucket)
+    assert not a.allow("u", bucket)
+    assert a.throttled == {"connection": 1, "user": 0}
+
+
+def test_strikes_close_the_socket(clock):
+    a = Admission(strikes=3)
+    _, strikes = a.connection_buckets()
+    assert [a.strike(strikes) for _ in range(4)] == [True, True, True, False]
+    assert a.closed["rate"] == 1
+    # strikes come back at one a second
+    clock.now += 1
+    assert a.strike(strikes)
+
+
+def test_too_big(clock):
+    a = Admission(max_size=4)
+    assert not a.too_big("abcd")
+    assert a.too_big("abcde")
+    assert a.closed["size"] == 1
+
+
+def test_slot_times_out_when_all_are_taken():
+    async def main():
+        a = Admission(max_in_flight=1, timeout=0.05)
+        async with a.slot():
+            assert a.in_flight == 1
+            with pytest.raises(ChatOverloaded):
+                async with a.slot():
+                    pass
+        assert a.closed["overload"] == 1
+        assert a.in_flight == 0
+        # the slot is free again once released
+        async with a.slot():
+            pass
+
+    asyncio.run(main())
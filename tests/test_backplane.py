@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+import tempfile
+
+from iot_proj.backplane import Broker, Event, EventKind, UnixSocketBackplane, connect_unix
+from iot_proj.websoc import ConnectionManager
+
+
+class FakeSocket:
+    """Just what ConnectionManager needs from a starlette WebSocket."""
+
+    def __init__(self):
+        self.scope = {"subprotocols": ["iot.v2.json"]}
+        self.sent: list[dict] = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+
+async def until(condition, timeout: float = 5.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def socket_path() -> str:
+    return os.path.join(tempfile.mkdtemp(prefix="iot_proj_bp_"), "bp.sock")
+
+
+def manager(path: str) -> ConnectionManager:
+    return ConnectionManager(backplane=UnixSocketBackplane(path), presence_batch_interval=0, resync_grace=0.2)
+
+
+def test_workers_share_presence_and_relay():
+    async def run():
+        path = socket_path()
+        a, b = manager(path), manager(path)
+        await a.start()
+        sock_a = FakeSocket()
+        await a.connect(sock_a, id="pat-a", is_doc=False, acks=True)
+        # b learns about pat-a from a's answer to its sync
+        await b.start()
+        assert a.backplane.broker is not None and b.backplane.broker is None
+        await until(lambda: "pat-a" in b.presence[False])
+        # and a about doc-b from the join
+        await b.connect(FakeSocket(), id="doc-b", is_doc=True, acks=True)
+        await until(lambda: "doc-b" in a.presence[True])
+
+        await b.relay_message("hello", senderid="doc-b", recvid="pat-a")
+        await until(lambda: any(f.get("t") == "message" for f in sock_a.sent))
+        msg = next(f for f in sock_a.sent if f.get("t") == "message")
+        assert (msg["msg"], msg["sender_id"]) == ("hello", "doc-b")
+
+        # b goes away without publishing a leave, the broker's gone event clears doc-b
+        await b.backplane.stop()
+        await until(lambda: "doc-b" not in a.presence[True])
+        assert {"t": "presence", "online": [], "offline": ["doc-b"]} in sock_a.sent
+        await a.stop()
+
+    asyncio.run(run())
+
+
+def test_broker_disconnects_a_worker_that_stops_reading():
+    async def run():
+        path = socket_path()
+        broker = Broker(path, queue_size=4)
+        await broker.start()
+        # a small buffer, so this one stops reading from the socket for good
+        _, stalled = await asyncio.open_unix_connection(path, limit=1024)
+        reader, sender = await connect_unix(path)
+        await until(lambda: len(broker.clients) == 2)
+        line = Event(kind=EventKind.relay, origin="sender", id="x", sender="y", msg="m" * 100_000).model_dump_json().encode() + b"\n"
+        received = 0
+        for _ in range(100):
+            sender.write(line)
+            await sender.drain()
+            # the reading worker keeps up whatever the stalled one does
+            await reader.readline()
+            received += 1
+        assert received == 100
+        assert broker.slow_disconnects == 1
+        assert len(broker.clients) == 1
+        stalled.close()
+        sender.close()
+        await broker.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+import pytest
+
+import iot_proj.delivery as delivery
+from iot_proj.delivery import DeliveryQueues
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time_ns(self) -> int:
+        return int(self.now * 1e9)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(delivery, "time", clock)
+    return clock
+
+
+def msgs(q: DeliveryQueues, recipient: str, after: int = 0) -> list[str]:
+    return [item.msg for item in q.pending(recipient, after)]
+
+
+def test_overflow_drops_oldest(clock):
+    q = DeliveryQueues(maxsize=3)
+    for i in range(5):
+        q.push("u", "s", f"m{i}")
+    assert msgs(q, "u") == ["m2", "m3", "m4"]
+    assert q.dropped == 2
+
+
+def test_mids_grow_within_the_same_clock_tick(clock):
+    q = DeliveryQueues(maxsize=10)
+    mids = [q.push("u", "s", "m").mid for _ in range(3)]
+    assert mids == sorted(set(mids))
+
+
+def test_recipient_cap_drops_least_recently_pushed(clock):
+    q = DeliveryQueues(maxsize=10, max_recipients=2)
+    q.push("a", "s", "a1")
+    q.push("b", "s", "b1")
+    q.push("a", "s", "a2")
+    q.push("c", "s", "c1")
+    assert "b" not in q
+    assert msgs(q, "a") == ["a1", "a2"] and msgs(q, "c") == ["c1"]
+    assert q.evicted == 1 and q.dropped == 1
+
+
+def test_idle_queues_expire(clock):
+    q = DeliveryQueues(maxsize=10, ttl=60)
+    q.push("a", "s", "a1")
+    clock.now += 30
+    q.push("b", "s", "b1")
+    clock.now += 31
+    q.push("c", "s", "c1")
+    assert "a" not in q and "b" in q and "c" in q
+    assert q.evicted == 1
+
+
+def test_ack_keeps_what_a_parked_device_has_not_acked(clock):
+    q = DeliveryQueues(maxsize=10, resume_window=120)
+    m1, m2, m3 = (q.push("u", "s", f"m{i}") for i in (1, 2, 3))
+    # one device went away having acked m1, another acks everything
+    q.park("u", m1.mid)
+    q.ack("u", m3.mid)
+    assert msgs(q, "u", after=m1.mid) == ["m2", "m3"]
+    # past the resume window the parked position no longer holds anything back
+    clock.now += 121
+    q.ack("u", m3.mid)
+    assert "u" not in q
+
+
+def test_ack_trims_to_the_lowest_parked_position(clock):
+    q = DeliveryQueues(maxsize=10, resume_window=120)
+    m1, m2, m3 = (q.push("u", "s", f"m{i}") for i in (1, 2, 3))
+    q.park("u", m2.mid)
+    q.park("u", m1.mid)
+    q.ack("u", m3.mid)
+    assert msgs(q, "u") == ["m2", "m3"]
+
+
+def test_take_empties_the_queue(clock):
+    q = DeliveryQueues(maxsize=10)
+    q.push("u", "s", "m1")
+    assert [item.msg for item in q.take("u")] == ["m1"]
+    assert "u" not in q and q.take("u") == []
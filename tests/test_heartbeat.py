@@ -0,0 +1,118 @@
+import pytest
+
+import iot_proj.heartbeat as heartbeat
+from iot_proj.heartbeat import Heartbeat, TimingWheel
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class Con:
+    def __init__(self):
+        self.last_seen = 0.0
+        self.pinged_at = 0.0
+        self.slot = -1
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(heartbeat, "time", clock)
+    return clock
+
+
+class Recorder:
+    def __init__(self, clock: FakeClock, **kwargs):
+        self.clock = clock
+        self.pinged: list[Con] = []
+        self.dead: list[Con] = []
+        self.hb = Heartbeat(self.pinged.append, self.dead.append, tick=1, **kwargs)
+
+    def run(self, seconds: int):
+        for _ in range(seconds):
+            self.clock.now += 1
+            self.hb.expire()
+
+
+def test_wheel_returns_items_on_their_tick():
+    wheel = TimingWheel(tick=1, horizon=10)
+    a, b = object(), object()
+    wheel.add(a, 2)
+    slot = wheel.add(b, 3)
+    assert len(wheel) == 2
+    assert wheel.advance() == set()
+    assert wheel.advance() == {a}
+    wheel.remove(b, slot)
+    assert wheel.advance() == set()
+    assert len(wheel) == 0
+
+
+def test_wheel_rounds_delays_up_to_the_next_tick():
+    wheel = TimingWheel(tick=0.5, horizon=10)
+    a = object()
+    wheel.add(a, 0.1)
+    assert wheel.advance() == {a}
+
+
+def test_ping_after_the_interval(clock):
+    r = Recorder(clock, interval=10, timeout=5)
+    con = Con()
+    r.hb.add(con)
+    r.run(9)
+    assert r.pinged == []
+    r.run(1)
+    assert r.pinged == [con] and r.hb.pings == 1
+    assert r.dead == []
+
+
+def test_traffic_postpones_the_ping(clock):
+    r = Recorder(clock, interval=10, timeout=5)
+    con = Con()
+    r.hb.add(con)
+    r.run(6)
+    con.last_seen = clock.now
+    r.run(4)
+    assert r.pinged == []
+    r.run(6)
+    assert r.pinged == [con]
+
+
+def test_reap_after_the_timeout(clock):
+    r = Recorder(clock, interval=10, timeout=5)
+    con = Con()
+    r.hb.add(con)
+    r.run(14)
+    assert r.dead == []
+    r.run(1)
+    assert r.dead == [con] and r.hb.reaped == 1
+    assert con.slot == -1 and len(r.hb.wheel) == 0
+
+
+def test_pong_keeps_the_connection(clock):
+    r = Recorder(clock, interval=10, timeout=5)
+    con = Con()
+    r.hb.add(con)
+    r.run(12)
+    assert r.pinged == [con]
+    # the pong
+    con.last_seen = clock.now
+    r.run(8)
+    assert r.dead == [] and con.pinged_at == 0.0
+    # silent again, pinged once more a full interval after the pong
+    r.run(2)
+    assert r.pinged == [con, con]
+    assert r.dead == []
+
+
+def test_removed_connections_are_not_visited(clock):
+    r = Recorder(clock, interval=10, timeout=5)
+    con = Con()
+    r.hb.add(con)
+    r.hb.remove(con)
+    r.run(30)
+    assert r.pinged == [] and r.dead == []
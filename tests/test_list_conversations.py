@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from iot_proj.models import Conversation, ConversationEntries, ConversationRead, Doctor, Patient, async_engine, async_session, create_db_and_tables
+from iot_proj.user_services import list_conversations
+
+CONVERSATIONS = 25
+
+
+async def seed() -> str:
+    """A doctor with CONVERSATIONS patients; patient i sent i + 1 messages, the doctor read the first one of each."""
+    async with async_session() as session:
+        doctor = Doctor(name="doc", email="list-doc@test", password="x")
+        session.add(doctor)
+        start = datetime(2024, 1, 1)
+        for i in range(CONVERSATIONS):
+            patient = Patient(name=f"pat{i}", email=f"list-pat{i}@test", password="x")
+            convo = Conversation(doctor_id=doctor.id, patient_id=patient.id)
+            session.add_all([patient, convo])
+            entries = [ConversationEntries(from_doctor=False, message=f"m{j}", time=start + timedelta(seconds=j), conversation_id=convo.id) for j in range(i + 1)]
+            session.add_all(entries)
+            await session.flush()
+            session.add(ConversationRead(conversation_id=convo.id, is_doctor=True, last_read_id=entries[0].id, last_read_time=entries[0].time))
+        await session.commit()
+        return doctor.id
+
+
+def test_list_conversations_is_one_query():
+    create_db_and_tables()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async def run():
+        doctor_id = await seed()
+        async with async_session() as session:
+            # a fresh connection may run its pragmas first, they are not part of the listing
+            await session.connection()
+            event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+            try:
+                return await list_conversations(doctor_id, is_doc=True, session=session)
+            finally:
+                event.remove(async_engine.sync_engine, "before_cursor_execute", count)
+
+    # one loop for everything, pooled aiosqlite connections are tied to the loop that opened them
+    convos = asyncio.run(run())
+    asyncio.run(async_engine.dispose())
+
+    assert len(statements) == 1, statements
+    assert len(convos) == CONVERSATIONS
+    by_name = {c.name: c for c in convos}
+    for i in range(CONVERSATIONS):
+        c = by_name[f"pat{i}"]
+        assert c.unread == i
+        assert c.last_message == f"m{i}"